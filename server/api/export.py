@@ -0,0 +1,495 @@
+"""Streaming sample exports.
+
+Exports never hold every sample in memory: their columns come from a pre-pass
+in the database, then samples are read and written out a chunk at a time.
+
+Besides CSV, samples can be exported as Arrow IPC files or Parquet, with typed
+columns, when pyarrow is installed.
+"""
+
+import csv
+import datetime
+import io
+import itertools
+import json
+import re
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, List, Literal, Optional, Set, Tuple, Union
+
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+from sqlalchemy import case, func, literal_column, tuple_, type_coerce
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.orm import aliased, Query, Session
+
+from database import load_audit_users, run_audit_rows, run_load_options, ProtocolVersion, Run, RunVersion, Sample, SampleVersion
+from settings import settings
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+# Run fields left out of sample exports.
+RUN_EXPORT_EXCLUDE = '(attachments|type|definition|protocol|plates|plateSequencingResults|plateMarkers)'
+# Added to each sample's data by run_to_sample.
+SAMPLE_ID_COLUMNS = ('sampleID', 'plateID', 'runID', 'protocolID')
+# Runs loaded at a time for exports spanning several runs.
+RUN_BATCH_SIZE = 100
+
+ExportFormat = Literal['csv', 'arrow', 'parquet']
+EXPORT_MEDIA_TYPES = {
+    'csv': 'text/csv',
+    'arrow': 'application/vnd.apache.arrow.file',
+    'parquet': 'application/vnd.apache.parquet',
+}
+
+
+def list_or_dict_items(collection: Union[list, dict]):
+    if type(collection) is list:
+        return zip(map(str, itertools.count()), collection)
+    elif type(collection) is dict:
+        return iter(collection.items())
+    else:
+        raise TypeError(f"Expected a list or a dict type. Found: {type(collection)}")
+
+class Flattener:
+    """Flattens nested lists and dicts into a dict keyed by `__` joined paths,
+    e.g. `{'a': [{'b': 1}]}` into `{'a__0__b': 1}`.
+
+    Lists and dicts whose path matches `exclude` are left out. The pattern is
+    compiled once, and nesting is walked with a stack rather than recursion.
+    """
+
+    def __init__(self, exclude: Optional[str] = None):
+        self.exclude = re.compile(exclude) if exclude is not None else None
+
+    def flatten(self, nested: Union[list, dict], current_path: str = "") -> dict:
+        exclude = self.exclude
+        result = {}
+        if exclude is not None and exclude.search(current_path) is not None:
+            return result
+
+        stack = [(f"{current_path}__" if current_path else "", list_or_dict_items(nested))]
+        while stack:
+            prefix, items = stack[-1]
+            for key, value in items:
+                path = prefix + key
+                value_type = type(value)
+                if value_type is list or value_type is dict:
+                    if exclude is None or exclude.search(path) is None:
+                        stack.append((path + "__", list_or_dict_items(value)))
+                        break
+                else:
+                    result[path] = value
+            else:
+                stack.pop()
+        return result
+
+def flatten_list_or_dict(nested: Union[list, dict], regex: Optional[str] = None, current_path: str = "") -> dict:
+    return Flattener(regex).flatten(nested, current_path)
+
+run_flattener = Flattener(RUN_EXPORT_EXCLUDE)
+
+
+class FlattenedRunCache:
+    """Per-worker LRU of runs flattened as prepended to their samples, keyed
+    by run version.
+
+    Only what the run's lists and dicts flatten to is cached: these come from
+    the (never edited) run version data, or are excluded (the protocol). Top
+    level fields, like the audit fields' user emails, are added on every call.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def flatten(self, run_version_id: Optional[int], run_dict: dict) -> dict:
+        if run_version_id is None or self.max_entries <= 0:
+            return run_flattener.flatten(run_dict)
+
+        with self._lock:
+            nested = self._entries.get(run_version_id)
+            if nested is not None:
+                self._entries.move_to_end(run_version_id)
+                self.hits += 1
+            else:
+                self.misses += 1
+        if nested is None:
+            nested = run_flattener.flatten({
+                key: value
+                for key, value in run_dict.items()
+                if type(value) is list or type(value) is dict
+            })
+            with self._lock:
+                self._entries[run_version_id] = nested
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+
+        flattened = dict(nested)
+        for key, value in run_dict.items():
+            if type(value) is not list and type(value) is not dict:
+                flattened[key] = value
+        return flattened
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+flattened_run_cache = FlattenedRunCache(settings.export_run_cache_size)
+
+
+# Marks columns a sample does not have.
+MISSING = object()
+
+class ColumnPlan:
+    """Fills an export's rows straight from each sample's (unflattened) data,
+    rather than flattening every sample and merging it with its run.
+
+    Columns no sample has (`sample_columns` lists those some do) only ever
+    hold run data, so each run's row is laid out once, and samples only fill
+    in their own columns. Sample data fields (see SampleResult) never contain
+    `__`, so a column's path through a sample is its name split on `__`.
+    """
+
+    def __init__(self, columns: List[str], sample_columns: Iterable[str]):
+        self.columns = columns
+        sample_columns = set(sample_columns)
+        self.sample_paths = []
+        for index, column in enumerate(columns):
+            if column not in sample_columns:
+                continue
+            key, *parts = column.split('__')
+            self.sample_paths.append((index, key, [
+                (part, int(part) if part.isdigit() and str(int(part)) == part else None)
+                for part in parts
+            ]))
+
+    def run_row(self, flattened_run: dict, default='') -> list:
+        return [flattened_run.get(column, default) for column in self.columns]
+
+    def row(self, sample: dict, run_row: list) -> list:
+        row = list(run_row)
+        for index, key, parts in self.sample_paths:
+            value = sample.get(key, MISSING)
+            for part, list_index in parts:
+                value_type = type(value)
+                if value_type is dict:
+                    value = value.get(part, MISSING)
+                elif value_type is list and list_index is not None and list_index < len(value):
+                    value = value[list_index]
+                else:
+                    value = MISSING
+                    break
+            if value is not MISSING and type(value) is not list and type(value) is not dict:
+                row[index] = value
+        return row
+
+def flatten_sample_runs(db: Session, samples_query: Query, run_to_dict: Callable) -> Dict[int, dict]:
+    """Flattened data of the runs of the samples in `samples_query`, by run
+    id, loading the runs a batch at a time.
+    """
+    sample_run_version = aliased(RunVersion)
+    run_ids = [
+        run_id
+        for run_id,
+        in samples_query\
+            .join(sample_run_version, sample_run_version.id == Sample.run_version_id)\
+            .with_entities(sample_run_version.run_id)\
+            .distinct()
+    ]
+
+    flattened_runs = {}
+    for start in range(0, len(run_ids), RUN_BATCH_SIZE):
+        runs = db.query(Run)\
+            .options(*run_load_options())\
+            .filter(Run.id.in_(run_ids[start:start + RUN_BATCH_SIZE]))\
+            .all()
+        load_audit_users(db, run_audit_rows(runs))
+        for run in runs:
+            flattened_runs[run.id] = flattened_run_cache.flatten(run.version_id, run_to_dict(run))
+    return flattened_runs
+
+def json_type(value) -> str:
+    """Type of a flattened value, as named by jsonb_typeof (though integers
+    from Python are told apart from other numbers).
+    """
+    if value is None:
+        return 'null'
+    if isinstance(value, bool):
+        return 'boolean'
+    if isinstance(value, int):
+        return 'integer'
+    if isinstance(value, float):
+        return 'number'
+    if isinstance(value, datetime.datetime):
+        return 'timestamp'
+    return 'string'
+
+def sample_data_types(db: Session, samples_query: Query) -> Dict[str, Set[str]]:
+    """Flattened columns of the data of the samples in `samples_query`, and
+    the types (see json_type) of their values.
+
+    Top level fields are listed by the database, which only sends back the
+    distinct lists and dicts found (e.g. a run's signers) to be flattened here.
+    """
+    documents = samples_query\
+        .outerjoin(SampleVersion, SampleVersion.id == Sample.version_id)\
+        .with_entities(SampleVersion.data.label('data'))\
+        .subquery('documents')
+    field = func.jsonb_each(documents.c.data).alias('field')
+    key = literal_column('field.key')
+    value = literal_column('field.value')
+    value_type = func.jsonb_typeof(value)
+    nested = type_coerce(case([(value_type.in_(['object', 'array']), value)]), JSONB)
+
+    types = {}
+    for field_key, field_type, field_value in db.query(key, value_type, nested).select_from(documents, field).distinct():
+        if field_value is None:
+            types.setdefault(field_key, set()).add(field_type)
+        else:
+            for column, column_value in flatten_list_or_dict(field_value, current_path=field_key).items():
+                types.setdefault(column, set()).add(json_type(column_value))
+    return types
+
+def sample_data_columns(db: Session, samples_query: Query) -> Set[str]:
+    """Flattened columns of the data of the samples in `samples_query`."""
+    return set(sample_data_types(db, samples_query))
+
+def sample_export_chunks(db: Session, samples_query: Query, chunk_size: Optional[int] = None) -> Iterable[List[tuple]]:
+    """Yield the (sample_id, plate_id, run_id, protocol_id, data) of the
+    samples in `samples_query`, in chunks of up to `chunk_size`.
+
+    pg8000 reads whole result sets into memory, so instead of a server side
+    cursor this pages through the samples by primary key.
+    """
+    chunk_size = chunk_size or settings.export_chunk_size
+    sample_run_version = aliased(RunVersion)
+    sample_protocol_version = aliased(ProtocolVersion)
+    key_columns = (Sample.sample_id, Sample.plate_id, Sample.run_version_id, Sample.protocol_version_id)
+    rows_query = samples_query\
+        .outerjoin(SampleVersion, SampleVersion.id == Sample.version_id)\
+        .outerjoin(sample_run_version, sample_run_version.id == Sample.run_version_id)\
+        .outerjoin(sample_protocol_version, sample_protocol_version.id == Sample.protocol_version_id)\
+        .with_entities(*key_columns, sample_run_version.run_id, sample_protocol_version.protocol_id, SampleVersion.data)\
+        .order_by(*key_columns)
+
+    last_key = None
+    while True:
+        chunk_query = rows_query
+        if last_key is not None:
+            chunk_query = chunk_query.filter(tuple_(*key_columns) > tuple_(*last_key))
+        rows = chunk_query.limit(chunk_size).all()
+        if rows:
+            yield [(sample_id, plate_id, run_id, protocol_id, data) for sample_id, plate_id, _, _, run_id, protocol_id, data in rows]
+        if len(rows) < chunk_size:
+            return
+        last_key = tuple(rows[-1][:4])
+
+def export_sample(sample_id, plate_id, run_id, protocol_id, data) -> dict:
+    """The sample as run_to_sample would return it."""
+    sample = dict(data) if data else {}
+    if sample_id:
+        sample['sampleID'] = sample_id
+    if plate_id:
+        sample['plateID'] = plate_id
+    if run_id:
+        sample['runID'] = run_id
+    if protocol_id:
+        sample['protocolID'] = protocol_id
+    return sample
+
+def samples_csv(chunks: Iterable[List[tuple]], plan: ColumnPlan, flattened_runs: Dict[int, dict]) -> Iterable[str]:
+    """Write samples out as CSV, yielding a chunk of rows at a time."""
+    csvfile = io.StringIO()
+    writer = csv.writer(csvfile, quoting=csv.QUOTE_NONNUMERIC)
+    writer.writerow(plan.columns)
+    run_rows = {run_id: plan.run_row(flattened_run) for run_id, flattened_run in flattened_runs.items()}
+    empty_row = plan.run_row({})
+    for chunk in chunks:
+        writer.writerows(plan.row(export_sample(*row), run_rows.get(row[2], empty_row)) for row in chunk)
+        yield csvfile.getvalue()
+        csvfile.seek(0)
+        csvfile.truncate(0)
+    remaining = csvfile.getvalue()
+    if remaining:
+        yield remaining
+
+def samples_export_types(db: Session, samples_query: Query, flattened_runs: Dict[int, dict]) -> Tuple[Dict[str, Set[str]], Set[str]]:
+    """Columns of an export of the samples in `samples_query` with the types
+    of their values, and those of them samples have.
+    """
+    types = sample_data_types(db, samples_query)
+    for column in SAMPLE_ID_COLUMNS:
+        types.setdefault(column, set())
+    sample_columns = set(types)
+    for flattened_run in flattened_runs.values():
+        for column, value in flattened_run.items():
+            types.setdefault(column, set()).add(json_type(value))
+    return types, sample_columns
+
+def samples_csv_response(db: Session, samples_query: Query, flattened_runs: Dict[int, dict]) -> StreamingResponse:
+    """Stream the samples in `samples_query`, each prefixed with the
+    flattened data of its run (from `flattened_runs`), as CSV.
+    """
+    types, sample_columns = samples_export_types(db, samples_query, flattened_runs)
+    return StreamingResponse(
+        samples_csv(sample_export_chunks(db, samples_query), ColumnPlan(sorted(types), sample_columns), flattened_runs),
+        media_type=EXPORT_MEDIA_TYPES['csv'],
+    )
+
+
+# Columnar Exports ------------------------------------------------------------
+
+# Columns always exported as integers, whatever their values look like.
+INTEGER_COLUMNS = {
+    'plateRow': 'int32',
+    'plateCol': 'int32',
+    'plateIndex': 'int32',
+    'runID': 'int64',
+    'protocolID': 'int64',
+}
+
+def to_integer(value) -> Optional[int]:
+    if value is None or isinstance(value, bool):
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def to_number(value) -> Optional[float]:
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return value
+    return None
+
+def to_boolean(value) -> Optional[bool]:
+    return value if isinstance(value, bool) else None
+
+def to_timestamp(value) -> Optional[datetime.datetime]:
+    return value if isinstance(value, datetime.datetime) else None
+
+def to_string(value) -> Optional[str]:
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, (bool, int, float)):
+        return json.dumps(value)
+    return str(value)
+
+def arrow_column(column: str, types: Set[str]) -> Tuple['pyarrow.DataType', Callable]:
+    """Arrow type of an exported column, and the function converting its
+    values to it. Columns mixing types are exported as strings.
+    """
+    if column in INTEGER_COLUMNS:
+        return getattr(pyarrow, INTEGER_COLUMNS[column])(), to_integer
+    types = types - {'null'}
+    if types == {'integer'}:
+        return pyarrow.int64(), to_integer
+    if types and types <= {'integer', 'number'}:
+        return pyarrow.float64(), to_number
+    if types == {'boolean'}:
+        return pyarrow.bool_(), to_boolean
+    if types == {'timestamp'}:
+        return pyarrow.timestamp('us'), to_timestamp
+    return pyarrow.string(), to_string
+
+class ExportSink:
+    """Write-only file holding what was written to it until taken.
+
+    Arrow's writers note the offsets of what they write (e.g. Parquet's row
+    groups), so the position keeps counting after each take.
+    """
+
+    def __init__(self):
+        self.buffers = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self.buffers.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def writable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return False
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self) -> bytes:
+        data = b''.join(self.buffers)
+        self.buffers = []
+        return data
+
+def samples_columnar(chunks: Iterable[List[tuple]], types: Dict[str, Set[str]], sample_columns: Set[str], flattened_runs: Dict[int, dict], export_format: ExportFormat) -> Iterable[bytes]:
+    """Write samples out as an Arrow IPC file or Parquet, yielding a record
+    batch (Parquet row group) per chunk.
+    """
+    columns = sorted(types)
+    plan = ColumnPlan(columns, sample_columns)
+    conversions = [arrow_column(column, types[column]) for column in columns]
+    schema = pyarrow.schema([(column, arrow_type) for column, (arrow_type, _) in zip(columns, conversions)])
+    run_rows = {run_id: plan.run_row(flattened_run, None) for run_id, flattened_run in flattened_runs.items()}
+    empty_row = plan.run_row({}, None)
+
+    sink = ExportSink()
+    if export_format == 'parquet':
+        writer = pyarrow.parquet.ParquetWriter(sink, schema)
+    else:
+        writer = pyarrow.ipc.new_file(sink, schema)
+    for chunk in chunks:
+        rows = [plan.row(export_sample(*row), run_rows.get(row[2], empty_row)) for row in chunk]
+        batch = pyarrow.RecordBatch.from_arrays(
+            [
+                pyarrow.array([convert(value) for value in values], type=arrow_type)
+                for values, (arrow_type, convert) in zip(zip(*rows), conversions)
+            ],
+            schema=schema,
+        )
+        if export_format == 'parquet':
+            writer.write_table(pyarrow.Table.from_batches([batch]))
+        else:
+            writer.write_batch(batch)
+        yield sink.take()
+    writer.close()
+    yield sink.take()
+
+def samples_export_response(db: Session, samples_query: Query, flattened_runs: Dict[int, dict], export_format: ExportFormat) -> StreamingResponse:
+    """Stream the samples in `samples_query`, each prefixed with the
+    flattened data of its run (from `flattened_runs`), as `export_format`.
+    """
+    if export_format == 'csv':
+        return samples_csv_response(db, samples_query, flattened_runs)
+    if pyarrow is None:
+        raise HTTPException(status_code=501, detail=f"The {export_format} export needs pyarrow installed")
+
+    types, sample_columns = samples_export_types(db, samples_query, flattened_runs)
+    return StreamingResponse(
+        samples_columnar(sample_export_chunks(db, samples_query), types, sample_columns, flattened_runs, export_format),
+        media_type=EXPORT_MEDIA_TYPES[export_format],
+    )
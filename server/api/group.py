@@ -9,7 +9,7 @@ from models import Group
 
 
 @app.get('/group', tags=['groups'], response_model=List[Group], response_model_exclude_none=True)
-async def get_groups(enforcer: casbin.Enforcer = Depends(get_enforcer)):
+def get_groups(enforcer: casbin.Enforcer = Depends(get_enforcer)):
     return [
         Group(id=role)
         for role
@@ -4,17 +4,25 @@ from fastapi.responses import JSONResponse
 from sqlalchemy.orm import Session
 
 from authorization import get_all_roles
-from server import app, get_db
+from api.export import flattened_run_cache
+from database import user_display_cache, version_dict_cache
+from server import app, get_db, pool_stats
 from settings import settings
 from models import HealthCheck
 
 
 @app.get('/health', tags=['system'], response_model=HealthCheck, response_model_exclude_none=True)
-async def health_check(db: Session = Depends(get_db)):
+def health_check(db: Session = Depends(get_db)):
     status = {
         'version': settings.server_version,
         'server': True,
-        'database': True
+        'database': True,
+        'caches': {
+            'users': user_display_cache.stats(),
+            'versions': version_dict_cache.stats(),
+            'export_runs': flattened_run_cache.stats(),
+        },
+        'pools': pool_stats(),
     }
 
     try:
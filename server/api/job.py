@@ -0,0 +1,38 @@
+from typing import Optional
+
+import casbin
+from fastapi import Depends, HTTPException
+from sqlalchemy.orm import Session
+
+from authorization import check_access, get_enforcer
+from database import row_to_dict, Job
+from jobs import wait_for_job
+from models import JobModel
+from server import app, get_db, get_current_user, Auth0ClaimsPatched
+
+
+def job_to_dict(job: Job) -> dict:
+    job_dict = row_to_dict(job)
+    job_dict.pop('payload', None)
+    job_dict.pop('is_deleted', None)
+    return job_dict
+
+
+@app.get('/job/{job_id}', tags=['jobs'], response_model=JobModel, response_model_exclude_none=True)
+def get_job(job_id: int, wait: bool = False, timeout: Optional[float] = None, enforcer: casbin.Enforcer = Depends(get_enforcer), db: Session = Depends(get_db), current_user: Auth0ClaimsPatched = Depends(get_current_user)):
+    job = db.query(Job).get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail='Job Not Found')
+    # Jobs are visible to whoever can read their run, or to their creator.
+    if job.run_id is not None:
+        allowed = check_access(enforcer, user=current_user.username, path=f"/run/{str(job.run_id)}", method="GET")
+    else:
+        allowed = job.created_by == current_user.username
+    if not allowed:
+        raise HTTPException(status_code=403, detail='Insufficient Permissions')
+
+    # Read your writes: wait for the job to finish before answering.
+    if wait:
+        wait_for_job(db, job_id, timeout)
+        db.refresh(job)
+    return job_to_dict(job)
@@ -0,0 +1,38 @@
+from fastapi.responses import PlainTextResponse
+
+from api.export import flattened_run_cache
+from database import user_display_cache, version_dict_cache
+from metrics import registry, CallbackMetric
+from server import app, pool_stats
+
+
+def cache_stat(field: str):
+    def collect():
+        caches = {
+            'users': user_display_cache.stats(),
+            'versions': version_dict_cache.stats(),
+            'export_runs': flattened_run_cache.stats(),
+        }
+        return {(name,): stats[field] for name, stats in caches.items() if field in stats}
+    return collect
+
+def pool_stat(field: str):
+    def collect():
+        return {(name,): stats[field] for name, stats in pool_stats().items()}
+    return collect
+
+registry.register(CallbackMetric('counter', 'flow_cache_hits_total', 'Cache lookups answered from the cache.', ('cache',), cache_stat('hits')))
+registry.register(CallbackMetric('counter', 'flow_cache_misses_total', 'Cache lookups that had to load from the database.', ('cache',), cache_stat('misses')))
+registry.register(CallbackMetric('gauge', 'flow_cache_entries', 'Entries held by each cache.', ('cache',), cache_stat('entries')))
+registry.register(CallbackMetric('gauge', 'flow_cache_bytes', 'Size of the entries held by each (size bounded) cache.', ('cache',), cache_stat('bytes')))
+registry.register(CallbackMetric('gauge', 'flow_db_pool_checked_out', 'Connections checked out of each pool.', ('pool',), pool_stat('checked_out')))
+registry.register(CallbackMetric('gauge', 'flow_db_pool_idle', 'Idle connections in each pool.', ('pool',), pool_stat('idle')))
+registry.register(CallbackMetric('gauge', 'flow_db_pool_overflow', 'Connections open beyond each pool\'s size.', ('pool',), pool_stat('overflow')))
+registry.register(CallbackMetric('counter', 'flow_db_pool_checkouts_total', 'Connection checkouts from each pool.', ('pool',), pool_stat('checkouts')))
+registry.register(CallbackMetric('counter', 'flow_db_pool_timeouts_total', 'Checkouts that timed out waiting for a connection.', ('pool',), pool_stat('timeouts')))
+registry.register(CallbackMetric('counter', 'flow_db_pool_wait_seconds_total', 'Time checkouts spent waiting for a connection.', ('pool',), lambda: {labels: value / 1000 for labels, value in pool_stat('wait_ms_total')().items()}))
+
+
+@app.get('/metrics', tags=['system'], response_class=PlainTextResponse)
+def get_metrics():
+    return PlainTextResponse(registry.render(), media_type='text/plain; version=0.0.4')
@@ -1,7 +1,7 @@
 from typing import List, Optional
 import casbin
 
-from fastapi import Depends, HTTPException
+from fastapi import Depends, HTTPException, Request, Response
 from server import Auth0ClaimsPatched
 from sqlalchemy.orm import Session
 
@@ -13,12 +13,17 @@ from authorization import check_access, add_policy, delete_policy, get_enforcer,
 from database import versioned_row_to_dict, strip_metadata, Protocol, ProtocolVersion
 from models import Policy, ProtocolModel, ProtocolsModel, SuccessResponse, success
 
-from api.utils import change_allowed, add_owner, add_updator
-from crud.protocol import crud_get_protocols, crud_get_protocol
+from api.export import flatten_sample_runs, samples_export_response, ExportFormat
+from api.run import run_to_dict
+from api.utils import change_allowed, add_owner, add_updator, conditional_response, parse_fields
+from crud.protocol import crud_get_protocols, crud_get_protocols_etag, crud_get_protocol, crud_get_protocol_etag
+from crud.sample import authorized_samples
 
 
 @app.get('/protocol', tags=['protocols'], response_model=ProtocolsModel, response_model_exclude_none=True)
-async def get_protocols(
+def get_protocols(
+    request: Request,
+    response: Response,
     run: Optional[int] = None,
     plate: Optional[str] = None,
     reagent: Optional[str] = None,
@@ -27,12 +32,31 @@ async def get_protocols(
     archived: Optional[bool] = None,
     page: Optional[int] = None,
     per_page: Optional[int] = None,
+    after: Optional[str] = None,
+    fields: Optional[str] = None,
     enforcer: casbin.Enforcer = Depends(get_enforcer),
     db: Session = Depends(get_db),
     current_user: Auth0ClaimsPatched = Depends(get_current_user)
 ):
+    fields = parse_fields(fields)
+    etag = crud_get_protocols_etag(
+        enforcer=enforcer,
+        db=db,
+        current_user=current_user,
+
+        run=run,
+        plate=plate,
+        reagent=reagent,
+        sample=sample,
+        creator=creator,
+        archived=archived,
+    )
+    not_modified = conditional_response(request, response, etag)
+    if not_modified:
+        return not_modified
+
     return crud_get_protocols(
-        item_to_dict=lambda protocol: versioned_row_to_dict(protocol, protocol.current, include_large_fields=False),
+        item_to_dict=lambda protocol: versioned_row_to_dict(protocol, protocol.current, include_large_fields=False, fields=fields),
 
         enforcer=enforcer,
         db=db,
@@ -46,10 +70,12 @@ async def get_protocols(
         archived=archived,
         page=page,
         per_page=per_page,
+        after=after,
+        fields=fields,
     )
 
 @app.post('/protocol', tags=['protocols'], response_model=ProtocolModel, response_model_exclude_none=True)
-async def create_protocol(protocol: ProtocolModel, enforcer: casbin.Enforcer = Depends(get_enforcer), db: Session = Depends(get_db), current_user: Auth0ClaimsPatched = Depends(get_current_user)):
+def create_protocol(protocol: ProtocolModel, enforcer: casbin.Enforcer = Depends(get_enforcer), db: Session = Depends(get_db), current_user: Auth0ClaimsPatched = Depends(get_current_user)):
     protocol_dict = protocol.dict()
     protocol = Protocol()
     protocol_version = ProtocolVersion(data=strip_metadata(protocol_dict), server_version=settings.server_version)
@@ -64,9 +90,16 @@ async def create_protocol(protocol: ProtocolModel, enforcer: casbin.Enforcer = D
     return versioned_row_to_dict(protocol, protocol_version)
 
 @app.get('/protocol/{protocol_id}', tags=['protocols'], response_model=ProtocolModel, response_model_exclude_none=True)
-async def get_protocol(protocol_id: int, version_id: Optional[int] = None, enforcer: casbin.Enforcer = Depends(get_enforcer), db: Session = Depends(get_db), current_user: Auth0ClaimsPatched = Depends(get_current_user)):
+def get_protocol(protocol_id: int, request: Request, response: Response, version_id: Optional[int] = None, fields: Optional[str] = None, enforcer: casbin.Enforcer = Depends(get_enforcer), db: Session = Depends(get_db), current_user: Auth0ClaimsPatched = Depends(get_current_user)):
+    # Older versions are still answered with the current one, see crud_get_protocol.
+    fields = parse_fields(fields)
+    etag = crud_get_protocol_etag(enforcer=enforcer, db=db, current_user=current_user, protocol_id=protocol_id)
+    not_modified = conditional_response(request, response, etag)
+    if not_modified:
+        return not_modified
+
     return crud_get_protocol(
-        item_to_dict=lambda protocol: versioned_row_to_dict(protocol, protocol.current),
+        item_to_dict=lambda protocol: versioned_row_to_dict(protocol, protocol.current, fields=fields),
 
         enforcer=enforcer,
         db=db,
@@ -74,10 +107,47 @@ async def get_protocol(protocol_id: int, version_id: Optional[int] = None, enfor
 
         protocol_id=protocol_id,
         version_id=version_id,
+        fields=fields,
+    )
+
+@app.get('/protocol/{protocol_id}/sample.{export_format}', tags=['protocols'], response_model_exclude_none=True)
+def export_protocol_samples(
+    protocol_id: int,
+    export_format: ExportFormat,
+    run: Optional[int] = None,
+    plate: Optional[str] = None,
+    reagent: Optional[str] = None,
+    sample: Optional[str] = None,
+    creator: Optional[str] = None,
+    archived: Optional[bool] = None,
+    enforcer: casbin.Enforcer = Depends(get_enforcer),
+    db: Session = Depends(get_db),
+    current_user: Auth0ClaimsPatched = Depends(get_current_user)
+):
+    if not check_access(enforcer, user=current_user.username, path=f"/protocol/{str(protocol_id)}", method="GET"):
+        raise HTTPException(status_code=403, detail='Insufficient Permissions')
+    protocol = db.query(Protocol).get(protocol_id)
+    if not protocol or protocol.is_deleted:
+        raise HTTPException(status_code=404, detail='Protocol Not Found')
+
+    samples_query = authorized_samples(
+        enforcer=enforcer,
+        db=db,
+        current_user=current_user,
+
+        protocol=protocol_id,
+        run=run,
+        plate=plate,
+        reagent=reagent,
+        sample=sample,
+        creator=creator,
+        archived=archived,
     )
+    flattened_runs = flatten_sample_runs(db, samples_query, lambda run: run_to_dict(run, run.current, False))
+    return samples_export_response(db, samples_query, flattened_runs, export_format)
 
 @app.put('/protocol/{protocol_id}', tags=['protocols'], response_model=ProtocolModel, response_model_exclude_none=True)
-async def update_protocol(protocol_id: int, protocol: ProtocolModel, enforcer: casbin.Enforcer = Depends(get_enforcer), db: Session = Depends(get_db), current_user: Auth0ClaimsPatched = Depends(get_current_user)):
+def update_protocol(protocol_id: int, protocol: ProtocolModel, enforcer: casbin.Enforcer = Depends(get_enforcer), db: Session = Depends(get_db), current_user: Auth0ClaimsPatched = Depends(get_current_user)):
     if not check_access(enforcer, user=current_user.username, path=f"/protocol/{str(protocol_id)}", method="PUT"):
         raise HTTPException(status_code=403, detail='Insufficient Permissions')
 
@@ -96,7 +166,7 @@ async def update_protocol(protocol_id: int, protocol: ProtocolModel, enforcer: c
     return versioned_row_to_dict(new_protocol, new_protocol.current)
 
 @app.patch('/protocol/{protocol_id}', tags=['protocols'], response_model=ProtocolModel, response_model_exclude_none=True)
-async def patch_protocol(protocol_id: int, patch: list, enforcer: casbin.Enforcer = Depends(get_enforcer), db: Session = Depends(get_db), current_user: Auth0ClaimsPatched = Depends(get_current_user)):
+def patch_protocol(protocol_id: int, patch: list, enforcer: casbin.Enforcer = Depends(get_enforcer), db: Session = Depends(get_db), current_user: Auth0ClaimsPatched = Depends(get_current_user)):
     if not check_access(enforcer, user=current_user.username, path=f"/protocol/{str(protocol_id)}", method="PUT"):
         raise HTTPException(status_code=403, detail='Insufficient Permissions')
 
@@ -120,7 +190,7 @@ async def patch_protocol(protocol_id: int, patch: list, enforcer: casbin.Enforce
     return versioned_row_to_dict(new_protocol, new_protocol.current)
 
 @app.delete('/protocol/{protocol_id}', tags=['protocols'], response_model=SuccessResponse, response_model_exclude_none=True)
-async def delete_protocol(protocol_id: int, purge: bool = False, enforcer: casbin.Enforcer = Depends(get_enforcer), db: Session = Depends(get_db), current_user: Auth0ClaimsPatched = Depends(get_current_user)):
+def delete_protocol(protocol_id: int, purge: bool = False, enforcer: casbin.Enforcer = Depends(get_enforcer), db: Session = Depends(get_db), current_user: Auth0ClaimsPatched = Depends(get_current_user)):
     if not check_access(enforcer, user=current_user.username, path=f"/protocol/{str(protocol_id)}", method="DELETE"):
         raise HTTPException(status_code=403, detail='Insufficient Permissions')
 
@@ -139,14 +209,14 @@ async def delete_protocol(protocol_id: int, purge: bool = False, enforcer: casbi
 # Permissions -----------------------------------------------------------------
 
 @app.get('/protocol/{protocol_id}/permission', tags=['protocols'], response_model=List[Policy], response_model_exclude_none=True)
-async def get_permissions(protocol_id: int, enforcer: casbin.Enforcer = Depends(get_enforcer), current_user: Auth0ClaimsPatched = Depends(get_current_user)):
+def get_permissions(protocol_id: int, enforcer: casbin.Enforcer = Depends(get_enforcer), current_user: Auth0ClaimsPatched = Depends(get_current_user)):
     if not check_access(enforcer, user=current_user.username, path=f"/protocol/{str(protocol_id)}", method="GET"):
         raise HTTPException(status_code=403, detail='Insufficient Permissions')
 
     return get_policies(enforcer, path=f"/protocol/{protocol_id}")
 
 @app.post('/protocol/{protocol_id}/permission/{method}/{user_id}', tags=['protocols'], response_model=Policy, response_model_exclude_none=True)
-async def create_permission(protocol_id: int, method: str, user_id: str, enforcer: casbin.Enforcer = Depends(get_enforcer), current_user: Auth0ClaimsPatched = Depends(get_current_user)):
+def create_permission(protocol_id: int, method: str, user_id: str, enforcer: casbin.Enforcer = Depends(get_enforcer), current_user: Auth0ClaimsPatched = Depends(get_current_user)):
     if not check_access(enforcer, user=current_user.username, path=f"/protocol/{str(protocol_id)}", method="PUT"):
         raise HTTPException(status_code=403, detail='Insufficient Permissions')
 
@@ -154,7 +224,7 @@ async def create_permission(protocol_id: int, method: str, user_id: str, enforce
     return success
 
 @app.delete('/protocol/{protocol_id}/permission/{method}/{user_id}', tags=['protocols'], response_model=SuccessResponse, response_model_exclude_none=True)
-async def delete_permission(protocol_id: int, method: str, user_id: str, enforcer: casbin.Enforcer = Depends(get_enforcer), current_user: Auth0ClaimsPatched = Depends(get_current_user)):
+def delete_permission(protocol_id: int, method: str, user_id: str, enforcer: casbin.Enforcer = Depends(get_enforcer), current_user: Auth0ClaimsPatched = Depends(get_current_user)):
     if not check_access(enforcer, user=current_user.username, path=f"/protocol/{str(protocol_id)}", method="PUT"):
         raise HTTPException(status_code=403, detail='Insufficient Permissions')
 
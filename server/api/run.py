@@ -1,4 +1,4 @@
-import csv
+import copy
 import io
 import casbin
 import jsonpatch
@@ -9,32 +9,38 @@ import logging
 from functools import reduce, wraps
 from typing import List, Optional, Any, Tuple, Union
 
-from fastapi import Depends, HTTPException, File, UploadFile, Request, Response
+from fastapi import Depends, HTTPException, File, Query, UploadFile, Request, Response
 from fastapi.responses import StreamingResponse
-from fastapi_utils.timing import add_timing_middleware, record_timing
 from server import Auth0ClaimsPatched
+from sqlalchemy import text, tuple_
 from sqlalchemy.orm import Session
-from sqlalchemy.orm.session import make_transient
 
 from server import app, get_db, get_current_user
 from settings import settings
 from authorization import check_access, add_policy, delete_policy, get_enforcer, get_policies, get_roles
-from database import filter_by_plate_label, filter_by_reagent_label, filter_by_sample_label, versioned_row_to_dict, json_row_to_dict, strip_metadata, Run, RunVersion, Protocol, run_to_sample, Sample, SampleVersion, Attachment
+from database import filter_by_plate_label, filter_by_reagent_label, filter_by_sample_label, json_recordset, run_samples_filter, versioned_row_to_dict, json_row_to_dict, strip_metadata, Run, RunVersion, Protocol, run_to_sample, Sample, SampleVersion, Attachment, Job
 from models import AttachmentModel, SampleResult, SampleResults, Policy, RunModel, RunsModel, SuccessResponse, success
 from pydantic_jsonpatch.jsonpatch import JSONPatch
 from pydantic import BaseModel
 
-from api.utils import change_allowed, add_owner, add_updator, paginatify
+from jobs import enqueue_job, has_unfinished_jobs, job_failure_handler, job_handler, wait_for_job
+from metrics import sample_regenerations
+from server_timing import phase
+from api.utils import change_allowed, add_owner, add_updator, conditional_response, paginatify, parse_fields
 
-from crud.run import crud_get_runs, crud_get_run, crud_get_run_samples, crud_get_run_sample
+from api.export import flattened_run_cache, samples_export_response, ExportFormat
+from crud.run import crud_get_runs, crud_get_runs_etag, crud_get_run, crud_get_run_etag, crud_get_run_samples, crud_get_run_sample, filter_run_samples
 
 
 logger = logging.getLogger(__name__)
 
 
-def run_to_dict(run, run_version, include_large_fields=True):
-    run_dict = versioned_row_to_dict(run, run_version, include_large_fields)
-    run_dict['protocol'] = versioned_row_to_dict(run.protocol_version.protocol, run.protocol_version, include_large_fields)
+def run_to_dict(run, run_version, include_large_fields=True, fields=None):
+    run_dict = versioned_row_to_dict(run, run_version, include_large_fields, fields)
+    if fields is None or 'protocol' in fields:
+        run_dict['protocol'] = versioned_row_to_dict(run.protocol_version.protocol, run.protocol_version, include_large_fields)
+    if run_version.samples_error and (fields is None or 'samples_error' in fields):
+        run_dict['samples_error'] = run_version.samples_error
     return run_dict
 
 
@@ -46,8 +52,138 @@ def extract_protocol_id(run_dict):
     return None
 
 
-def get_samples(run_version, protocol_version):
+# JSON patch paths that can change a run's samples.
+SAMPLE_PATH_PATTERNS = [
+    # /sections/*/blocks/*/plates
+    re.compile("^/(sections/([^/]+/(blocks/([^/]+/(plates(/.*)?)?)?)?)?)?$"),
+    # /sections/*/blocks/*/plateSequencingResults
+    re.compile("^/(sections/([^/]+/(blocks/([^/]+/(plateSequencingResults(/.*)?)?)?)?)?)?$"),
+    # /protocol/sections/*/blocks/*/plateMarkers
+    re.compile("^/(protocol/(sections/([^/]+/(blocks/([^/]+/(plateMarkers(/.*)?)?)?)?)?)?)?$"),
+]
+
+def is_sample_path(path: str) -> bool:
+    return any(pattern.search(path) for pattern in SAMPLE_PATH_PATTERNS)
+
+# JSON patch paths of fields copied into every sample (signers, witnesses and
+# plateLots), so changing them changes all of a run's samples.
+ALL_SAMPLES_PATH_PATTERNS = [
+    # The whole run
+    re.compile("^$"),
+    # /sections/*/signature, /sections/*/witness
+    re.compile("^/sections/[^/]+/(signature|witness)(/.*)?$"),
+    # /sections/*/blocks/*/plateLot
+    re.compile("^/sections/[^/]+/blocks/[^/]+/plateLot(/.*)?$"),
+]
+
+def is_all_samples_path(path: str) -> bool:
+    return any(pattern.search(path) for pattern in ALL_SAMPLES_PATH_PATTERNS)
+
+
+class SampleScope:
+    """The samples of a run that a JSON patch can affect.
+
+    Samples are matched by their (sample_id, plate_id) key, or by the marker
+    pair linking their well to a sequencing result.
+    """
+    def __init__(self):
+        self.keys = set()
+        self.marker_pairs = set()
+
+    def __bool__(self):
+        return bool(self.keys or self.marker_pairs)
+
+    def to_payload(self) -> dict:
+        # Plates without a label have a None plate_id.
+        return {
+            'keys': sorted(self.keys, key=lambda key: (key[0], key[1] or '')),
+            'marker_pairs': sorted(self.marker_pairs),
+        }
+
+    @classmethod
+    def from_payload(cls, payload: dict) -> 'SampleScope':
+        scope = cls()
+        scope.keys = {tuple(key) for key in payload['keys']}
+        scope.marker_pairs = set(payload['marker_pairs'])
+        return scope
+
+    def add_coordinate(self, plate, coordinate):
+        if isinstance(plate, dict) and isinstance(coordinate, dict) and 'sampleLabel' in coordinate:
+            self.keys.add((f"{coordinate['sampleLabel']}", plate.get('label')))
+
+    def add_plate(self, plate):
+        if isinstance(plate, dict):
+            for coordinate in plate.get('coordinates') or []:
+                self.add_coordinate(plate, coordinate)
+
+    def add_result(self, result):
+        if isinstance(result, dict):
+            self.marker_pairs.add(f"{result.get('marker1')}-{result.get('marker2')}")
+
+    def includes(self, sample_id: str, plate_id: str, marker: Optional[dict]) -> bool:
+        if (sample_id, plate_id) in self.keys:
+            return True
+        return marker is not None and f"{marker['marker1']}-{marker['marker2']}" in self.marker_pairs
+
+
+def json_pointer_get(document, parts: List[str]):
+    for part in parts:
+        if isinstance(document, list):
+            if part == '-':
+                part = len(document) - 1
+            try:
+                document = document[int(part)]
+            except (ValueError, IndexError):
+                return None
+        elif isinstance(document, dict):
+            document = document.get(part)
+        else:
+            return None
+    return document
+
+def sample_patch_scope(patch: list, run_dict: dict) -> Optional[SampleScope]:
+    """Work out which samples applying `patch` to `run_dict` can change.
+
+    Each operation touching a plate, well or sequencing result adds the
+    entries at its path, both before and after it is applied. Returns None
+    when the samples have to be regenerated from scratch, e.g. when a whole
+    block or the protocol's plate markers are replaced, or a signature,
+    witness or plate lot (which every sample has) changes.
+    """
+    scope = SampleScope()
+    document = copy.deepcopy(run_dict)
+    for operation in patch:
+        if any(path is not None and is_all_samples_path(path) for path in (operation.get('path', ''), operation.get('from'))):
+            return None
+        paths = [path for path in (operation.get('path', ''), operation.get('from')) if path is not None and is_sample_path(path)]
+        parts = [
+            [part.replace('~1', '/').replace('~0', '~') for part in path.split('/')[1:]]
+            for path in paths
+        ]
+        for path_parts in parts:
+            # Only /sections/*/blocks/*/(plates|plateSequencingResults)/*/...
+            if len(path_parts) < 6 or path_parts[0] != 'sections':
+                return None
+
+        def add_entries():
+            for path_parts in parts:
+                entry = json_pointer_get(document, path_parts[:6])
+                if path_parts[4] == 'plateSequencingResults':
+                    scope.add_result(entry)
+                elif len(path_parts) >= 8 and path_parts[6] == 'coordinates':
+                    scope.add_coordinate(entry, json_pointer_get(entry, path_parts[6:8]))
+                else:
+                    scope.add_plate(entry)
+
+        add_entries()
+        document = jsonpatch.apply_patch(document, [operation], in_place=True)
+        add_entries()
+    return scope
+
+def get_samples(run_version, protocol_version, scope: Optional[SampleScope] = None):
+    """Build the samples of a run version, only those in `scope` if given."""
     sample_ids = set()
+    plate_samples = []
     samples = []
     markers = {}
     results = {}
@@ -82,23 +218,7 @@ def get_samples(run_version, protocol_version):
                                 logger.warn(f"Skipping duplicate sample: {json.dumps(plate_sample)}")
                                 continue
                             sample_ids.add(f"{plate_id}-{plate_sample['sampleLabel']}")
-                            sample = Sample(
-                                sample_id=f"{plate_sample['sampleLabel']}",
-                                plate_id=plate_id,
-                            )
-                            sample_version = SampleVersion(
-                                data={
-                                    'plateRow': plate_sample['row'],
-                                    'plateCol': plate_sample['col'],
-                                    'plateIndex': plate_sample['plateIndex'],
-                                },
-                                sample=sample,
-                                server_version=settings.server_version,
-                            )
-                            sample.run_version = run_version
-                            sample.protocol_version_id = run_version.run.protocol_version_id
-                            sample.current = sample_version
-                            samples.append(sample)
+                            plate_samples.append((plate_id, plate_sample))
             if block['type'] == 'end-plate-sequencer' and 'plateSequencingResults' in block and block['plateSequencingResults'] is not None:
                 for result in block['plateSequencingResults']:
                     results[f"{result['marker1']}-{result['marker2']}"] = result
@@ -112,14 +232,34 @@ def get_samples(run_version, protocol_version):
                     for marker in block['plateMarkers']:
                         markers[f"{marker['plateIndex']}-{marker['plateRow']}-{marker['plateColumn']}"] = marker
 
-    logger.info(f"Found {len(samples)} samples, {len(markers)} markers, {len(results)} results")
+    logger.info(f"Found {len(plate_samples)} samples, {len(markers)} markers, {len(results)} results")
+
+    for plate_id, plate_sample in plate_samples:
+        marker = markers.get(f"{plate_sample['plateIndex']}-{plate_sample['row']}-{plate_sample['col']}", None)
+        if scope is not None and not scope.includes(f"{plate_sample['sampleLabel']}", plate_id, marker):
+            continue
 
-    for sample in samples:
-        sample.current.data['signers'] = signers
-        sample.current.data['witnesses'] = witnesses
-        sample.current.data['plateLots'] = lots
+        sample = Sample(
+            sample_id=f"{plate_sample['sampleLabel']}",
+            plate_id=plate_id,
+        )
+        sample_version = SampleVersion(
+            data={
+                'plateRow': plate_sample['row'],
+                'plateCol': plate_sample['col'],
+                'plateIndex': plate_sample['plateIndex'],
+                'signers': signers,
+                'witnesses': witnesses,
+                'plateLots': lots,
+            },
+            sample=sample,
+            server_version=settings.server_version,
+        )
+        sample.run_version = run_version
+        sample.protocol_version_id = run_version.run.protocol_version_id
+        sample.current = sample_version
+        samples.append(sample)
 
-        marker = markers.get(f"{sample.current.data['plateIndex']}-{sample.current.data['plateRow']}-{sample.current.data['plateCol']}", None)
         if not marker:
             continue
         sample.current.data['marker1'] = marker['marker1']
@@ -135,22 +275,201 @@ def get_samples(run_version, protocol_version):
 
 def all_samples(db: Session, run, include_archived=False):
     query = db.query(Sample)\
-        .filter(Sample.run_version_id == run.version_id)
+        .filter(run_samples_filter(run.version_id))
     if not include_archived:
         query = query\
             .filter(Sample.is_deleted != True)
     return query
 
-def clone_model(db: Session, model, **kwargs):
-    db.expunge(model)
-    make_transient(model)
-    for (field, value) in kwargs.items():
-        setattr(model, field, value)
-    return model
+def samples_changed(db: Session, run_version, samples: List[Sample], keys=None) -> bool:
+    """Whether `samples` (from get_samples) differ from those of `run_version`.
+
+    With `keys`, only the existing samples with those (sample_id, plate_id)
+    keys are compared.
+    """
+    def sample_key(sample_id, plate_id, protocol_version_id, data):
+        return (sample_id, plate_id, protocol_version_id, json.dumps(data, sort_keys=True))
+
+    existing = db.query(Sample.sample_id, Sample.plate_id, Sample.protocol_version_id, SampleVersion.data)\
+        .join(SampleVersion, SampleVersion.id == Sample.version_id)\
+        .filter(Sample.run_version_id == run_version.sample_run_version_id)\
+        .filter(Sample.is_deleted != True)
+    if keys is not None:
+        if not keys:
+            return bool(samples)
+        existing = existing.filter(tuple_(Sample.sample_id, Sample.plate_id).in_(list(keys)))
+    return {sample_key(*row) for row in existing} != {
+        sample_key(sample.sample_id, sample.plate_id, sample.protocol_version_id, sample.current.data)
+        for sample in samples
+    }
+
+def update_samples(db: Session, run_version, previous_run_version, samples: List[Sample], scope: Optional[SampleScope] = None) -> bool:
+    """Share the samples of `previous_run_version` unless they have changed.
+
+    Samples are only written when they differ, so a run's sample table grows
+    with real changes rather than with every saved edit. With a `scope`,
+    `samples` only replace the previous samples it includes and the rest are
+    carried over. Returns whether new samples were written.
+    """
+    keys = None
+    if scope is not None:
+        keys = scope.keys | {(sample.sample_id, sample.plate_id) for sample in samples}
+    if previous_run_version and not samples_changed(db, previous_run_version, samples, keys):
+        run_version.sample_set_id = previous_run_version.sample_run_version_id
+        return False
+    run_version.sample_set_id = None
+    if previous_run_version and keys is not None:
+        copy_samples(db, run_version, previous_run_version, keys)
+    if samples:
+        save_samples(db, samples)
+    return True
+
+def copy_samples(db: Session, run_version, previous_run_version, exclude_keys):
+    """Carry the samples of `previous_run_version` over to `run_version`.
+
+    The copies point at the existing sample versions, so this writes one
+    (small) sample row per sample and no sample data.
+    """
+    # Make sure the run version has an id.
+    db.flush()
+
+    db.execute(
+        text(f"""
+            INSERT INTO sample (sample_id, plate_id, run_version_id, protocol_version_id, version_id, is_deleted, created_by, created_on)
+            SELECT sample_id, plate_id, CAST(:run_version_id AS integer), protocol_version_id, version_id, is_deleted, created_by, created_on
+            FROM sample
+            WHERE run_version_id = :previous_run_version_id
+            AND NOT EXISTS (
+                SELECT 1 FROM {json_recordset([Sample.sample_id, Sample.plate_id])}
+                WHERE rows.sample_id = sample.sample_id AND rows.plate_id = sample.plate_id
+            )
+        """),
+        {
+            'run_version_id': run_version.id,
+            'previous_run_version_id': previous_run_version.sample_run_version_id,
+            'rows': json.dumps([{'sample_id': sample_id, 'plate_id': plate_id} for sample_id, plate_id in exclude_keys]),
+        },
+    )
+
+def enqueue_sample_job(db: Session, run_version, previous_run_version, scope: Optional[SampleScope], created_by: str) -> Job:
+    """Regenerate the samples of a new run version in the background.
+
+    Until the job is done the version shows the previous version's samples.
+    """
+    # Make sure the run version has an id.
+    db.flush()
+
+    if previous_run_version:
+        run_version.sample_set_id = previous_run_version.sample_run_version_id
+    return enqueue_job(
+        db,
+        'run_samples',
+        run_id=run_version.run_id,
+        payload={
+            'run_version_id': run_version.id,
+            'previous_run_version_id': previous_run_version.id if previous_run_version else None,
+            'scope': scope.to_payload() if scope is not None else None,
+        },
+        created_by=created_by,
+    )
+
+WAIT_FOR_SAMPLES = Query(False, description=(
+    "Saves regenerate the run's samples in a background job (its id is in the X-Job-ID header). "
+    "Until it is done the run shows the samples of its previous version, unless this waits for it. "
+    "If the job fails for good, the run's samples_error says why."
+))
+
+def finish_sample_job(db: Session, response: Response, job: Job, wait: bool):
+    """Point the client at a sample job, and wait for it when asked to."""
+    response.headers['X-Job-ID'] = str(job.id)
+    if wait:
+        with phase('samples', 'Waited for sample job'):
+            wait_for_job(db, job.id)
+
+@job_handler('run_samples')
+def run_samples_job(db: Session, job: Job):
+    run_version = db.query(RunVersion).get(job.payload['run_version_id'])
+    if not run_version:
+        return
+    previous_run_version = None
+    if job.payload['previous_run_version_id']:
+        previous_run_version = db.query(RunVersion).get(job.payload['previous_run_version_id'])
+    scope = None
+    if job.payload['scope'] is not None:
+        scope = SampleScope.from_payload(job.payload['scope'])
+    if previous_run_version is not None and previous_run_version.samples_error:
+        # The previous version's samples are stale, so start over.
+        scope = None
+
+    samples = get_samples(run_version, run_version.run.protocol_version, scope)
+    if update_samples(db, run_version, previous_run_version, samples, scope):
+        logger.info(f"Generated {len(samples)} samples for run_version: ({run_version.run_id}, {run_version.id})")
+        sample_regenerations.observe(len(samples), 'full' if scope is None else 'partial')
+    else:
+        logger.info(f"Samples unchanged, sharing them with run_version: ({run_version.run_id}, {run_version.id})")
+        sample_regenerations.observe(0, 'full' if scope is None else 'partial')
+
+@job_failure_handler('run_samples')
+def run_samples_job_failed(db: Session, job: Job):
+    run_version = db.query(RunVersion).get(job.payload['run_version_id'])
+    if run_version:
+        run_version.samples_error = job.error
+
+def save_samples(db: Session, samples: List[Sample]):
+    """Write samples from get_samples (and their current versions) in bulk.
+
+    Instead of a merge (a SELECT, then an INSERT or UPDATE) per sample, this
+    is a single statement: the versions are inserted, then the samples
+    pointing at them are upserted.
+    """
+    # Make sure the run version has an id.
+    db.flush()
+
+    version_columns = [
+        SampleVersion.sample_id,
+        SampleVersion.plate_id,
+        SampleVersion.run_version_id,
+        SampleVersion.protocol_version_id,
+        SampleVersion.data,
+        SampleVersion.server_version,
+        SampleVersion.updated_by,
+    ]
+    rows = [
+        {
+            'sample_id': sample.sample_id,
+            'plate_id': sample.plate_id,
+            'run_version_id': sample.run_version.id,
+            'protocol_version_id': sample.protocol_version_id,
+            'data': sample.current.data,
+            'server_version': sample.current.server_version,
+            'updated_by': sample.current.updated_by,
+        }
+        for sample in samples
+    ]
+    key = 'sample_id, plate_id, run_version_id, protocol_version_id'
+    # The foreign key from sample_version to sample is checked at the end of
+    # the statement, once both inserts are done.
+    db.execute(
+        text(f"""
+            WITH new_versions AS (
+                INSERT INTO sample_version ({key}, data, server_version, updated_by, updated_on)
+                SELECT {key}, data, server_version, updated_by, now()
+                FROM {json_recordset(version_columns)}
+                RETURNING id, {key}
+            )
+            INSERT INTO sample ({key}, version_id, is_deleted, created_on)
+            SELECT {key}, id, false, now() FROM new_versions
+            ON CONFLICT ({key}) DO UPDATE
+            SET version_id = excluded.version_id, is_deleted = excluded.is_deleted
+        """),
+        {'rows': json.dumps(rows)},
+    )
 
 
 @app.get('/run', tags=['runs'], response_model=RunsModel, response_model_exclude_none=True)
-async def get_runs(
+def get_runs(
+    request: Request,
+    response: Response,
     protocol: Optional[int] = None,
     plate: Optional[str] = None,
     reagent: Optional[str] = None,
@@ -159,12 +478,31 @@ async def get_runs(
     archived: Optional[bool] = None,
     page: Optional[int] = None,
     per_page: Optional[int] = None,
+    after: Optional[str] = None,
+    fields: Optional[str] = None,
     enforcer: casbin.Enforcer = Depends(get_enforcer),
     db: Session = Depends(get_db),
     current_user: Auth0ClaimsPatched = Depends(get_current_user)
 ):
+    fields = parse_fields(fields)
+    etag = crud_get_runs_etag(
+        enforcer=enforcer,
+        db=db,
+        current_user=current_user,
+
+        protocol=protocol,
+        plate=plate,
+        reagent=reagent,
+        sample=sample,
+        creator=creator,
+        archived=archived,
+    )
+    not_modified = conditional_response(request, response, etag)
+    if not_modified:
+        return not_modified
+
     return crud_get_runs(
-        item_to_dict=lambda run: run_to_dict(run, run.current, include_large_fields=False),
+        item_to_dict=lambda run: run_to_dict(run, run.current, include_large_fields=False, fields=fields),
 
         enforcer=enforcer,
         db=db,
@@ -179,10 +517,12 @@ async def get_runs(
 
         page=page,
         per_page=per_page,
+        after=after,
+        fields=fields,
     )
 
 @app.post('/run', tags=['runs'], response_model=RunModel, response_model_exclude_none=True)
-async def create_run(run: RunModel, enforcer: casbin.Enforcer = Depends(get_enforcer), db: Session = Depends(get_db), current_user: Auth0ClaimsPatched = Depends(get_current_user)):
+def create_run(run: RunModel, response: Response, wait: bool = WAIT_FOR_SAMPLES, enforcer: casbin.Enforcer = Depends(get_enforcer), db: Session = Depends(get_db), current_user: Auth0ClaimsPatched = Depends(get_current_user)):
     run_dict = run.dict()
     protocol_id = extract_protocol_id(run_dict)
     run_dict.pop('protocol', None)
@@ -198,20 +538,25 @@ async def create_run(run: RunModel, enforcer: casbin.Enforcer = Depends(get_enfo
     new_run.protocol_version_id = protocol.version_id
     add_owner(new_run, current_user.username)
     db.add_all([new_run, new_run_version])
-    samples = get_samples(new_run_version, protocol.current)
-    if samples:
-        for sample in samples:
-            db.merge(sample)
+    job = enqueue_sample_job(db, new_run_version, None, None, created_by=current_user.username)
     db.commit()
     add_policy(enforcer, user=current_user.username, path=f"/run/{str(new_run.id)}", method="GET")
     add_policy(enforcer, user=current_user.username, path=f"/run/{str(new_run.id)}", method="PUT")
     add_policy(enforcer, user=current_user.username, path=f"/run/{str(new_run.id)}", method="DELETE")
+    finish_sample_job(db, response, job, wait)
     return run_to_dict(new_run, new_run_version)
 
 @app.get('/run/{run_id}', tags=['runs'], response_model=RunModel, response_model_exclude_none=True)
-async def get_run(run_id: int, version_id: Optional[int] = None, enforcer: casbin.Enforcer = Depends(get_enforcer), db: Session = Depends(get_db), current_user: Auth0ClaimsPatched = Depends(get_current_user)):
+def get_run(run_id: int, request: Request, response: Response, version_id: Optional[int] = None, fields: Optional[str] = None, enforcer: casbin.Enforcer = Depends(get_enforcer), db: Session = Depends(get_db), current_user: Auth0ClaimsPatched = Depends(get_current_user)):
+    # Older versions are still answered with the current one, see crud_get_run.
+    fields = parse_fields(fields)
+    etag = crud_get_run_etag(enforcer=enforcer, db=db, current_user=current_user, run_id=run_id)
+    not_modified = conditional_response(request, response, etag)
+    if not_modified:
+        return not_modified
+
     return crud_get_run(
-        item_to_dict=lambda run: run_to_dict(run, run.current),
+        item_to_dict=lambda run: run_to_dict(run, run.current, fields=fields),
 
         enforcer=enforcer,
         db=db,
@@ -219,10 +564,11 @@ async def get_run(run_id: int, version_id: Optional[int] = None, enforcer: casbi
 
         run_id=run_id,
         version_id=version_id,
+        fields=fields,
     )
 
 @app.put('/run/{run_id}', tags=['runs'], response_model=RunModel, response_model_exclude_none=True)
-async def update_run(run_id: int, run: RunModel, enforcer: casbin.Enforcer = Depends(get_enforcer), db: Session = Depends(get_db), current_user: Auth0ClaimsPatched = Depends(get_current_user)):
+def update_run(run_id: int, run: RunModel, response: Response, wait: bool = WAIT_FOR_SAMPLES, enforcer: casbin.Enforcer = Depends(get_enforcer), db: Session = Depends(get_db), current_user: Auth0ClaimsPatched = Depends(get_current_user)):
     if not check_access(enforcer, user=current_user.username, path=f"/run/{str(run_id)}", method="PUT"):
         raise HTTPException(status_code=403, detail='Insufficient Permissions')
 
@@ -237,31 +583,30 @@ async def update_run(run_id: int, run: RunModel, enforcer: casbin.Enforcer = Dep
     new_run_version = RunVersion(data=strip_metadata(run_dict), server_version=settings.server_version)
     new_run_version.run = new_run
     add_updator(new_run_version, current_user.username)
+    original_run_version = new_run.current
     new_run.current = new_run_version
     db.add(new_run_version)
-    samples = get_samples(new_run_version, new_run.protocol_version)
-    if samples:
-        for sample in samples:
-            db.merge(sample)
+    job = enqueue_sample_job(db, new_run_version, original_run_version, None, created_by=current_user.username)
     db.commit()
+    finish_sample_job(db, response, job, wait)
     return run_to_dict(new_run, new_run.current)
 
 @app.patch('/run/{run_id}', tags=['runs'], response_model=RunModel, response_model_exclude_none=True)
-async def patch_run(request: Request, run_id: int, patch: list, enforcer: casbin.Enforcer = Depends(get_enforcer), db: Session = Depends(get_db), current_user: Auth0ClaimsPatched = Depends(get_current_user)):
+def patch_run(response: Response, run_id: int, patch: list, wait: bool = WAIT_FOR_SAMPLES, enforcer: casbin.Enforcer = Depends(get_enforcer), db: Session = Depends(get_db), current_user: Auth0ClaimsPatched = Depends(get_current_user)):
     if not check_access(enforcer, user=current_user.username, path=f"/run/{str(run_id)}", method="PUT"):
         raise HTTPException(status_code=403, detail='Insufficient Permissions')
 
-    new_run = db.query(Run).get(run_id)
+    with phase('fetch', f"Fetched run {run_id}"):
+        new_run = db.query(Run).get(run_id)
     original_run_version = new_run.current
     if not new_run or new_run.is_deleted:
         raise HTTPException(status_code=404, detail='Run Not Found')
 
-    record_timing(request, note=f"Fetched run {run_id}")
-
     run_dict = versioned_row_to_dict(new_run, new_run.current)
     run_dict.pop('protocol', None)
     json_patch = jsonpatch.JsonPatch(patch)
     run_dict.pop('protocol', None)
+    original_run_dict = run_dict
     run_dict = json_patch.apply(run_dict)
 
     if not change_allowed(run_to_dict(new_run, new_run.current), run_dict):
@@ -273,62 +618,39 @@ async def patch_run(request: Request, run_id: int, patch: list, enforcer: casbin
     original_run_version = new_run.current
     new_run.current = new_run_version
     db.add(new_run_version)
-    db.commit()
-
-    record_timing(request, note=f"Saved changes to run {run_id}")
 
-    samples_dirty = False
-    for operation in patch:
-        operation_path = operation.get('path', '')
-        # Check for changes to the path: /sections/*/blocks/*/plates
-        if re.search("^/(sections/([^/]+/(blocks/([^/]+/(plates(/.*)?)?)?)?)?)?$", operation_path):
-            samples_dirty = True
-            break
-        # Check for changes to the path: /sections/*/blocks/*/plateSequencingResults
-        if re.search("^/(sections/([^/]+/(blocks/([^/]+/(plateSequencingResults(/.*)?)?)?)?)?)?$", operation_path):
-            samples_dirty = True
-            break
-        # Check for changes to the path: /protocol/sections/*/blocks/*/plateMarkers
-        if re.search("^/(protocol/(sections/([^/]+/(blocks/([^/]+/(plateMarkers(/.*)?)?)?)?)?)?)?$", operation_path):
-            samples_dirty = True
-            break
+    samples_dirty = any(
+        is_sample_path(operation.get('path', '')) or is_sample_path(operation.get('from') or '')
+        for operation in patch
+    )
 
     if samples_dirty:
-        logger.info("======================================")
-        logger.info(f"Regenerating samples for run_version: ({new_run.id}, {new_run_version.id})")
-        samples = get_samples(new_run_version, new_run.protocol_version)
-
-        record_timing(request, note=f"Regenerated run {new_run.id} samples (len: {len(samples)})")
-
-        if samples:
-            for sample in samples:
-                db.merge(sample)
-        logger.info(f"Generated {len(samples)} samples for run_version: ({new_run.id}, {new_run_version.id})")
-        logger.info("======================================")
-
-        record_timing(request, note=f"Saved {len(samples)} regenerated samples to run {new_run.id}")
+        # Only rebuild the samples of the plates, wells and results patched.
+        scope = sample_patch_scope(patch, original_run_dict)
+        if scope is None:
+            logger.info(f"Queueing sample regeneration for run_version: ({new_run.id}, {new_run_version.id})")
+        else:
+            logger.info(f"Queueing regeneration of {len(scope.keys)} samples (and results for {len(scope.marker_pairs)} markers) for run_version: ({new_run.id}, {new_run_version.id})")
+        job = enqueue_sample_job(db, new_run_version, original_run_version, scope, created_by=current_user.username)
+    elif has_unfinished_jobs(db, new_run.id) or original_run_version.samples_error:
+        # The original's samples aren't final yet, share them once they are
+        # (or regenerate them, if the original's job failed).
+        job = enqueue_sample_job(db, new_run_version, original_run_version, SampleScope(), created_by=current_user.username)
     else:
-        logger.info("======================================")
-        logger.info(f"Using old samples for run_version: ({new_run.id}, {new_run_version.id})")
-        samples = db.query(Sample)\
-            .filter(Sample.run_version_id == original_run_version.id)\
-            .distinct()
-        sample_count = 0
-        for sample in samples:
-            new_sample_version = clone_model(db, sample.current, run_version_id=new_run_version.id)
-            new_sample = clone_model(db, sample, current=new_sample_version, run_version_id=new_run_version.id)
-            db.merge(new_sample)
-            sample_count += 1
-        logger.info(f"Attached {sample_count} existing samples to run_version: ({new_run.id}, {new_run_version.id})")
-        logger.info("======================================")
-
-        record_timing(request, note=f"Attached {sample_count} existing samples to run {new_run.id}")
+        # Nothing is copied, the new version shares the original's samples.
+        job = None
+        new_run_version.sample_set_id = original_run_version.sample_run_version_id
+        logger.info(f"Shared samples of run_version {new_run_version.sample_set_id} with run_version: ({new_run.id}, {new_run_version.id})")
 
-    db.commit()
+    with phase('commit', f"Saved changes to run {run_id}"):
+        db.commit()
+
+    if job:
+        finish_sample_job(db, response, job, wait)
     return run_to_dict(new_run, new_run.current)
 
 @app.delete('/run/{run_id}', tags=['runs'], response_model=SuccessResponse, response_model_exclude_none=True)
-async def delete_run(run_id: int, purge: bool = False, enforcer: casbin.Enforcer = Depends(get_enforcer), db: Session = Depends(get_db), current_user: Auth0ClaimsPatched = Depends(get_current_user)):
+def delete_run(run_id: int, purge: bool = False, enforcer: casbin.Enforcer = Depends(get_enforcer), db: Session = Depends(get_db), current_user: Auth0ClaimsPatched = Depends(get_current_user)):
     if not check_access(enforcer, user=current_user.username, path=f"/run/{str(run_id)}", method="DELETE"):
         raise HTTPException(status_code=403, detail='Insufficient Permissions')
 
@@ -348,14 +670,14 @@ async def delete_run(run_id: int, purge: bool = False, enforcer: casbin.Enforcer
 # Permissions -----------------------------------------------------------------
 
 @app.get('/run/{run_id}/permission', tags=['runs'], response_model=List[Policy], response_model_exclude_none=True)
-async def get_permissions(run_id: int, enforcer: casbin.Enforcer = Depends(get_enforcer), current_user: Auth0ClaimsPatched = Depends(get_current_user)):
+def get_permissions(run_id: int, enforcer: casbin.Enforcer = Depends(get_enforcer), current_user: Auth0ClaimsPatched = Depends(get_current_user)):
     if not check_access(enforcer, user=current_user.username, path=f"/run/{str(run_id)}", method="GET"):
         raise HTTPException(status_code=403, detail='Insufficient Permissions')
 
     return get_policies(enforcer, path=f"/run/{run_id}")
 
 @app.post('/run/{run_id}/permission/{method}/{user_id}', tags=['protocols'], response_model=Policy, response_model_exclude_none=True)
-async def create_permission(run_id: int, method: str, user_id: str, enforcer: casbin.Enforcer = Depends(get_enforcer), current_user: Auth0ClaimsPatched = Depends(get_current_user)):
+def create_permission(run_id: int, method: str, user_id: str, enforcer: casbin.Enforcer = Depends(get_enforcer), current_user: Auth0ClaimsPatched = Depends(get_current_user)):
     if not check_access(enforcer, user=current_user.username, path=f"/run/{str(run_id)}", method="PUT"):
         raise HTTPException(status_code=403, detail='Insufficient Permissions')
 
@@ -363,7 +685,7 @@ async def create_permission(run_id: int, method: str, user_id: str, enforcer: ca
     return success
 
 @app.delete('/run/{run_id}/permission/{method}/{user_id}', tags=['protocols'], response_model=SuccessResponse, response_model_exclude_none=True)
-async def delete_permission(run_id: int, method: str, user_id: str, enforcer: casbin.Enforcer = Depends(get_enforcer), current_user: Auth0ClaimsPatched = Depends(get_current_user)):
+def delete_permission(run_id: int, method: str, user_id: str, enforcer: casbin.Enforcer = Depends(get_enforcer), current_user: Auth0ClaimsPatched = Depends(get_current_user)):
     if not check_access(enforcer, user=current_user.username, path=f"/run/{str(run_id)}", method="PUT"):
         raise HTTPException(status_code=403, detail='Insufficient Permissions')
 
@@ -374,7 +696,7 @@ async def delete_permission(run_id: int, method: str, user_id: str, enforcer: ca
 # Samples ---------------------------------------------------------------------
 
 @app.get('/run/{run_id}/sample', tags=['runs'], response_model=SampleResults, response_model_exclude_none=True)
-async def get_run_samples(
+def get_run_samples(
     run_id: Optional[int] = None,
     protocol: Optional[int] = None,
     plate: Optional[str] = None,
@@ -404,29 +726,9 @@ async def get_run_samples(
         per_page=per_page,
     )
 
-def list_or_dict_items(collection: Union[list, dict]):
-    if type(collection) == list:
-        for i, value in enumerate(collection):
-            yield (f"{i}", value)
-    elif type(collection) == dict:
-        for key, value in collection.items():
-            yield (key, value)
-    else:
-        raise TypeError(f"Expected a list or a dict type. Found: {type(collection)}")
-
-def flatten_list_or_dict(nested: Union[list, dict], regex: Optional[str] = None, current_path: str = "") -> Tuple[dict]:
-    result = {}
-    if regex is None or re.search(regex, current_path) is None:
-        for key, value in list_or_dict_items(nested):
-            sub_path = f"{key}" if current_path == "" else f"{current_path}__{key}"
-            if type(value) == list or type(value) == dict:
-                result.update(flatten_list_or_dict(value, regex, sub_path))
-            else:
-                result[sub_path] = value
-    return result
-
-@app.get('/run/{run_id}/sample.csv', tags=['runs'], response_model_exclude_none=True)
-async def export_run_samples_csv(
+@app.get('/run/{run_id}/sample.{export_format}', tags=['runs'], response_model_exclude_none=True)
+def export_run_samples(
+    export_format: ExportFormat,
     run_id: Optional[int] = None,
     protocol: Optional[int] = None,
     plate: Optional[str] = None,
@@ -443,14 +745,9 @@ async def export_run_samples_csv(
     if not run or run.is_deleted:
         raise HTTPException(status_code=404, detail='Run Not Found')
 
-    samples = crud_get_run_samples(
-        item_to_dict=lambda sample: run_to_sample(sample),
-
-        enforcer=enforcer,
-        db=db,
-        current_user=current_user,
-
-        run_id=run_id,
+    samples_query = filter_run_samples(
+        db,
+        run,
         protocol=protocol,
         plate=plate,
         reagent=reagent,
@@ -458,27 +755,12 @@ async def export_run_samples_csv(
         archived=archived,
     )
 
-    # Process each sample and add in flattened run data (with a filter).
-    flattened_run = flatten_list_or_dict(run_to_dict(run, run.current, False), '(attachments|type|definition|protocol|plates|plateSequencingResults|plateMarkers)')
-    flattened_samples = []
-    sample_headers = set()
-    for sample in samples['samples']:
-        flattened_sample = {**flattened_run, **flatten_list_or_dict(sample)}
-        flattened_samples.append(flattened_sample)
-        sample_headers.update(flattened_sample.keys())
-
-    sample_headers = list(sample_headers)
-    sample_headers.sort()
-    csvfile = io.StringIO()
-    writer = csv.writer(csvfile, quoting=csv.QUOTE_NONNUMERIC)
-    writer.writerow(sample_headers)
-    for flattened_sample in flattened_samples:
-        writer.writerow([flattened_sample.get(header, '') for header in sample_headers])
-
-    return Response(csvfile.getvalue(), media_type='text/csv')
+    # Every sample gets the same flattened run data (with a filter).
+    flattened_run = flattened_run_cache.flatten(run.version_id, run_to_dict(run, run.current, False))
+    return samples_export_response(db, samples_query, {run.id: flattened_run}, export_format)
 
 @app.get('/run/{run_id}/sample/{sample_id}', tags=['runs'], response_model=SampleResults, response_model_exclude_none=True)
-async def get_run_sample(run_id: int, sample_id: str, version_id: Optional[int] = None, enforcer: casbin.Enforcer = Depends(get_enforcer), db: Session = Depends(get_db), current_user: Auth0ClaimsPatched = Depends(get_current_user)):
+def get_run_sample(run_id: int, sample_id: str, version_id: Optional[int] = None, enforcer: casbin.Enforcer = Depends(get_enforcer), db: Session = Depends(get_db), current_user: Auth0ClaimsPatched = Depends(get_current_user)):
     return crud_get_run_sample(
         item_to_dict=lambda sample: run_to_sample(sample),
 
@@ -492,7 +774,7 @@ async def get_run_sample(run_id: int, sample_id: str, version_id: Optional[int]
     )
 
 @app.put('/run/{run_id}/sample/{sample_id}', tags=['runs'], response_model=SampleResults, response_model_exclude_none=True)
-async def update_run_sample(run_id: int, sample_id: str, sample: SampleResult, enforcer: casbin.Enforcer = Depends(get_enforcer), db: Session = Depends(get_db), current_user: Auth0ClaimsPatched = Depends(get_current_user)):
+def update_run_sample(run_id: int, sample_id: str, sample: SampleResult, enforcer: casbin.Enforcer = Depends(get_enforcer), db: Session = Depends(get_db), current_user: Auth0ClaimsPatched = Depends(get_current_user)):
     if not check_access(enforcer, user=current_user.username, path=f"/run/{str(run_id)}", method="PUT"):
         raise HTTPException(status_code=403, detail='Insufficient Permissions')
 
@@ -518,7 +800,7 @@ async def update_run_sample(run_id: int, sample_id: str, sample: SampleResult, e
 # Attachments -----------------------------------------------------------------
 
 @app.get('/run/{run_id}/attachment', tags=['runs'], response_model=List[AttachmentModel], response_model_exclude_none=True)
-async def get_run_attachments(run_id: int, enforcer: casbin.Enforcer = Depends(get_enforcer), db: Session = Depends(get_db), current_user: Auth0ClaimsPatched = Depends(get_current_user)):
+def get_run_attachments(run_id: int, enforcer: casbin.Enforcer = Depends(get_enforcer), db: Session = Depends(get_db), current_user: Auth0ClaimsPatched = Depends(get_current_user)):
     if not check_access(enforcer, user=current_user.username, path=f"/run/{str(run_id)}", method="GET"):
         raise HTTPException(status_code=403, detail='Insufficient Permissions')
 
@@ -534,7 +816,7 @@ async def get_run_attachments(run_id: int, enforcer: casbin.Enforcer = Depends(g
     ]
 
 @app.post('/run/{run_id}/attachment', tags=['runs'], response_model=AttachmentModel, response_model_exclude_none=True)
-async def create_run_attachment(run_id: int, file: UploadFile = File(...), enforcer: casbin.Enforcer = Depends(get_enforcer), db: Session = Depends(get_db), current_user: Auth0ClaimsPatched = Depends(get_current_user)):
+def create_run_attachment(run_id: int, file: UploadFile = File(...), enforcer: casbin.Enforcer = Depends(get_enforcer), db: Session = Depends(get_db), current_user: Auth0ClaimsPatched = Depends(get_current_user)):
     if not check_access(enforcer, user=current_user.username, path=f"/run/{str(run_id)}", method="GET"):
         raise HTTPException(status_code=403, detail='Insufficient Permissions')
     run = db.query(Run).get(run_id)
@@ -544,7 +826,7 @@ async def create_run_attachment(run_id: int, file: UploadFile = File(...), enfor
     attachment = Attachment(
         name=file.filename,
         mimetype=file.content_type,
-        data=await file.read(),
+        data=file.file.read(),
     )
 
     db.add(attachment)
@@ -552,7 +834,7 @@ async def create_run_attachment(run_id: int, file: UploadFile = File(...), enfor
     return AttachmentModel(id=attachment.id, name=attachment.name)
 
 @app.get('/run/{run_id}/attachment/{attachment_id}', tags=['runs'], response_model_exclude_none=True)
-async def get_run_attachment(run_id: int, attachment_id: int, enforcer: casbin.Enforcer = Depends(get_enforcer), db: Session = Depends(get_db), current_user: Auth0ClaimsPatched = Depends(get_current_user)):
+def get_run_attachment(run_id: int, attachment_id: int, enforcer: casbin.Enforcer = Depends(get_enforcer), db: Session = Depends(get_db), current_user: Auth0ClaimsPatched = Depends(get_current_user)):
     if not check_access(enforcer, user=current_user.username, path=f"/run/{str(run_id)}", method="GET"):
         raise HTTPException(status_code=403, detail='Insufficient Permissions')
     run = db.query(Run).get(run_id)
@@ -566,7 +848,7 @@ async def get_run_attachment(run_id: int, attachment_id: int, enforcer: casbin.E
     return StreamingResponse(io.BytesIO(attachment.data), media_type=attachment.mimetype if attachment.mimetype else 'application/octet-stream')
 
 @app.delete('/run/{run_id}/attachment/{attachment_id}', tags=['runs'], response_model=SuccessResponse, response_model_exclude_none=True)
-async def delete_run_attachment(run_id: int, attachment_id: int, purge: bool = False, enforcer: casbin.Enforcer = Depends(get_enforcer), db: Session = Depends(get_db), current_user: Auth0ClaimsPatched = Depends(get_current_user)):
+def delete_run_attachment(run_id: int, attachment_id: int, purge: bool = False, enforcer: casbin.Enforcer = Depends(get_enforcer), db: Session = Depends(get_db), current_user: Auth0ClaimsPatched = Depends(get_current_user)):
     if not check_access(enforcer, user=current_user.username, path=f"/run/{str(run_id)}", method="GET"):
         raise HTTPException(status_code=403, detail='Insufficient Permissions')
     run = db.query(Run).get(run_id)
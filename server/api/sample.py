@@ -11,12 +11,14 @@ from settings import settings
 from database import strip_metadata, run_to_sample, Sample, SampleVersion
 from models import SampleResult, SampleResults
 
+from api.export import flatten_sample_runs, samples_export_response, ExportFormat
+from api.run import run_to_dict
 from api.utils import change_allowed, add_updator
-from crud.sample import crud_get_samples, crud_get_sample
+from crud.sample import authorized_samples, crud_get_samples, crud_get_sample
 
 
 @app.get('/sample', tags=['samples'], response_model=SampleResults, response_model_exclude_none=True)
-async def get_samples(
+def get_samples(
     protocol: Optional[int] = None,
     run: Optional[int] = None,
     plate: Optional[str] = None,
@@ -26,6 +28,7 @@ async def get_samples(
     archived: Optional[bool] = None,
     page: Optional[int] = None,
     per_page: Optional[int] = None,
+    after: Optional[str] = None,
     enforcer: casbin.Enforcer = Depends(get_enforcer),
     db: Session = Depends(get_db),
     current_user: Auth0ClaimsPatched = Depends(get_current_user)
@@ -46,10 +49,41 @@ async def get_samples(
         archived=archived,
         page=page,
         per_page=per_page,
+        after=after,
     )
 
+@app.get('/sample.{export_format}', tags=['samples'], response_model_exclude_none=True)
+def export_samples(
+    export_format: ExportFormat,
+    protocol: Optional[int] = None,
+    run: Optional[int] = None,
+    plate: Optional[str] = None,
+    reagent: Optional[str] = None,
+    sample: Optional[str] = None,
+    creator: Optional[str] = None,
+    archived: Optional[bool] = None,
+    enforcer: casbin.Enforcer = Depends(get_enforcer),
+    db: Session = Depends(get_db),
+    current_user: Auth0ClaimsPatched = Depends(get_current_user)
+):
+    samples_query = authorized_samples(
+        enforcer=enforcer,
+        db=db,
+        current_user=current_user,
+
+        protocol=protocol,
+        run=run,
+        plate=plate,
+        reagent=reagent,
+        sample=sample,
+        creator=creator,
+        archived=archived,
+    )
+    flattened_runs = flatten_sample_runs(db, samples_query, lambda run: run_to_dict(run, run.current, False))
+    return samples_export_response(db, samples_query, flattened_runs, export_format)
+
 @app.get('/sample/{sample_id}', tags=['samples'], response_model=SampleResult, response_model_exclude_none=True)
-async def get_sample(
+def get_sample(
     sample_id: str,
     plate_id: str,
     run_version_id: int,
@@ -75,7 +109,7 @@ async def get_sample(
     )
 
 @app.put('/sample/{sample_id}', tags=['samples'], response_model=SampleResult, response_model_exclude_none=True)
-async def update_sample(sample_id: str, sample: SampleResult, db: Session = Depends(get_db), current_user: Auth0ClaimsPatched = Depends(get_current_user)):
+def update_sample(sample_id: str, sample: SampleResult, db: Session = Depends(get_db), current_user: Auth0ClaimsPatched = Depends(get_current_user)):
     sample_dict = sample.dict()
     new_sample = db.query(Sample).get(sample_id)
     if not new_sample or new_sample.is_deleted:
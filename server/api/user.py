@@ -3,18 +3,18 @@ import urllib.parse
 from typing import Optional
 import casbin
 
-from fastapi import Depends, HTTPException
+from fastapi import Depends, HTTPException, Request, Response
 from server import Auth0ClaimsPatched
 from sqlalchemy.orm import Session
 
 from server import app, get_db, get_current_user
 from settings import settings
 from authorization import add_policy, get_enforcer, get_roles
-from database import versioned_row_to_dict, strip_metadata, User, UserVersion
+from database import user_display_cache, versioned_row_to_dict, strip_metadata, User, UserVersion
 from models import UserModel, UsersModel
 
-from api.utils import add_owner, add_updator
-from crud.user import crud_get_users, crud_get_user
+from api.utils import add_owner, add_updator, conditional_response
+from crud.user import crud_get_users, crud_get_users_etag, crud_get_user, crud_get_user_etag
 
 
 def add_role(enforcer: casbin.Enforcer, d):
@@ -23,7 +23,9 @@ def add_role(enforcer: casbin.Enforcer, d):
 
 
 @app.get('/user', tags=['users'], response_model=UsersModel, response_model_exclude_none=True)
-async def get_users(
+def get_users(
+    request: Request,
+    response: Response,
     page: Optional[int] = None,
     per_page: Optional[int] = None,
 
@@ -31,6 +33,11 @@ async def get_users(
     db: Session = Depends(get_db),
     current_user: Auth0ClaimsPatched = Depends(get_current_user),
 ):
+    etag = crud_get_users_etag(enforcer=enforcer, db=db, current_user=current_user, archived=False)
+    not_modified = conditional_response(request, response, etag)
+    if not_modified:
+        return not_modified
+
     return crud_get_users(
         item_to_dict=lambda user: add_role(enforcer, versioned_row_to_dict(user, user.current)),
 
@@ -44,7 +51,7 @@ async def get_users(
     )
 
 @app.post('/user', tags=['users'], response_model=UserModel, response_model_exclude_none=True)
-async def create_user(user: UserModel, enforcer: casbin.Enforcer = Depends(get_enforcer), db: Session = Depends(get_db), current_user: Auth0ClaimsPatched = Depends(get_current_user)):
+def create_user(user: UserModel, enforcer: casbin.Enforcer = Depends(get_enforcer), db: Session = Depends(get_db), current_user: Auth0ClaimsPatched = Depends(get_current_user)):
     user_dict = user.dict()
 
     # Drop the roles field if it was provided.
@@ -61,7 +68,12 @@ async def create_user(user: UserModel, enforcer: casbin.Enforcer = Depends(get_e
     return add_role(enforcer, versioned_row_to_dict(new_user, new_user_version))
 
 @app.get('/user/{user_id}', tags=['users'], response_model=UserModel, response_model_exclude_none=True)
-async def get_user(user_id: str, version_id: Optional[int] = None, enforcer: casbin.Enforcer = Depends(get_enforcer), db: Session = Depends(get_db), current_user: Auth0ClaimsPatched = Depends(get_current_user)):
+def get_user(user_id: str, request: Request, response: Response, version_id: Optional[int] = None, enforcer: casbin.Enforcer = Depends(get_enforcer), db: Session = Depends(get_db), current_user: Auth0ClaimsPatched = Depends(get_current_user)):
+    etag = crud_get_user_etag(enforcer=enforcer, db=db, current_user=current_user, user_id=user_id)
+    not_modified = conditional_response(request, response, etag)
+    if not_modified:
+        return not_modified
+
     return crud_get_user(
         item_to_dict=lambda user: add_role(enforcer, versioned_row_to_dict(user, user.current)),
 
@@ -74,7 +86,7 @@ async def get_user(user_id: str, version_id: Optional[int] = None, enforcer: cas
     )
 
 @app.put('/user/{user_id}', tags=['users'], response_model=UserModel, response_model_exclude_none=True)
-async def update_user(user_id: str, user: UserModel, enforcer: casbin.Enforcer = Depends(get_enforcer), db: Session = Depends(get_db), current_user: Auth0ClaimsPatched = Depends(get_current_user)):
+def update_user(user_id: str, user: UserModel, enforcer: casbin.Enforcer = Depends(get_enforcer), db: Session = Depends(get_db), current_user: Auth0ClaimsPatched = Depends(get_current_user)):
     user_id = urllib.parse.unquote(user_id)
 
     user_dict = user.dict()
@@ -89,4 +101,5 @@ async def update_user(user_id: str, user: UserModel, enforcer: casbin.Enforcer =
     new_user.current = new_user_version
     db.add(new_user_version)
     db.commit()
+    user_display_cache.invalidate(new_user.id)
     return add_role(enforcer, versioned_row_to_dict(new_user, new_user.current))
@@ -1,6 +1,18 @@
+import base64
 import copy
+import hashlib
+import json
 import math
+from datetime import datetime
+from typing import List, Optional
 from deepdiff import DeepHash
+from fastapi import HTTPException, Request, Response
+from sqlalchemy import func, tuple_, DateTime
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import Query
+from sqlalchemy.sql.expression import ClauseElement, Executable
+
+from settings import settings
 
 
 # -----------------------------------------------------------------------------
@@ -71,13 +83,116 @@ def change_allowed(orig_dict, new_dict):
     return True
 
 
+# -----------------------------------------------------------------------------
+# Sparse Fieldsets ------------------------------------------------------------
+# -----------------------------------------------------------------------------
+
+def parse_fields(fields: Optional[str]) -> Optional[List[str]]:
+    """Top level fields asked for with `?fields=name,status`, or None for all
+    of them.
+    """
+    if fields is None:
+        return None
+    return sorted({field.strip() for field in fields.split(',') if field.strip()})
+
+
 # -----------------------------------------------------------------------------
 # Pagination ------------------------------------------------------------------
 # -----------------------------------------------------------------------------
 
-def paginatify(items_label, items, item_to_dict, page=None, per_page=None):
+class Explain(Executable, ClauseElement):
+    """`EXPLAIN (FORMAT JSON)` for a query, used to estimate its row count."""
+
+    def __init__(self, query: Query):
+        self.statement = query.statement
+
+@compiles(Explain, 'postgresql')
+def compile_explain(element, compiler, **kw):
+    return f"EXPLAIN (FORMAT JSON) {compiler.process(element.statement, **kw)}"
+
+def estimate_count(query: Query) -> int:
+    plan = query.session.execute(Explain(query)).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+def count_items(query: Query) -> int:
+    query = query.enable_eagerloads(False).order_by(None)
+    threshold = settings.pagination_count_estimate_threshold
+    if threshold > 0 and query.session.bind.dialect.name == 'postgresql':
+        estimate = estimate_count(query)
+        if estimate > threshold:
+            return estimate
+    return query.count()
+
+def encode_cursor(item, cursor_columns) -> str:
+    values = [getattr(item, column.key) for column in cursor_columns]
+    values = [value.isoformat() if isinstance(value, datetime) else value for value in values]
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+def decode_cursor(cursor: str, cursor_columns) -> list:
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if not isinstance(values, list) or len(values) != len(cursor_columns):
+            raise ValueError(cursor)
+        return [
+            datetime.fromisoformat(value) if isinstance(column.type, DateTime) else value
+            for column, value
+            in zip(cursor_columns, values)
+        ]
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail='Invalid Cursor')
+
+def seek_filter(cursor: str, cursor_columns, descending: bool, forward: bool):
+    key = tuple_(*cursor_columns)
+    bound = tuple_(*decode_cursor(cursor, cursor_columns))
+    if descending == forward:
+        return key < bound
+    return key > bound
+
+def paginatify(items_label, items, item_to_dict, page=None, per_page=None, after=None, before=None, cursor_columns=None, descending=True, prefetch=None):
+    """Page through `items`, either a list or a Query.
+
+    Queries are paged with LIMIT/OFFSET and counted separately so that only
+    the requested page is loaded. Queries ordered by `cursor_columns` can
+    also be paged by seeking past an `after` (or before a `before`) cursor,
+    which skips the OFFSET scan and the COUNT entirely.
+
+    `prefetch`, if given, is called with each page of items before they are
+    converted, so that whatever item_to_dict needs can be loaded in bulk.
+    """
+    def page_to_dicts(page_items):
+        if prefetch is not None:
+            prefetch(page_items)
+        return [item_to_dict(item) for item in page_items]
+
     response = {}
-    if page is not None or per_page is not None:
+    if after is not None or before is not None:
+        if per_page is None:
+            per_page = 20
+
+        query = items
+        if after is not None:
+            query = query.filter(seek_filter(after, cursor_columns, descending, forward=True))
+        if before is not None:
+            query = query.filter(seek_filter(before, cursor_columns, descending, forward=False))
+        backward = after is None
+        if backward:
+            query = query\
+                .order_by(None)\
+                .order_by(*[column.asc() if descending else column.desc() for column in cursor_columns])
+
+        # Fetch one extra row to find out whether there is another page.
+        page_items = query.limit(per_page + 1).all()
+        has_more = len(page_items) > per_page
+        page_items = page_items[:per_page]
+        if backward:
+            page_items.reverse()
+
+        response[items_label] = page_to_dicts(page_items)
+        response['hasNextPage'] = has_more if not backward else True
+        response['hasPreviousPage'] = has_more if backward else True
+    elif page is not None or per_page is not None:
         if page is None:
             page = 1
         if per_page is None:
@@ -86,15 +201,84 @@ def paginatify(items_label, items, item_to_dict, page=None, per_page=None):
         starting_index = (page - 1) * per_page
         ending_index = page * per_page
 
-        response[items_label] = [item_to_dict(item) for item in items[starting_index:ending_index]]
+        if isinstance(items, Query):
+            page_items = items.offset(starting_index).limit(per_page).all()
+            item_count = count_items(items)
+        else:
+            page_items = items[starting_index:ending_index]
+            item_count = len(items)
+
+        response[items_label] = page_to_dicts(page_items)
         response['page'] = page
-        response['pageCount'] = math.ceil(float(len(items)) / per_page)
+        response['pageCount'] = math.ceil(float(item_count) / per_page)
+        response['hasNextPage'] = page < response['pageCount']
+        response['hasPreviousPage'] = page > 1
     else:
-        response[items_label] = [item_to_dict(item) for item in items]
+        page_items = items if isinstance(items, list) else items.all()
+        response[items_label] = page_to_dicts(page_items)
+
+    if cursor_columns is not None:
+        response['cursors'] = [encode_cursor(item, cursor_columns) for item in page_items]
+        if response.get('hasNextPage', False) and page_items:
+            response['nextCursor'] = response['cursors'][-1]
 
     return response
 
 
+# -----------------------------------------------------------------------------
+# Conditional Requests --------------------------------------------------------
+# -----------------------------------------------------------------------------
+
+def version_etag(kind: str, *version_ids, extra=None) -> str:
+    """Strong ETag for a single row, from the version ids its body is built from.
+
+    Anything else the body depends on can be passed as `extra` (any JSON
+    serializable value), which is folded in as a digest.
+    """
+    parts = [kind, *[str(version_id) for version_id in version_ids]]
+    if extra is not None:
+        parts.append(hashlib.sha1(json.dumps(extra, default=str).encode()).hexdigest()[:8])
+    return '"' + '-'.join(parts) + '"'
+
+def query_etag(kind: str, query: Query, *version_columns, extra=None) -> str:
+    """Strong ETag for every row `query` matches.
+
+    Version ids only ever increase, so the row count along with the max and
+    sum of each version column changes whenever a row is added, edited,
+    archived or shared. That takes one aggregate query and no JSONB.
+    """
+    aggregates = []
+    for column in version_columns:
+        aggregates.extend([func.max(column), func.sum(column)])
+    values = query\
+        .enable_eagerloads(False)\
+        .order_by(None)\
+        .with_entities(func.count(), *aggregates)\
+        .one()
+    digest = hashlib.sha1(json.dumps([*values, extra], default=str).encode()).hexdigest()
+    return f'"{kind}-{digest[:20]}"'
+
+def etag_matches(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get('if-none-match')
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        # If-None-Match uses the weak comparison.
+        if tag == '*' or tag == etag or tag == f"W/{etag}":
+            return True
+    return False
+
+def conditional_response(request: Request, response: Response, etag: Optional[str]) -> Optional[Response]:
+    """Return a 304 if the client has `etag` already, else tag `response` with it."""
+    if etag is None:
+        return None
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers={'ETag': etag})
+    response.headers['ETag'] = etag
+    return None
+
+
 # -----------------------------------------------------------------------------
 # Miscellaneous ---------------------------------------------------------------
 # -----------------------------------------------------------------------------
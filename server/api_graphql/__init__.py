@@ -1,21 +1,24 @@
+from starlette.concurrency import run_in_threadpool
 from starlette.graphql import GraphQLApp
 from fastapi import Request, Response, HTTPException
 from fastapi.security.http import HTTPBearer
-from authorization import init_enforcer
+from authorization import get_shared_enforcer
 from server import app, get_current_user
 from api_graphql.schema import schema
 
 
-@app.middleware("http")
-async def add_current_user(request: Request, call_next):
-    # Only do the following if this is the graphql app.
-    if request.url.path.startswith("/graphql") and request.method != "OPTIONS":
-        try:
-            request.state.user = await get_current_user(await HTTPBearer()(request))
-            request.state.enforcer = init_enforcer()
-        except HTTPException as ex:
-            return Response(ex.detail, media_type="text/plain", status_code=ex.status_code)
+class AuthenticatedGraphQLApp(GraphQLApp):
+    """GraphQLApp resolving the current user and enforcer for its resolvers."""
 
-    return await call_next(request)
+    async def handle_graphql(self, request: Request) -> Response:
+        if request.method != "OPTIONS":
+            try:
+                request.state.user = await get_current_user(await HTTPBearer()(request))
+                # Syncing (or first loading) the policy queries the database.
+                request.state.enforcer = await run_in_threadpool(get_shared_enforcer)
+            except HTTPException as ex:
+                return Response(ex.detail, media_type="text/plain", status_code=ex.status_code)
 
-app.add_route("/graphql", GraphQLApp(schema=schema))
+        return await super().handle_graphql(request)
+
+app.add_route("/graphql", AuthenticatedGraphQLApp(schema=schema))
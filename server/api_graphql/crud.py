@@ -1,22 +1,21 @@
-from collections import OrderedDict
 from typing import Dict, List, Optional, Set
 import casbin
 from graphql.execution.base import ResolveInfo
 from graphql.language.ast import Field, FragmentDefinition, FragmentSpread
 from graphql.type.definition import GraphQLList, GraphQLNonNull
 from graphql.type.schema import GraphQLSchema
-from database import Protocol, ProtocolVersion, Run, RunVersion, Sample, SampleVersion, filter_by_plate_label_filter, filter_by_reagent_label_filter, filter_by_sample_label_filter
+from database import Protocol, ProtocolVersion, QueryFilters, Run, RunVersion, Sample, SampleVersion, filter_by_plate_label_filter, filter_by_reagent_label_filter, filter_by_sample_label_filter
 from fastapi import Request
 from models import ProtocolModel, RunModel, SampleResult
 from server import Auth0CurrentUserPatched, Session
 
 from api.utils import paginatify
-from authorization import check_access
+from authorization import access_filter
 
 # CRUD helpers ----------------------------------------------------------------
 
 def get_session(info: ResolveInfo) -> Session:
-    return getattr(info.context['request'].state, 'session', None)
+    return info.context['request'].state.db.get()
 
 def get_current_user_from_request(request: Request) -> Auth0CurrentUserPatched:
     return getattr(request.state, 'user', None)
@@ -103,6 +102,8 @@ def graphql_crud_get_runs(
     # Paging parameters
     page: Optional[int] = None,
     per_page: Optional[int] = None,
+    after: Optional[str] = None,
+    before: Optional[str] = None,
 ):
     # Calculate which top level fields to remove.
     top_level_ignore = {'id', 'run_id', 'created_by', 'created_on', 'updated_by', 'updated_on', 'protocol'}
@@ -138,50 +139,46 @@ def graphql_crud_get_runs(
     db = get_session(info)
 
     # Join with additional tables as necessary for search params.
-    from_tables = OrderedDict()
-    filters = []
+    filters = QueryFilters()
     
     if protocol:
-        from_tables[ProtocolVersion] = ProtocolVersion.id == Run.protocol_version_id
-        filters.append(ProtocolVersion.protocol_id == protocol)
+        filters.join(ProtocolVersion, ProtocolVersion.id == Run.protocol_version_id)
+        filters.filter(ProtocolVersion.protocol_id == protocol)
     if run:
-        filters.append(Run.id == run)
+        filters.filter(Run.id == run)
     if plate:
-        filters.append(filter_by_plate_label_filter(plate))
+        filters.filter(filter_by_plate_label_filter(plate))
     if reagent:
-        filters.append(filter_by_reagent_label_filter(reagent))
+        filters.filter(filter_by_reagent_label_filter(reagent, Run.protocol_version_id))
     if sample:
-        filters.append(filter_by_sample_label_filter(sample))
+        filters.filter(filter_by_sample_label_filter(sample))
     if creator:
-        filters.append(Run.created_by == creator)
+        filters.filter(Run.created_by == creator)
     if archived is None or archived == False:
-        filters.append(Run.is_deleted == False)
+        filters.filter(Run.is_deleted == False)
 
     query = db.query(*select_args)\
         .select_from(Run)\
         .join(RunVersion, RunVersion.id == Run.version_id)
-    for join_cls, join_filter in from_tables.items():
-        query = query.join(join_cls, join_filter)
-    
+
     # Apply search filters.
-    for search_filter in filters:
-        query = query.filter(search_filter)
+    query = filters.apply(query)
+
+    # Only return rows the current user can read.
+    query = query.filter(access_filter(enforcer, user=current_user.username, path_prefix='/run/', column=Run.id, method='GET'))
 
     # Get results
-    query = query.distinct().order_by(Run.created_on.desc())
-    rows = [
-        run
-        for run
-        in query
-        if check_access(enforcer, user=current_user.username, path=f"/run/{str(run.id)}", method="GET")
-    ]
+    query = query.distinct().order_by(Run.created_on.desc(), Run.id.desc())
 
     return paginatify(
         items_label='runs',
-        items=rows,
+        items=query,
         item_to_dict=lambda run: RunModel.parse_obj(run._asdict()),
         page=page,
         per_page=per_page,
+        after=after,
+        before=before,
+        cursor_columns=(Run.created_on, Run.id),
     )
 
 def graphql_crud_get_protocols(
@@ -201,6 +198,8 @@ def graphql_crud_get_protocols(
     # Paging parameters
     page: Optional[int] = None,
     per_page: Optional[int] = None,
+    after: Optional[str] = None,
+    before: Optional[str] = None,
 ):
     # Calculate which top level fields to remove.
     top_level_ignore = {'id', 'protocol_id', 'created_by', 'created_on', 'updated_by', 'updated_on', 'protocol'}
@@ -235,56 +234,52 @@ def graphql_crud_get_protocols(
     db = get_session(info)
 
     # Join with additional tables as necessary for search params.
-    from_tables = OrderedDict()
-    filters = []
+    filters = QueryFilters()
     
     if protocol:
-        filters.append(Protocol.id == protocol)
+        filters.filter(Protocol.id == protocol)
     if run:
-        from_tables[Run] = Run.protocol_version_id == ProtocolVersion.id
-        filters.append(Run.id == run)
+        filters.join(Run, Run.protocol_version_id == ProtocolVersion.id)
+        filters.filter(Run.id == run)
     if plate:
-        from_tables[Run] = Run.protocol_version_id == ProtocolVersion.id
-        from_tables[RunVersion] = RunVersion.id == Run.version_id
-        filters.append(filter_by_plate_label_filter(plate))
+        filters.join(Run, Run.protocol_version_id == ProtocolVersion.id)
+        filters.join(RunVersion, RunVersion.id == Run.version_id)
+        filters.filter(filter_by_plate_label_filter(plate))
     if reagent:
-        from_tables[Run] = Run.protocol_version_id == ProtocolVersion.id
-        from_tables[RunVersion] = RunVersion.id == Run.version_id
-        filters.append(filter_by_reagent_label_filter(reagent))
+        filters.join(Run, Run.protocol_version_id == ProtocolVersion.id)
+        filters.join(RunVersion, RunVersion.id == Run.version_id)
+        filters.filter(filter_by_reagent_label_filter(reagent))
     if sample:
-        from_tables[Run] = Run.protocol_version_id == ProtocolVersion.id
-        from_tables[RunVersion] = RunVersion.id == Run.version_id
-        filters.append(filter_by_sample_label_filter(sample))
+        filters.join(Run, Run.protocol_version_id == ProtocolVersion.id)
+        filters.join(RunVersion, RunVersion.id == Run.version_id)
+        filters.filter(filter_by_sample_label_filter(sample))
     if creator:
-        filters.append(Protocol.created_by == creator)
+        filters.filter(Protocol.created_by == creator)
     if archived is None or archived == False:
-        filters.append(Protocol.is_deleted == False)
+        filters.filter(Protocol.is_deleted == False)
 
     query = db.query(*select_args)\
         .select_from(Protocol)\
         .join(ProtocolVersion, ProtocolVersion.id == Protocol.version_id)
-    for join_cls, join_filter in from_tables.items():
-        query = query.join(join_cls, join_filter)
-    
+
     # Apply search filters.
-    for search_filter in filters:
-        query = query.filter(search_filter)
+    query = filters.apply(query)
+
+    # Only return rows the current user can read.
+    query = query.filter(access_filter(enforcer, user=current_user.username, path_prefix='/protocol/', column=Protocol.id, method='GET'))
 
     # Get results
-    query = query.distinct().order_by(Protocol.created_on.desc())
-    rows = [
-        protocol
-        for protocol
-        in query
-        if check_access(enforcer, user=current_user.username, path=f"/protocol/{str(protocol.id)}", method="GET")
-    ]
+    query = query.distinct().order_by(Protocol.created_on.desc(), Protocol.id.desc())
 
     return paginatify(
         items_label='protocols',
-        items=rows,
+        items=query,
         item_to_dict=lambda protocol: ProtocolModel.parse_obj(protocol._asdict()),
         page=page,
         per_page=per_page,
+        after=after,
+        before=before,
+        cursor_columns=(Protocol.created_on, Protocol.id),
     )
 
 def graphql_crud_get_samples(
@@ -304,6 +299,8 @@ def graphql_crud_get_samples(
     # Paging parameters
     page: Optional[int] = None,
     per_page: Optional[int] = None,
+    after: Optional[str] = None,
+    before: Optional[str] = None,
 ):
     # Calculate which top level fields to remove.
     top_level_ignore = {'sample_id', 'plate_id', 'run_version_id', 'protocol_version_id', 'created_by', 'created_on', 'updated_by', 'updated_on', 'run_id', 'protocol_id'}
@@ -354,49 +351,45 @@ def graphql_crud_get_samples(
     db = get_session(info)
 
     # Join with additional tables as necessary for search params.
-    from_tables = OrderedDict()
-    filters = []
+    filters = QueryFilters()
     
     if protocol:
-        filters.append(ProtocolVersion.protocol_id == protocol)
+        filters.filter(ProtocolVersion.protocol_id == protocol)
     if run:
-        filters.append(RunVersion.run_id == run)
+        filters.filter(RunVersion.run_id == run)
     if plate:
-        filters.append(Sample.plate_id.like(f"%{plate}%"))
+        filters.filter(Sample.plate_id.like(f"%{plate}%"))
     if reagent:
-        filters.append(filter_by_reagent_label_filter(reagent))
+        filters.filter(filter_by_reagent_label_filter(reagent))
     if sample:
-        filters.append(Sample.sample_id.like(f"%{sample}%"))
+        filters.filter(Sample.sample_id.like(f"%{sample}%"))
     if creator:
-        filters.append(Sample.created_by == creator)
+        filters.filter(Sample.created_by == creator)
     if archived is None or archived == False:
-        filters.append(Sample.is_deleted == False)
+        filters.filter(Sample.is_deleted == False)
 
     query = db.query(*select_args)\
         .select_from(Sample)\
         .join(SampleVersion, SampleVersion.id == Sample.version_id)\
         .join(RunVersion, RunVersion.id == Sample.run_version_id)\
         .join(ProtocolVersion, ProtocolVersion.id == Sample.protocol_version_id)
-    for join_cls, join_filter in from_tables.items():
-        query = query.join(join_cls, join_filter)
-    
+
     # Apply search filters.
-    for search_filter in filters:
-        query = query.filter(search_filter)
+    query = filters.apply(query)
+
+    # Only return rows the current user can read.
+    query = query.filter(access_filter(enforcer, user=current_user.username, path_prefix='/run/', column=RunVersion.run_id, method='GET'))
 
     # Get results
-    query = query.distinct().order_by(Sample.created_on.desc())
-    rows = [
-        sample
-        for sample
-        in query
-        if check_access(enforcer, user=current_user.username, path=f"/run/{str(sample.run_id)}", method="GET")
-    ]
+    query = query.distinct().order_by(Sample.created_on.desc(), Sample.sample_id.desc(), Sample.plate_id.desc(), Sample.run_version_id.desc(), Sample.protocol_version_id.desc())
 
     return paginatify(
         items_label='samples',
-        items=rows,
+        items=query,
         item_to_dict=lambda sample: SampleResult.parse_obj(add_sample_id(sample._asdict())),
         page=page,
         per_page=per_page,
+        after=after,
+        before=before,
+        cursor_columns=(Sample.created_on, Sample.sample_id, Sample.plate_id, Sample.run_version_id, Sample.protocol_version_id),
     )
@@ -1,6 +1,7 @@
 import graphene
 
 from sqlalchemy import and_
+from graphql import GraphQLError
 from graphql.execution.base import ResolveInfo
 from graphene import relay
 from graphene_pydantic import PydanticObjectType
@@ -25,6 +26,33 @@ def add_ids(input: dict, **kwargs) -> dict:
         input[key] = value
     return input
 
+def relay_per_page(first: Optional[int], last: Optional[int], before: Optional[str], per_page: Optional[int]) -> Optional[int]:
+    # Pages are only read backward from a cursor, so `last` needs `before`.
+    if last is not None and before is None:
+        raise GraphQLError("`last` requires a `before` cursor")
+    return first or last or per_page
+
+def pagination_to_connection(connection_type, node_type, items_label: str, pagination_dict: dict):
+    cursors = pagination_dict.get('cursors', [])
+    return connection_type(
+        page=pagination_dict.get('page', None),
+        pageCount=pagination_dict.get('pageCount', None),
+        edges=[
+            connection_type.Edge(
+                node=node_type.parse_obj(r),
+                cursor=cursor,
+            )
+            for r, cursor
+            in zip(pagination_dict[items_label], cursors)
+        ],
+        page_info=relay.PageInfo(
+            has_next_page=pagination_dict.get('hasNextPage', False),
+            has_previous_page=pagination_dict.get('hasPreviousPage', False),
+            start_cursor=cursors[0] if cursors else None,
+            end_cursor=cursors[-1] if cursors else None,
+        ),
+    )
+
 
 # Pydantic Schema Classes -----------------------------------------------------
 
@@ -463,6 +491,12 @@ class RunNode(VersionedPydanticObjectType):
         # Paging parameters
         page: Optional[int] = None,
         per_page: Optional[int] = None,
+
+        # Relay paging parameters
+        before: Optional[str] = None,
+        after: Optional[str] = None,
+        first: Optional[int] = None,
+        last: Optional[int] = None,
     ):
         enforcer = get_enforcer_from_request(info.context['request'])
         current_user = get_current_user_from_request(info.context['request'])
@@ -480,27 +514,12 @@ class RunNode(VersionedPydanticObjectType):
             run_id=root.run_id,
 
             page=page,
-            per_page=per_page,
+            per_page=relay_per_page(first, last, before, per_page),
+            after=after,
+            before=before,
         )
 
-        return SampleConnection(
-            page=pagination_dict.get('page', None),
-            pageCount=pagination_dict.get('pageCount', None),
-            edges=[
-                SampleConnection.Edge(
-                    node=SampleResult.parse_obj(r),
-                    cursor=f"{pagination_dict.get('page', 1)}.{i}",
-                )
-                for i, r
-                in enumerate(pagination_dict['samples'])
-            ],
-            page_info=relay.PageInfo(
-                has_next_page=pagination_dict.get('page', 1) < pagination_dict.get('pageCount', 1),
-                has_previous_page=pagination_dict.get('page', 1) > pagination_dict.get('pageCount', 1),
-                start_cursor="1.0",
-                end_cursor=f"1.{len(pagination_dict['samples'])}" if pagination_dict.get('pageCount', None) is None else f"{pagination_dict['pageCount']}.{len(pagination_dict['samples'])}",
-            ),
-        )
+        return pagination_to_connection(SampleConnection, SampleResult, 'samples', pagination_dict)
 
 class RunConnection(relay.Connection):
     class Meta:
@@ -626,7 +645,7 @@ class Query(graphene.ObjectType):
         page: Optional[int] = None,
         per_page: Optional[int] = None,
 
-        # Currently unused
+        # Relay paging parameters
         before: Optional[str] = None,
         after: Optional[str] = None,
         first: Optional[int] = None,
@@ -649,27 +668,12 @@ class Query(graphene.ObjectType):
             creator,
             archived,
             page,
-            per_page,
+            relay_per_page(first, last, before, per_page),
+            after=after,
+            before=before,
         )
 
-        return ProtocolConnection(
-            page=pagination_dict.get('page', None),
-            pageCount=pagination_dict.get('pageCount', None),
-            edges=[
-                ProtocolConnection.Edge(
-                    node=ProtocolModel.parse_obj(r),
-                    cursor=f"{pagination_dict.get('page', 1)}.{i}",
-                )
-                for i, r
-                in enumerate(pagination_dict['protocols'])
-            ],
-            page_info=relay.PageInfo(
-                has_next_page=pagination_dict.get('page', 1) < pagination_dict.get('pageCount', 1),
-                has_previous_page=pagination_dict.get('page', 1) > pagination_dict.get('pageCount', 1),
-                start_cursor="1.0",
-                end_cursor=f"1.{len(pagination_dict['protocols'])}" if pagination_dict.get('pageCount', None) is None else f"{pagination_dict['pageCount']}.{len(pagination_dict['protocols'])}",
-            ),
-        )
+        return pagination_to_connection(ProtocolConnection, ProtocolModel, 'protocols', pagination_dict)
 
     @staticmethod
     def resolve_run(
@@ -715,7 +719,7 @@ class Query(graphene.ObjectType):
         page: Optional[int] = None,
         per_page: Optional[int] = None,
 
-        # Currently unused
+        # Relay paging parameters
         before: Optional[str] = None,
         after: Optional[str] = None,
         first: Optional[int] = None,
@@ -738,27 +742,12 @@ class Query(graphene.ObjectType):
             creator,
             archived,
             page,
-            per_page,
+            relay_per_page(first, last, before, per_page),
+            after=after,
+            before=before,
         )
 
-        return RunConnection(
-            page=pagination_dict.get('page', None),
-            pageCount=pagination_dict.get('pageCount', None),
-            edges=[
-                RunConnection.Edge(
-                    node=RunModel.parse_obj(r),
-                    cursor=f"{pagination_dict.get('page', 1)}.{i}",
-                )
-                for i, r
-                in enumerate(pagination_dict['runs'])
-            ],
-            page_info=relay.PageInfo(
-                has_next_page=pagination_dict.get('page', 1) < pagination_dict.get('pageCount', 1),
-                has_previous_page=pagination_dict.get('page', 1) > pagination_dict.get('pageCount', 1),
-                start_cursor="1.0",
-                end_cursor=f"1.{len(pagination_dict['runs'])}" if pagination_dict.get('pageCount', None) is None else f"{pagination_dict['pageCount']}.{len(pagination_dict['runs'])}",
-            ),
-        )
+        return pagination_to_connection(RunConnection, RunModel, 'runs', pagination_dict)
 
     @staticmethod
     def resolve_user(root, info: ResolveInfo, id: str, version_id: Optional[int]):
@@ -792,7 +781,7 @@ class Query(graphene.ObjectType):
         page: Optional[int] = None,
         per_page: Optional[int] = None,
 
-        # Currently unused
+        # Relay paging parameters
         before: Optional[str] = None,
         after: Optional[str] = None,
         first: Optional[int] = None,
@@ -814,27 +803,12 @@ class Query(graphene.ObjectType):
             archived=archived,
 
             page=page,
-            per_page=per_page,
+            per_page=relay_per_page(first, last, before, per_page),
+            after=after,
+            before=before,
         )
 
-        return UserConnection(
-            page=pagination_dict.get('page', None),
-            pageCount=pagination_dict.get('pageCount', None),
-            edges=[
-                UserConnection.Edge(
-                    node=UserModel.parse_obj(r),
-                    cursor=f"{pagination_dict.get('page', 1)}.{i}",
-                )
-                for i, r
-                in enumerate(pagination_dict['users'])
-            ],
-            page_info=relay.PageInfo(
-                has_next_page=pagination_dict.get('page', 1) < pagination_dict.get('pageCount', 1),
-                has_previous_page=pagination_dict.get('page', 1) > pagination_dict.get('pageCount', 1),
-                start_cursor="1.0",
-                end_cursor=f"1.{len(pagination_dict['users'])}" if pagination_dict.get('pageCount', None) is None else f"{pagination_dict['pageCount']}.{len(pagination_dict['users'])}",
-            ),
-        )
+        return pagination_to_connection(UserConnection, UserModel, 'users', pagination_dict)
 
     @staticmethod
     def resolve_sample(root, info: ResolveInfo, sample_id: str, plate_id: str, run_version_id: int, protocol_version_id: int, version_id: Optional[int]):
@@ -877,7 +851,7 @@ class Query(graphene.ObjectType):
         page: Optional[int] = None,
         per_page: Optional[int] = None,
 
-        # Currently unused
+        # Relay paging parameters
         before: Optional[str] = None,
         after: Optional[str] = None,
         first: Optional[int] = None,
@@ -900,27 +874,12 @@ class Query(graphene.ObjectType):
             creator,
             archived,
             page,
-            per_page,
+            relay_per_page(first, last, before, per_page),
+            after=after,
+            before=before,
         )
 
-        return SampleConnection(
-            page=pagination_dict.get('page', None),
-            pageCount=pagination_dict.get('pageCount', None),
-            edges=[
-                SampleConnection.Edge(
-                    node=SampleResult.parse_obj(r),
-                    cursor=f"{pagination_dict.get('page', 1)}.{i}",
-                )
-                for i, r
-                in enumerate(pagination_dict['samples'])
-            ],
-            page_info=relay.PageInfo(
-                has_next_page=pagination_dict.get('page', 1) < pagination_dict.get('pageCount', 1),
-                has_previous_page=pagination_dict.get('page', 1) > pagination_dict.get('pageCount', 1),
-                start_cursor="1.0",
-                end_cursor=f"1.{len(pagination_dict['samples'])}" if pagination_dict.get('pageCount', None) is None else f"{pagination_dict['pageCount']}.{len(pagination_dict['samples'])}",
-            ),
-        )
+        return pagination_to_connection(SampleConnection, SampleResult, 'samples', pagination_dict)
 
 
 # TODO:
@@ -1,58 +1,358 @@
 """Utilities for API authorization."""
 
-from typing import Optional
+import logging
+import re
+import threading
+import time
+
+from datetime import timedelta
+from typing import List, Optional
 import casbin
 import casbin_sqlalchemy_adapter
+from casbin_sqlalchemy_adapter.adapter import CasbinRule
+from sqlalchemy import case, cast, exc, func, inspect, literal, or_, true, Column, DateTime, Index, Integer, String
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker
 
+from metrics import enforcer_checks
+from server import casbin_engine, engine
+from server_timing import phase
 from settings import settings
 
 
+logger = logging.getLogger(__name__)
+
+
+# CASBIN Change Log -----------------------------------------------------------
+
+# Lives next to casbin_rule (which may be a separate database), so it is
+# managed here instead of through the alembic migrations.
+PolicyBase = declarative_base()
+
+class CasbinRuleChange(PolicyBase):
+    """Append-only log of policy edits, replayed by the other worker processes."""
+    __tablename__ = 'casbin_rule_change'
+
+    id = Column(Integer, primary_key=True)
+    created_on = Column(DateTime, default=func.now())
+    operation = Column(String(16))
+    ptype = Column(String(255))
+    field_index = Column(Integer, default=0)
+    v0 = Column(String(255))
+    v1 = Column(String(255))
+    v2 = Column(String(255))
+    v3 = Column(String(255))
+    v4 = Column(String(255))
+    v5 = Column(String(255))
+
+    @property
+    def values(self) -> List[str]:
+        values = [self.v0, self.v1, self.v2, self.v3, self.v4, self.v5]
+        return [value for value in values if value is not None]
+
+PolicySession = sessionmaker(bind=casbin_engine)
+
+# The adapter creates casbin_rule itself (without this index, which
+# access_filter relies on), so the index is managed here too.
+casbin_rule_subject_index = Index('ix_casbin_rule_ptype_v0', CasbinRule.ptype, CasbinRule.v0)
+
+def create_casbin_rule_index():
+    def exists():
+        return any(index['name'] == casbin_rule_subject_index.name for index in inspect(casbin_engine).get_indexes('casbin_rule'))
+
+    if exists():
+        return
+    try:
+        casbin_rule_subject_index.create(casbin_engine)
+    except exc.DBAPIError:
+        # Another worker may have created it in the meantime.
+        if not exists():
+            raise
+
+def record_policy_change(operation: str, ptype: str, field_index: int, values: List[str]):
+    db = PolicySession()
+    try:
+        change = CasbinRuleChange(operation=operation, ptype=ptype, field_index=field_index)
+        for i, value in enumerate(values):
+            setattr(change, f"v{i}", value)
+        db.add(change)
+        # Workers that fall further behind than this do a full reload instead.
+        db.query(CasbinRuleChange)\
+            .filter(CasbinRuleChange.created_on < func.now() - timedelta(seconds=2 * settings.casbin_policy_reload_interval))\
+            .delete(synchronize_session=False)
+        db.commit()
+    except:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+def record_policy_change_or_log(operation: str, ptype: str, field_index: int, values: List[str]):
+    """Record a policy edit that has already been saved to casbin_rule."""
+    try:
+        record_policy_change(operation, ptype, field_index, values)
+    except Exception:
+        # The edit stands, but other workers only see it after a full reload.
+        logger.exception(f"Failed to record policy change {operation} {ptype} {values}; other workers will miss it until their next reload.")
+
+
 # CASBIN Dependency -----------------------------------------------------------
 
+class PolicyAdapter(casbin_sqlalchemy_adapter.Adapter):
+    """Adapter rolling back its session when an operation fails.
+
+    The adapter keeps one session for the life of its enforcer, and never
+    rolls it back itself, so one failed write would fail every later one.
+    """
+
+    def _rollback_on_error(self, operation, *args):
+        try:
+            return operation(*args)
+        except:
+            self._session.rollback()
+            raise
+
+    def load_policy(self, model):
+        return self._rollback_on_error(super().load_policy, model)
+
+    def save_policy(self, model):
+        return self._rollback_on_error(super().save_policy, model)
+
+    def add_policy(self, sec, ptype, rule):
+        return self._rollback_on_error(super().add_policy, sec, ptype, rule)
+
+    def remove_policy(self, sec, ptype, rule):
+        return self._rollback_on_error(super().remove_policy, sec, ptype, rule)
+
+    def remove_filtered_policy(self, sec, ptype, field_index, *field_values):
+        return self._rollback_on_error(super().remove_filtered_policy, sec, ptype, field_index, *field_values)
+
+class SharedEnforcer(casbin.SyncedEnforcer):
+    """Enforcer shared by every request in this process.
+
+    Edits made through `add_policy`/`delete_policy` update the in-memory
+    policy directly. Edits made by other workers are picked up by replaying
+    `casbin_rule_change`, and a background thread reloads the whole policy
+    table every `casbin_policy_reload_interval` seconds to catch anything
+    made outside of the API.
+    """
+
+    def __init__(self):
+        self._sync_lock = threading.Lock()
+        self.last_change_id, self.seen_change_ids = self._change_log_position()
+        self.last_sync = time.monotonic()
+        super().__init__(settings.casbin_model, PolicyAdapter(casbin_engine))
+        if settings.casbin_policy_reload_interval > 0:
+            thread = threading.Thread(target=self._reload_periodically, name='casbin-policy-reload', daemon=True)
+            thread.start()
+
+    def _recent_changes(self, db):
+        # Ids are assigned when a change is inserted, not when it commits, so
+        # a lower id can show up after a higher one. Re-reading the last
+        # casbin_policy_sync_overlap seconds catches those.
+        return db.query(CasbinRuleChange)\
+            .filter(or_(
+                CasbinRuleChange.id > self.last_change_id,
+                CasbinRuleChange.created_on >= func.now() - timedelta(seconds=settings.casbin_policy_sync_overlap),
+            ))\
+            .order_by(CasbinRuleChange.id)
+
+    def _change_log_position(self):
+        db = PolicySession()
+        try:
+            last_change_id = db.query(func.max(CasbinRuleChange.id)).scalar() or 0
+            recent_ids = db.query(CasbinRuleChange.id)\
+                .filter(CasbinRuleChange.created_on >= func.now() - timedelta(seconds=settings.casbin_policy_sync_overlap))
+            return last_change_id, {change_id for (change_id,) in recent_ids}
+        finally:
+            db.close()
+
+    def _reload_periodically(self):
+        while True:
+            time.sleep(settings.casbin_policy_reload_interval)
+            try:
+                self.reload()
+            except Exception:
+                logger.exception("Failed to reload the policy table.")
+
+    def reload(self):
+        """Load the full policy off to the side, then swap it in."""
+        last_change_id, seen_change_ids = self._change_log_position()
+        enforcer = init_enforcer()
+        with self._sync_lock:
+            with self._wl:
+                self._e = enforcer
+            # Changes committed since the position was read get replayed onto
+            # the new policy by the next sync.
+            self.last_change_id = last_change_id
+            self.seen_change_ids = seen_change_ids
+
+    def sync(self):
+        now = time.monotonic()
+        if now - self.last_sync < settings.casbin_policy_sync_interval:
+            return
+
+        # Requests don't queue up behind a sync that is already under way.
+        if not self._sync_lock.acquire(blocking=False):
+            return
+        try:
+            if now - self.last_sync < settings.casbin_policy_sync_interval:
+                return
+
+            db = PolicySession()
+            try:
+                recent_changes = self._recent_changes(db).all()
+            finally:
+                db.close()
+
+            changes = [change for change in recent_changes if change.id not in self.seen_change_ids]
+            if changes:
+                # Adding a rule twice or removing a missing one does nothing, so
+                # replaying our own edits is harmless. Changes are replayed in id
+                # order, which racing edits to the same rule may have committed
+                # in a different order; the next full reload settles those.
+                with self._wl:
+                    model = self._e.get_model()
+                    for change in changes:
+                        sec = change.ptype[0]
+                        if change.operation == 'add':
+                            model.add_policy(sec, change.ptype, change.values)
+                        else:
+                            model.remove_filtered_policy(sec, change.ptype, change.field_index, *change.values)
+                    if any(change.ptype.startswith('g') for change in changes):
+                        self._e.build_role_links()
+                logger.info(f"Applied {len(changes)} policy changes (up to {recent_changes[-1].id}).")
+            if recent_changes:
+                self.last_change_id = max(self.last_change_id, recent_changes[-1].id)
+            # Changes older than the overlap are not read again, so forget them.
+            self.seen_change_ids = {change.id for change in recent_changes}
+            self.last_sync = now
+        finally:
+            self._sync_lock.release()
+
+shared_enforcer: Optional[SharedEnforcer] = None
+shared_enforcer_lock = threading.Lock()
+
 def init_enforcer():
-    casbin_adapter = casbin_sqlalchemy_adapter.Adapter(settings.casbin_database_uri)
+    casbin_adapter = PolicyAdapter(casbin_engine)
     return casbin.Enforcer(settings.casbin_model, casbin_adapter)
 
+def get_shared_enforcer() -> SharedEnforcer:
+    global shared_enforcer
+    if shared_enforcer is None:
+        with shared_enforcer_lock:
+            if shared_enforcer is None:
+                PolicyBase.metadata.create_all(casbin_engine)
+                shared_enforcer = SharedEnforcer()
+                create_casbin_rule_index()
+                return shared_enforcer
+    shared_enforcer.sync()
+    return shared_enforcer
+
 def get_enforcer():
-    casbin_enforcer = init_enforcer()
-    yield casbin_enforcer
-    # try:
-    #     yield casbin_enforcer
-    # finally:
-    #     casbin_enforcer.close()
+    with phase('enforcer'):
+        return get_shared_enforcer()
 
 
 # CASBIN Helpers --------------------------------------------------------------
 
+def filter_args(*field_values):
+    """Trim blank (wildcard) fields so the adapter can match the rest exactly."""
+    field_values = list(field_values)
+    field_index = 0
+    while field_values and field_values[0] == '':
+        field_values.pop(0)
+        field_index += 1
+    while field_values and field_values[-1] == '':
+        field_values.pop()
+    return field_index, field_values
+
 # TODO: Support multi-tenant mode (teams)
 def check_access(enforcer: casbin.Enforcer, user, path, method):
     if enforcer is None:
-        enforcer = init_enforcer()
-    return enforcer.enforce(user, path, method)
+        enforcer = get_shared_enforcer()
+    with phase('enforcer'):
+        allowed = enforcer.enforce(user, path, method)
+    enforcer_checks.inc(method, 'allowed' if allowed else 'denied')
+    return allowed
 
 def add_policy(enforcer: casbin.Enforcer, user, path, method):
     if enforcer is None:
-        enforcer = init_enforcer()
-    return enforcer.add_permission_for_user(user, path, method)
+        enforcer = get_shared_enforcer()
+    added = enforcer.add_permission_for_user(user, path, method)
+    if added:
+        record_policy_change_or_log('add', 'p', 0, [user, path, method])
+    return added
 
 def delete_policy(enforcer: casbin.Enforcer, user='', path='', method=''):
     if enforcer is None:
-        enforcer = init_enforcer()
-    return enforcer.remove_filtered_policy(0, user, path, method)
+        enforcer = get_shared_enforcer()
+    field_index, field_values = filter_args(user, path, method)
+    if not field_values:
+        return False
+    removed = enforcer.remove_filtered_policy(field_index, *field_values)
+    if removed:
+        record_policy_change_or_log('remove', 'p', field_index, field_values)
+    return removed
+
+def access_filter(enforcer: casbin.Enforcer, user, path_prefix, column, method='GET'):
+    """Build a SQL clause limiting `column` to the ids `user` may access.
+
+    Mirrors the matcher in casbinmodel.conf (direct, role or "*" subject,
+    keyMatch on `path_prefix + id`, regexMatch on the method) so that list
+    queries only return authorized rows instead of calling `check_access`
+    once per row.
+    """
+    if enforcer is None:
+        enforcer = get_shared_enforcer()
+    subjects = [user, '*', *enforcer.get_implicit_roles_for_user(user)]
+    clauses = []
+
+    db = PolicySession()
+    try:
+        # Wildcard rules are rare, so match those in python the way keyMatch does.
+        wildcard_rules = db.query(CasbinRule.v1, CasbinRule.v2)\
+            .filter(CasbinRule.ptype == 'p')\
+            .filter(CasbinRule.v0.in_(subjects))\
+            .filter(CasbinRule.v1.contains('*'))
+        for obj, act in wildcard_rules:
+            if not re.match(act, method):
+                continue
+            obj_prefix = obj[:obj.index('*')]
+            if path_prefix.startswith(obj_prefix):
+                return true()
+            if obj_prefix.startswith(path_prefix):
+                clauses.append(cast(column, String).startswith(obj_prefix[len(path_prefix):], autoescape=True))
+
+        id_pattern = f"^{re.escape(path_prefix)}{'[0-9]+' if isinstance(column.type, Integer) else '[^*]+'}$"
+        rule_ids = db.query(cast(case([(CasbinRule.v1.op('~', is_comparison=True)(id_pattern), func.substr(CasbinRule.v1, len(path_prefix) + 1))]), column.type))\
+            .filter(CasbinRule.ptype == 'p')\
+            .filter(CasbinRule.v0.in_(subjects))\
+            .filter(CasbinRule.v1.op('~', is_comparison=True)(id_pattern))\
+            .filter(cast(literal(method), String).op('~', is_comparison=True)(('^(?:' + CasbinRule.v2 + ')').self_group()))
+        if casbin_engine is engine:
+            clauses.append(column.in_(rule_ids.subquery()))
+        else:
+            clauses.append(column.in_([rule_id for (rule_id,) in rule_ids]))
+    finally:
+        db.close()
+
+    return or_(*clauses)
 
 def get_policies(enforcer: casbin.Enforcer, user='', path='', method=''):
     if enforcer is None:
-        enforcer = init_enforcer()
+        enforcer = get_shared_enforcer()
     rules = enforcer.get_filtered_policy(0, user, path, method)
     # TODO: Make sure the /protocol/* cases are handled properly.
     return [{'user': rule[0], 'path': rule[1], 'method': rule[2]} for rule in rules]
 
 def get_roles(enforcer: casbin.Enforcer, user):
     if enforcer is None:
-        enforcer = init_enforcer()
+        enforcer = get_shared_enforcer()
     return enforcer.get_roles_for_user(user)
 
 def get_all_roles(enforcer: casbin.Enforcer):
     if enforcer is None:
-        enforcer = init_enforcer()
+        enforcer = get_shared_enforcer()
     return enforcer.get_all_roles()
@@ -0,0 +1,99 @@
+"""Measure a running server's throughput under a mix of slow and fast requests.
+
+Slow clients keep expensive requests (e.g. a large run's CSV export) in
+flight while fast clients hit a cheap endpoint. A server that blocks its
+event loop on database work serializes everything behind the slow requests,
+which shows up as fast request latencies close to the slow ones.
+
+    python concurrency_benchmark.py --token $TOKEN --slow /run/1/sample.csv
+"""
+
+import argparse
+import statistics
+import threading
+import time
+import urllib.error
+import urllib.request
+from typing import List, Optional
+
+
+class Results:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+
+    def record(self, kind: str, latency: float, ok: bool):
+        with self.lock:
+            if ok:
+                self.latencies.setdefault(kind, []).append(latency)
+            else:
+                self.errors[kind] = self.errors.get(kind, 0) + 1
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def request(url: str, token: Optional[str]) -> bool:
+    headers = {'Authorization': f"Bearer {token}"} if token else {}
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, headers=headers)) as response:
+            response.read()
+            return response.status < 400
+    except (urllib.error.URLError, OSError):
+        return False
+
+def client(results: Results, kind: str, url: str, token: Optional[str], deadline: float):
+    while time.monotonic() < deadline:
+        start = time.perf_counter()
+        ok = request(url, token)
+        results.record(kind, time.perf_counter() - start, ok)
+
+def run_benchmark(base_url: str, token: Optional[str], slow_path: str, fast_path: str, slow_clients: int, fast_clients: int, duration: float) -> Results:
+    results = Results()
+    deadline = time.monotonic() + duration
+    threads = [
+        threading.Thread(target=client, args=(results, kind, base_url.rstrip('/') + path, token, deadline))
+        for kind, path, count
+        in (('slow', slow_path, slow_clients), ('fast', fast_path, fast_clients))
+        for _ in range(count)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+def print_results(results: Results, duration: float):
+    print(f"{'kind':<6}{'requests':>10}{'errors':>8}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}")
+    for kind in ('slow', 'fast'):
+        latencies = results.latencies.get(kind, [])
+        errors = results.errors.get(kind, 0)
+        if not latencies:
+            print(f"{kind:<6}{0:>10}{errors:>8}")
+            continue
+        print(
+            f"{kind:<6}{len(latencies):>10}{errors:>8}{len(latencies) / duration:>9.1f}"
+            f"{statistics.median(latencies) * 1000:>9.1f}"
+            f"{percentile(latencies, 0.95) * 1000:>9.1f}"
+            f"{percentile(latencies, 0.99) * 1000:>9.1f}"
+            f"{max(latencies) * 1000:>9.1f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', default='http://localhost:5000', help='Server base url.')
+    parser.add_argument('--token', help='Bearer token sent with every request.')
+    parser.add_argument('--slow', required=True, help='Path of the slow request, e.g. /run/1/sample.csv')
+    parser.add_argument('--fast', default='/health', help='Path of the fast request.')
+    parser.add_argument('--slow-clients', type=int, default=4)
+    parser.add_argument('--fast-clients', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=10.0, help='Seconds to run for.')
+    args = parser.parse_args()
+
+    print_results(
+        run_benchmark(args.url, args.token, args.slow, args.fast, args.slow_clients, args.fast_clients, args.duration),
+        args.duration,
+    )
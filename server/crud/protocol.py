@@ -1,22 +1,24 @@
 import casbin
+from sqlalchemy import and_, join, select
 from sqlalchemy.orm import Session, Query
 from typing import Optional, List
-from functools import reduce
 from fastapi import HTTPException
 
-from authorization import check_access
+from authorization import access_filter, check_access
 from server import Auth0ClaimsPatched
 from database import (
-    filter_by_plate_label,
-    filter_by_reagent_label,
-    filter_by_sample_label,
+    filter_by_plate_label_filter,
+    filter_by_reagent_label_filter,
+    filter_by_sample_label_filter,
     Protocol,
     ProtocolVersion,
+    QueryFilters,
     Run,
-    RunVersion,
     fix_plate_markers_protocol,
+    load_audit_users,
+    versioned_row_load_options,
 )
-from api.utils import paginatify
+from api.utils import paginatify, query_etag, version_etag
 
 
 def all_protocols(db: Session, include_archived=False) -> Query:
@@ -26,12 +28,15 @@ def all_protocols(db: Session, include_archived=False) -> Query:
     return query
 
 
-def crud_get_protocols(
-    item_to_dict,
+def protocol_runs_filter(*run_filters):
+    """Match protocols with a run (of any of their versions) passing `run_filters`."""
+    protocol_ids = select([ProtocolVersion.protocol_id])\
+        .select_from(join(ProtocolVersion, Run, Run.protocol_version_id == ProtocolVersion.id))\
+        .where(and_(*run_filters))
+    return Protocol.id.in_(protocol_ids)
 
-    enforcer: casbin.Enforcer,
+def filter_protocols(
     db: Session,
-    current_user: Auth0ClaimsPatched,
 
     protocol: Optional[int] = None,
     run: Optional[int] = None,
@@ -40,70 +45,142 @@ def crud_get_protocols(
     sample: Optional[str] = None,
     creator: Optional[str] = None,
     archived: Optional[bool] = None,
-    page: Optional[int] = None,
-    per_page: Optional[int] = None,
-) -> List[dict]:
-    protocols_queries = []
+) -> Query:
+    # Run based filters are semi-joins, so (like the per-filter queries they
+    # replace) each one may be satisfied by a different run.
+    filters = QueryFilters()
     if protocol:
-        protocols_queries.append(
-            all_protocols(db, archived)\
-                .filter(Protocol.id == protocol)
-        )
+        filters.filter(Protocol.id == protocol)
     if run:
-        protocols_queries.append(
-            all_protocols(db, archived)\
-                .join(ProtocolVersion, ProtocolVersion.protocol_id == Protocol.id)\
-                .join(Run, Run.protocol_version_id == ProtocolVersion.id)\
-                .filter(Run.id == run)
-        )
+        filters.filter(protocol_runs_filter(Run.id == run))
     if plate:
-        run_version_query = all_protocols(db, archived)\
-            .join(ProtocolVersion, ProtocolVersion.protocol_id == Protocol.id)\
-            .join(Run, Run.protocol_version_id == ProtocolVersion.id)\
-            .join(RunVersion, RunVersion.id == Run.version_id)
-        protocols_subquery = filter_by_plate_label(run_version_query, plate)
-        protocols_queries.append(protocols_subquery)
+        filters.filter(protocol_runs_filter(filter_by_plate_label_filter(plate, Run.version_id)))
     if reagent:
-        run_version_query = all_protocols(db, archived)\
-            .join(ProtocolVersion, ProtocolVersion.protocol_id == Protocol.id)\
-            .join(Run, Run.protocol_version_id == ProtocolVersion.id)\
-            .join(RunVersion, RunVersion.id == Run.version_id)
-        protocols_subquery = filter_by_reagent_label(run_version_query, reagent)
-        protocols_queries.append(protocols_subquery)
+        filters.filter(protocol_runs_filter(filter_by_reagent_label_filter(reagent, ProtocolVersion.id)))
     if sample:
-        run_version_query = all_protocols(db, archived)\
-            .join(ProtocolVersion, ProtocolVersion.protocol_id == Protocol.id)\
-            .join(Run, Run.protocol_version_id == ProtocolVersion.id)\
-            .join(RunVersion, RunVersion.id == Run.version_id)
-        protocols_subquery = filter_by_sample_label(run_version_query, sample)
-        protocols_queries.append(protocols_subquery)
+        filters.filter(protocol_runs_filter(filter_by_sample_label_filter(sample, Run.version_id)))
     if creator:
-        protocols_queries.append(
-            all_protocols(db, archived)\
-                # .filter(Protocol.id == protocol)\
-                .filter(Protocol.created_by == creator)
-        )
+        filters.filter(Protocol.created_by == creator)
+    return filters.apply(all_protocols(db, archived))
 
-    # Add a basic non-deleted items query if no filters were specified.
-    if len(protocols_queries) == 0:
-        protocols_queries.append(all_protocols(db, archived))
+def authorized_protocols(
+    enforcer: casbin.Enforcer,
+    db: Session,
+    current_user: Auth0ClaimsPatched,
 
-    # Only return the intersection of all queries.
-    protocols_query = reduce(lambda a, b: a.intersect(b), protocols_queries)
+    protocol: Optional[int] = None,
+    run: Optional[int] = None,
+    plate: Optional[str] = None,
+    reagent: Optional[str] = None,
+    sample: Optional[str] = None,
+    creator: Optional[str] = None,
+    archived: Optional[bool] = None,
+) -> Query:
+    return filter_protocols(
+        db,
+        protocol=protocol,
+        run=run,
+        plate=plate,
+        reagent=reagent,
+        sample=sample,
+        creator=creator,
+        archived=archived,
+    )\
+        .filter(access_filter(enforcer, user=current_user.username, path_prefix='/protocol/', column=Protocol.id, method='GET'))\
+        .filter(Protocol.version_id != None)
+
+def crud_get_protocols_etag(
+    enforcer: casbin.Enforcer,
+    db: Session,
+    current_user: Auth0ClaimsPatched,
+
+    protocol: Optional[int] = None,
+    run: Optional[int] = None,
+    plate: Optional[str] = None,
+    reagent: Optional[str] = None,
+    sample: Optional[str] = None,
+    creator: Optional[str] = None,
+    archived: Optional[bool] = None,
+) -> str:
+    protocols_query = authorized_protocols(
+        enforcer,
+        db,
+        current_user,
+        protocol=protocol,
+        run=run,
+        plate=plate,
+        reagent=reagent,
+        sample=sample,
+        creator=creator,
+        archived=archived,
+    )
+    return query_etag('protocols', protocols_query, Protocol.version_id)
+
+def crud_get_protocols(
+    item_to_dict,
+
+    enforcer: casbin.Enforcer,
+    db: Session,
+    current_user: Auth0ClaimsPatched,
+
+    protocol: Optional[int] = None,
+    run: Optional[int] = None,
+    plate: Optional[str] = None,
+    reagent: Optional[str] = None,
+    sample: Optional[str] = None,
+    creator: Optional[str] = None,
+    archived: Optional[bool] = None,
+    page: Optional[int] = None,
+    per_page: Optional[int] = None,
+    after: Optional[str] = None,
+    before: Optional[str] = None,
+    fields: Optional[List[str]] = None,
+) -> List[dict]:
+    protocols_query = authorized_protocols(
+        enforcer,
+        db,
+        current_user,
+        protocol=protocol,
+        run=run,
+        plate=plate,
+        reagent=reagent,
+        sample=sample,
+        creator=creator,
+        archived=archived,
+    )\
+        .options(*versioned_row_load_options(Protocol, ProtocolVersion, fields))
 
     return paginatify(
         items_label='protocols',
-        items=[
-            protocol
-            for protocol
-            in protocols_query.distinct().order_by(Protocol.created_on.desc())
-            if check_access(enforcer, user=current_user.username, path=f"/protocol/{str(protocol.id)}", method="GET") and protocol and protocol.current
-        ],
-        item_to_dict=lambda protocol: item_to_dict(fix_plate_markers_protocol(db, protocol)),
+        items=protocols_query.order_by(Protocol.created_on.desc(), Protocol.id.desc()),
+        item_to_dict=lambda protocol: item_to_dict(fix_plate_markers_protocol(db, protocol, fields)),
+        prefetch=lambda protocols: load_audit_users(db, [(protocol, protocol.current) for protocol in protocols]),
         page=page,
         per_page=per_page,
+        after=after,
+        before=before,
+        cursor_columns=(Protocol.created_on, Protocol.id),
     )
 
+def crud_get_protocol_etag(
+    enforcer: casbin.Enforcer,
+    db: Session,
+    current_user: Auth0ClaimsPatched,
+
+    protocol_id: int,
+) -> Optional[str]:
+    """ETag for `GET /protocol/{protocol_id}`, from one primary key lookup."""
+    if not check_access(enforcer, user=current_user.username, path=f"/protocol/{str(protocol_id)}", method="GET"):
+        raise HTTPException(status_code=403, detail='Insufficient Permissions')
+
+    versions = db.query(Protocol.version_id)\
+        .filter(Protocol.id == protocol_id)\
+        .filter(Protocol.is_deleted != True)\
+        .first()
+    if not versions:
+        return None
+    return version_etag('protocol', *versions)
+
 def crud_get_protocol(
     item_to_dict,
 
@@ -113,6 +190,7 @@ def crud_get_protocol(
 
     protocol_id: int,
     version_id: Optional[int] = None,
+    fields: Optional[List[str]] = None,
 ) -> dict:
     if not check_access(enforcer, user=current_user.username, path=f"/protocol/{str(protocol_id)}", method="GET"):
         raise HTTPException(status_code=403, detail='Insufficient Permissions')
@@ -126,7 +204,7 @@ def crud_get_protocol(
             raise HTTPException(status_code=404, detail='Protocol Not Found')
         return item_to_dict(protocol_version.protocol)
 
-    protocol = db.query(Protocol).get(protocol_id)
+    protocol = db.query(Protocol).options(*versioned_row_load_options(Protocol, ProtocolVersion, fields)).get(protocol_id)
     if (not protocol) or protocol.is_deleted:
         raise HTTPException(status_code=404, detail='Protocol Not Found')
-    return item_to_dict(fix_plate_markers_protocol(db, protocol))
+    return item_to_dict(fix_plate_markers_protocol(db, protocol, fields))
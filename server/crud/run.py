@@ -1,22 +1,27 @@
 import casbin
 from sqlalchemy.orm import Session, Query
 from typing import Optional, List
-from functools import reduce
 from fastapi import HTTPException
 
-from authorization import check_access
+from authorization import access_filter, check_access
 from server import Auth0ClaimsPatched
 from database import (
-    filter_by_plate_label,
-    filter_by_reagent_label,
-    filter_by_sample_label,
+    filter_by_plate_label_filter,
+    filter_by_reagent_label_filter,
+    filter_by_sample_label_filter,
     ProtocolVersion,
+    QueryFilters,
     Run,
     RunVersion,
     Sample,
     fix_plate_markers_run,
+    load_audit_users,
+    run_audit_rows,
+    run_load_options,
+    run_samples_filter,
+    sample_load_options,
 )
-from api.utils import paginatify
+from api.utils import paginatify, query_etag, version_etag
 
 
 def all_runs(db: Session, include_archived=False) -> Query:
@@ -27,18 +32,14 @@ def all_runs(db: Session, include_archived=False) -> Query:
 
 def all_samples(db: Session, run: Run, include_archived=False) -> Query:
     query = db.query(Sample)\
-        .filter(Sample.run_version_id == run.version_id)
+        .filter(run_samples_filter(run.version_id))
     if not include_archived:
         query = query\
             .filter(Sample.is_deleted != True)
     return query
 
-def crud_get_runs(
-    item_to_dict,
-
-    enforcer: casbin.Enforcer,
+def filter_runs(
     db: Session,
-    current_user: Auth0ClaimsPatched,
 
     protocol: Optional[int] = None,
     run: Optional[int] = None,
@@ -47,65 +48,141 @@ def crud_get_runs(
     sample: Optional[str] = None,
     creator: Optional[str] = None,
     archived: Optional[bool] = None,
-    page: Optional[int] = None,
-    per_page: Optional[int] = None,
-) -> List[dict]:
-    runs_queries = []
-
-    # Add filter specific queries. These will be intersected later on.
+) -> Query:
+    filters = QueryFilters()
     if protocol:
-        runs_queries.append(
-            all_runs(db, archived)\
-                .join(ProtocolVersion, ProtocolVersion.id == Run.protocol_version_id)\
-                .filter(ProtocolVersion.protocol_id == protocol)
-        )
+        filters.join(ProtocolVersion, ProtocolVersion.id == Run.protocol_version_id)
+        filters.filter(ProtocolVersion.protocol_id == protocol)
     if run:
-        runs_queries.append(
-            all_runs(db, archived)\
-                .filter(Run.id == run)
-        )
+        filters.filter(Run.id == run)
     if plate:
-        run_version_query = all_runs(db, archived)\
-            .join(RunVersion, RunVersion.id == Run.version_id)
-        runs_subquery = filter_by_plate_label(run_version_query, plate)
-        runs_queries.append(runs_subquery)
+        filters.filter(filter_by_plate_label_filter(plate, Run.version_id))
     if reagent:
-        run_version_query = all_runs(db, archived)\
-            .join(RunVersion, RunVersion.id == Run.version_id)
-        runs_subquery = filter_by_reagent_label(run_version_query, reagent)
-        runs_queries.append(runs_subquery)
+        filters.filter(filter_by_reagent_label_filter(reagent, Run.protocol_version_id))
     if sample:
-        run_version_query = all_runs(db, archived)\
-            .join(RunVersion, RunVersion.id == Run.version_id)
-        runs_subquery = filter_by_sample_label(run_version_query, sample)
-        runs_queries.append(runs_subquery)
+        filters.filter(filter_by_sample_label_filter(sample, Run.version_id))
     if creator:
-        runs_queries.append(
-            all_runs(db, archived)\
-                # .filter(Run.id == run)
-                .filter(Run.created_by == creator)
-        )
+        filters.filter(Run.created_by == creator)
+    return filters.apply(all_runs(db, archived))
+
+def authorized_runs(
+    enforcer: casbin.Enforcer,
+    db: Session,
+    current_user: Auth0ClaimsPatched,
+
+    protocol: Optional[int] = None,
+    run: Optional[int] = None,
+    plate: Optional[str] = None,
+    reagent: Optional[str] = None,
+    sample: Optional[str] = None,
+    creator: Optional[str] = None,
+    archived: Optional[bool] = None,
+) -> Query:
+    return filter_runs(
+        db,
+        protocol=protocol,
+        run=run,
+        plate=plate,
+        reagent=reagent,
+        sample=sample,
+        creator=creator,
+        archived=archived,
+    )\
+        .filter(access_filter(enforcer, user=current_user.username, path_prefix='/run/', column=Run.id, method='GET'))\
+        .filter(Run.version_id != None)
+
+def crud_get_runs_etag(
+    enforcer: casbin.Enforcer,
+    db: Session,
+    current_user: Auth0ClaimsPatched,
+
+    protocol: Optional[int] = None,
+    run: Optional[int] = None,
+    plate: Optional[str] = None,
+    reagent: Optional[str] = None,
+    sample: Optional[str] = None,
+    creator: Optional[str] = None,
+    archived: Optional[bool] = None,
+) -> str:
+    runs_query = authorized_runs(
+        enforcer,
+        db,
+        current_user,
+        protocol=protocol,
+        run=run,
+        plate=plate,
+        reagent=reagent,
+        sample=sample,
+        creator=creator,
+        archived=archived,
+    )
+    return query_etag('runs', runs_query, Run.version_id, Run.protocol_version_id)
+
+def crud_get_runs(
+    item_to_dict,
 
-    # Add a basic non-deleted items query if no filters were specified.
-    if len(runs_queries) == 0:
-        runs_queries.append(all_runs(db, archived))
+    enforcer: casbin.Enforcer,
+    db: Session,
+    current_user: Auth0ClaimsPatched,
 
-    # Only return the intersection of all queries.
-    runs_query = reduce(lambda a, b: a.intersect(b), runs_queries)
+    protocol: Optional[int] = None,
+    run: Optional[int] = None,
+    plate: Optional[str] = None,
+    reagent: Optional[str] = None,
+    sample: Optional[str] = None,
+    creator: Optional[str] = None,
+    archived: Optional[bool] = None,
+    page: Optional[int] = None,
+    per_page: Optional[int] = None,
+    after: Optional[str] = None,
+    before: Optional[str] = None,
+    fields: Optional[List[str]] = None,
+) -> List[dict]:
+    runs_query = authorized_runs(
+        enforcer,
+        db,
+        current_user,
+        protocol=protocol,
+        run=run,
+        plate=plate,
+        reagent=reagent,
+        sample=sample,
+        creator=creator,
+        archived=archived,
+    )\
+        .options(*run_load_options(fields))
 
     return paginatify(
         items_label='runs',
-        items=[
-            run
-            for run
-            in runs_query.distinct().order_by(Run.created_on.desc())
-            if check_access(enforcer, user=current_user.username, path=f"/run/{str(run.id)}", method="GET") and run and run.current
-        ],
-        item_to_dict=lambda run: item_to_dict(fix_plate_markers_run(db, run)),
+        items=runs_query.order_by(Run.created_on.desc(), Run.id.desc()),
+        item_to_dict=lambda run: item_to_dict(fix_plate_markers_run(db, run, fields)),
+        prefetch=lambda runs: load_audit_users(db, run_audit_rows(runs, include_protocols=fields is None or 'protocol' in fields)),
         page=page,
         per_page=per_page,
+        after=after,
+        before=before,
+        cursor_columns=(Run.created_on, Run.id),
     )
 
+def crud_get_run_etag(
+    enforcer: casbin.Enforcer,
+    db: Session,
+    current_user: Auth0ClaimsPatched,
+
+    run_id: int,
+) -> Optional[str]:
+    """ETag for `GET /run/{run_id}`, from one primary key lookup."""
+    if not check_access(enforcer, user=current_user.username, path=f"/run/{str(run_id)}", method="GET"):
+        raise HTTPException(status_code=403, detail='Insufficient Permissions')
+
+    versions = db.query(Run.version_id, Run.protocol_version_id)\
+        .filter(Run.id == run_id)\
+        .filter(Run.is_deleted != True)\
+        .first()
+    if not versions:
+        return None
+    return version_etag('run', *versions)
+
 def crud_get_run(
     item_to_dict,
 
@@ -115,6 +192,7 @@ def crud_get_run(
 
     run_id: int,
     version_id: Optional[int] = None,
+    fields: Optional[List[str]] = None,
 ) -> dict:
     if not check_access(enforcer, user=current_user.username, path=f"/run/{str(run_id)}", method="GET"):
         raise HTTPException(status_code=403, detail='Insufficient Permissions')
@@ -128,12 +206,34 @@ def crud_get_run(
             raise HTTPException(status_code=404, detail='Run Not Found')
         return item_to_dict(run_version.run)
     
-    run = db.query(Run).get(run_id)
+    run = db.query(Run).options(*run_load_options(fields)).get(run_id)
     if (not run) or run.is_deleted:
         raise HTTPException(status_code=404, detail='Run Not Found')
 
-    return item_to_dict(fix_plate_markers_run(db, run))
+    return item_to_dict(fix_plate_markers_run(db, run, fields))
+
 
+def filter_run_samples(
+    db: Session,
+    run: Run,
+
+    protocol: Optional[int] = None,
+    plate: Optional[str] = None,
+    reagent: Optional[str] = None,
+    creator: Optional[str] = None,
+    archived: Optional[bool] = None,
+) -> Query:
+    filters = QueryFilters()
+    if protocol:
+        filters.join(ProtocolVersion, ProtocolVersion.id == Sample.protocol_version_id)
+        filters.filter(ProtocolVersion.protocol_id == protocol)
+    if plate:
+        filters.filter(Sample.plate_id == plate)
+    if reagent:
+        filters.filter(filter_by_reagent_label_filter(reagent, Sample.protocol_version_id))
+    if creator:
+        filters.filter(Sample.created_by == creator)
+    return filters.apply(all_samples(db, run, archived))
 
 def crud_get_run_samples(
     item_to_dict,
@@ -150,6 +250,8 @@ def crud_get_run_samples(
     archived: Optional[bool] = None,
     page: Optional[int] = None,
     per_page: Optional[int] = None,
+    after: Optional[str] = None,
+    before: Optional[str] = None,
 ) -> List[dict]:
     if not check_access(enforcer, user=current_user.username, path=f"/run/{str(run_id)}", method="GET"):
         raise HTTPException(status_code=403, detail='Insufficient Permissions')
@@ -157,48 +259,28 @@ def crud_get_run_samples(
     if not run or run.is_deleted:
         raise HTTPException(status_code=404, detail='Run Not Found')
 
-    samples_queries = []
-
-    # Add filter specific queries. These will be intersected later on.
-    if protocol:
-        samples_queries.append(
-            all_samples(db, run, archived)\
-                .join(ProtocolVersion, ProtocolVersion.id == Sample.protocol_version_id)\
-                .filter(ProtocolVersion.protocol_id == protocol)
-        )
-    if plate:
-        samples_queries.append(
-            all_samples(db, run, archived)\
-                .filter(Sample.plate_id == plate)
-        )
-    if reagent:
-        run_version_query = all_samples(db, run, archived)\
-            .join(RunVersion, RunVersion.id == Sample.run_version_id)
-        samples_subquery = filter_by_reagent_label(run_version_query, reagent)
-        samples_queries.append(samples_subquery)
-    if creator:
-        samples_queries.append(
-            all_samples(db, run, archived)\
-                .filter(Sample.created_by == creator)
-        )
-
-    # Add a basic non-deleted items query if no filters were specified.
-    if len(samples_queries) == 0:
-        samples_queries.append(all_samples(db, run, archived))
-
-    # Only return the intersection of all queries.
-    samples_query = reduce(lambda a, b: a.intersect(b), samples_queries)
+    samples_query = filter_run_samples(
+        db,
+        run,
+        protocol=protocol,
+        plate=plate,
+        reagent=reagent,
+        creator=creator,
+        archived=archived,
+    )\
+        .options(*sample_load_options())
 
     return paginatify(
         items_label='samples',
-        items=[
-            sample
-            for sample
-            in samples_query.distinct().order_by(Sample.sample_id.asc())
-        ],
+        items=samples_query.order_by(Sample.sample_id.asc(), Sample.plate_id.asc(), Sample.run_version_id.asc(), Sample.protocol_version_id.asc()),
         item_to_dict=item_to_dict,
+        prefetch=lambda samples: load_audit_users(db, [(sample, sample.current) for sample in samples]),
         page=page,
         per_page=per_page,
+        after=after,
+        before=before,
+        cursor_columns=(Sample.sample_id, Sample.plate_id, Sample.run_version_id, Sample.protocol_version_id),
+        descending=False,
     )
 
 def crud_get_run_sample(
@@ -218,7 +300,7 @@ def crud_get_run_sample(
     if not run or run.is_deleted:
         raise HTTPException(status_code=404, detail='Run Not Found')
     sample = db.query(Sample)\
-        .filter(Sample.run_version_id == run.version_id)\
+        .filter(run_samples_filter(run.version_id))\
         .filter(Sample.sample_id == sample_id)\
         .first()
     return item_to_dict(sample)
@@ -1,30 +1,84 @@
 import casbin
 from sqlalchemy.orm import Session, Query
 from typing import Optional, List
-from functools import reduce
 from fastapi import HTTPException
 
-from authorization import check_access
+from authorization import access_filter, check_access
 from server import Auth0ClaimsPatched
 from database import (
-    filter_by_reagent_label,
+    filter_by_reagent_label_filter,
     ProtocolVersion,
+    QueryFilters,
     Run,
     RunVersion,
     Sample,
-    SampleVersion
+    SampleVersion,
+    load_audit_users,
+    sample_load_options,
 )
 from api.utils import paginatify
 
 
 def all_samples(db: Session, include_archived=False) -> Query:
     query = db.query(Sample)\
-        .join(RunVersion, RunVersion.id == Sample.run_version_id)\
+        .join(RunVersion, RunVersion.sample_run_version_id == Sample.run_version_id)\
         .join(Run, Run.version_id == RunVersion.id)
     if not include_archived:
         query = query.filter(Sample.is_deleted != True)
     return query
 
+def filter_samples(
+    db: Session,
+
+    protocol: Optional[int] = None,
+    run: Optional[int] = None,
+    plate: Optional[str] = None,
+    reagent: Optional[str] = None,
+    sample: Optional[str] = None,
+    creator: Optional[str] = None,
+    archived: Optional[bool] = None,
+) -> Query:
+    filters = QueryFilters()
+    if protocol:
+        filters.join(ProtocolVersion, ProtocolVersion.id == Sample.protocol_version_id)
+        filters.filter(ProtocolVersion.protocol_id == protocol)
+    if run:
+        filters.filter(RunVersion.run_id == run)
+    if plate:
+        filters.filter(Sample.plate_id == plate)
+    if reagent:
+        filters.filter(filter_by_reagent_label_filter(reagent, Sample.protocol_version_id))
+    if sample:
+        filters.filter(Sample.sample_id == sample)
+    if creator:
+        filters.filter(Sample.created_by == creator)
+    return filters.apply(all_samples(db, archived))
+
+def authorized_samples(
+    enforcer: casbin.Enforcer,
+    db: Session,
+    current_user: Auth0ClaimsPatched,
+
+    protocol: Optional[int] = None,
+    run: Optional[int] = None,
+    plate: Optional[str] = None,
+    reagent: Optional[str] = None,
+    sample: Optional[str] = None,
+    creator: Optional[str] = None,
+    archived: Optional[bool] = None,
+) -> Query:
+    return filter_samples(
+        db,
+        protocol=protocol,
+        run=run,
+        plate=plate,
+        reagent=reagent,
+        sample=sample,
+        creator=creator,
+        archived=archived,
+    )\
+        .filter(access_filter(enforcer, user=current_user.username, path_prefix='/run/', column=Run.id, method='GET'))\
+        .filter(Sample.version_id != None)
 
 def crud_get_samples(
     item_to_dict,
@@ -42,61 +96,33 @@ def crud_get_samples(
     archived: Optional[bool] = None,
     page: Optional[int] = None,
     per_page: Optional[int] = None,
+    after: Optional[str] = None,
+    before: Optional[str] = None,
 ) -> List[dict]:
-    samples_queries = []
-
-    # Add filter specific queries. These will be intersected later on.
-    if protocol:
-        samples_queries.append(
-            all_samples(db, archived)\
-                .join(ProtocolVersion, ProtocolVersion.id == Sample.protocol_version_id)\
-                .filter(ProtocolVersion.protocol_id == protocol)
-        )
-    if run:
-        samples_queries.append(
-            all_samples(db, archived)\
-                # .join(RunVersion, RunVersion.id == Sample.run_version_id)\
-                .filter(RunVersion.run_id == run)
-        )
-    if plate:
-        samples_queries.append(
-            all_samples(db, archived)\
-                .filter(Sample.plate_id == plate)
-        )
-    if reagent:
-        run_version_query = all_samples(db, archived) # \
-            # .join(RunVersion, RunVersion.id == Sample.run_version_id)
-        samples_subquery = filter_by_reagent_label(run_version_query, reagent)
-        samples_queries.append(samples_subquery)
-    if sample:
-        samples_queries.append(
-            all_samples(db, archived)\
-                .filter(Sample.sample_id == sample)
-        )
-    if creator:
-        samples_queries.append(
-            all_samples(db, archived)\
-                .filter(Sample.created_by == creator)
-        )
-
-    # Add a basic non-deleted items query if no filters were specified.
-    if len(samples_queries) == 0:
-        samples_queries.append(all_samples(db, archived))
-
-    # Only return the intersection of all queries.
-    samples_query = reduce(lambda a, b: a.intersect(b), samples_queries)
+    samples_query = authorized_samples(
+        enforcer,
+        db,
+        current_user,
+        protocol=protocol,
+        run=run,
+        plate=plate,
+        reagent=reagent,
+        sample=sample,
+        creator=creator,
+        archived=archived,
+    )\
+        .options(*sample_load_options())
 
     return paginatify(
         items_label='samples',
-        items=[
-            sample
-            for sample
-            in samples_query.distinct().order_by(Sample.created_on.desc())
-            if check_access(enforcer, user=current_user.username, path=f"/run/{str(sample.run_version.run_id)}", method="GET") and sample and sample.current
-        ],
+        items=samples_query.order_by(Sample.created_on.desc(), Sample.sample_id.desc(), Sample.plate_id.desc(), Sample.run_version_id.desc(), Sample.protocol_version_id.desc()),
         item_to_dict=item_to_dict,
+        prefetch=lambda samples: load_audit_users(db, [(sample, sample.current) for sample in samples]),
         page=page,
         per_page=per_page,
+        after=after,
+        before=before,
+        cursor_columns=(Sample.created_on, Sample.sample_id, Sample.plate_id, Sample.run_version_id, Sample.protocol_version_id),
     )
 
 def crud_get_sample(
@@ -5,13 +5,15 @@ from sqlalchemy.orm import Session, Query
 from typing import Optional, List
 from fastapi import HTTPException
 
-from authorization import check_access
+from authorization import access_filter, check_access, get_roles
 from server import Auth0ClaimsPatched
 from database import (
     User,
     UserVersion,
+    load_audit_users,
+    versioned_row_load_options,
 )
-from api.utils import paginatify
+from api.utils import paginatify, query_etag, version_etag
 
 
 def all_users(db: Session, include_archived=False) -> Query:
@@ -20,6 +22,27 @@ def all_users(db: Session, include_archived=False) -> Query:
         query = query.filter(User.is_deleted != True)
     return query
 
+def authorized_users(
+    enforcer: casbin.Enforcer,
+    db: Session,
+    current_user: Auth0ClaimsPatched,
+
+    archived: Optional[bool] = None,
+) -> Query:
+    return all_users(db, archived)\
+        .filter(access_filter(enforcer, user=current_user.username, path_prefix='/user/', column=User.id, method='GET'))\
+        .filter(User.version_id != None)
+
+def crud_get_users_etag(
+    enforcer: casbin.Enforcer,
+    db: Session,
+    current_user: Auth0ClaimsPatched,
+
+    archived: Optional[bool] = None,
+) -> str:
+    # Users are listed with their roles, so role assignments count too.
+    return query_etag('users', authorized_users(enforcer, db, current_user, archived), User.version_id, extra=enforcer.get_grouping_policy())
+
 def crud_get_users(
     item_to_dict,
 
@@ -30,20 +53,43 @@ def crud_get_users(
     archived: Optional[bool] = None,
     page: Optional[int] = None,
     per_page: Optional[int] = None,
+    after: Optional[str] = None,
+    before: Optional[str] = None,
 ) -> List[dict]:
     return paginatify(
         items_label='users',
-        items=[
-            user
-            for user
-            in all_users(db, archived).order_by(User.created_on.desc())
-            if check_access(enforcer, user=current_user.username, path=f"/user/{str(user.id)}", method="GET") and user and user.current
-        ],
+        items=authorized_users(enforcer, db, current_user, archived)\
+            .options(*versioned_row_load_options(User, UserVersion))\
+            .order_by(User.created_on.desc(), User.id.desc()),
         item_to_dict=item_to_dict,
+        prefetch=lambda users: load_audit_users(db, [(user, user.current) for user in users]),
         page=page,
         per_page=per_page,
+        after=after,
+        before=before,
+        cursor_columns=(User.created_on, User.id),
     )
 
+def crud_get_user_etag(
+    enforcer: casbin.Enforcer,
+    db: Session,
+    current_user: Auth0ClaimsPatched,
+
+    user_id: str,
+) -> Optional[str]:
+    """ETag for `GET /user/{user_id}`, from one primary key lookup."""
+    user_id = urllib.parse.unquote(user_id)
+    if user_id != current_user.username and not check_access(enforcer, user=current_user.username, path=f"/user/{str(user_id)}", method="GET"):
+        raise HTTPException(status_code=403, detail='Insufficient Permissions')
+
+    versions = db.query(User.version_id)\
+        .filter(User.id == user_id)\
+        .filter(User.is_deleted != True)\
+        .first()
+    if not versions:
+        return None
+    return version_etag('user', *versions, extra=get_roles(enforcer, user_id))
+
 def crud_get_user(
     item_to_dict,
 
@@ -67,7 +113,7 @@ def crud_get_user(
             raise HTTPException(status_code=404, detail='User Not Found')
         return item_to_dict(user_version.user)
     
-    user = db.query(User).get(user_id)
+    user = db.query(User).options(*versioned_row_load_options(User, UserVersion)).get(user_id)
     if (not user) or user.is_deleted:
         raise HTTPException(status_code=404, detail='User Not Found')
 
@@ -0,0 +1,819 @@
+import asyncio
+import csv
+import io
+import itertools
+import json
+import re
+import unittest
+import unittest.mock
+
+import casbin
+import jsonpatch
+from casbin_sqlalchemy_adapter.adapter import CasbinRule
+from easy_profile import SessionProfiler
+from sqlalchemy.dialects import postgresql
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from api.export import flatten_list_or_dict, pyarrow, sample_data_columns, sample_export_chunks, samples_columnar, samples_export_types, ColumnPlan, Flattener, FlattenedRunCache, RUN_EXPORT_EXCLUDE
+from api.run import enqueue_sample_job, get_samples, run_to_dict, sample_patch_scope, save_samples, update_samples, SampleScope
+from authorization import access_filter, add_policy, delete_policy, get_enforcer, get_shared_enforcer, CasbinRuleChange, PolicySession, SharedEnforcer
+from crud.protocol import filter_protocols
+from crud.run import crud_get_runs, filter_runs, filter_run_samples
+from crud.sample import filter_samples
+from jobs import JobPool
+import main  # Registers every route on app.
+from database import Job, user_display_cache, version_data_to_dict, Protocol, ProtocolVersion, Run, RunLabelIndex, RunVersion, Sample, User, UserVersion, VersionDictCache
+from server import app, engine, get_current_user, get_db, Auth0ClaimsPatched
+from starlette.middleware.base import BaseHTTPMiddleware
+from settings import settings
+
+
+SEARCH_PARAMS = {
+    'protocol': 1,
+    'run': 2,
+    'plate': 'PLATE-1',
+    'reagent': 'R-123',
+    'sample': 'S-1',
+    'creator': 'someone',
+}
+
+
+def filter_combinations(names):
+    for count in range(len(names) + 1):
+        for combination in itertools.combinations(names, count):
+            yield {name: SEARCH_PARAMS[name] for name in combination}
+
+def compile_query(query) -> str:
+    return str(query.statement.compile(dialect=postgresql.dialect()))
+
+
+class FilterQueryPlanTest(unittest.TestCase):
+    """Every filter combination should compile to a single SELECT."""
+
+    def setUp(self):
+        self.db = Session()
+
+    def tearDown(self):
+        self.db.close()
+
+    def assertSingleSelect(self, sql: str, kwargs: dict, run_labels=True):
+        self.assertNotIn('INTERSECT', sql, kwargs)
+        self.assertNotIn('jsonb_path_match', sql, kwargs)
+        # Filters that need the same table share a single join.
+        from_clause = sql.split('\nWHERE', 1)[0]
+        for table in re.findall(r'JOIN (\w+)', from_clause):
+            self.assertEqual(len(re.findall(rf'JOIN {table}\b', from_clause)), 1, (table, kwargs))
+        if run_labels and ('plate' in kwargs or 'sample' in kwargs):
+            self.assertIn('run_label_index', sql, kwargs)
+        if 'reagent' in kwargs:
+            self.assertIn('protocol_label_index', sql, kwargs)
+
+    def test_filter_runs(self):
+        for kwargs in filter_combinations(['protocol', 'run', 'plate', 'reagent', 'sample', 'creator']):
+            self.assertSingleSelect(compile_query(filter_runs(self.db, **kwargs)), kwargs)
+
+    def test_filter_protocols(self):
+        for kwargs in filter_combinations(['protocol', 'run', 'plate', 'reagent', 'sample', 'creator']):
+            self.assertSingleSelect(compile_query(filter_protocols(self.db, **kwargs)), kwargs)
+
+    def test_filter_samples(self):
+        for kwargs in filter_combinations(['protocol', 'run', 'plate', 'reagent', 'sample', 'creator']):
+            self.assertSingleSelect(compile_query(filter_samples(self.db, **kwargs)), kwargs, run_labels=False)
+
+    def test_filter_run_samples(self):
+        run = Run(id=1, version_id=1)
+        for kwargs in filter_combinations(['protocol', 'plate', 'reagent', 'creator']):
+            self.assertSingleSelect(compile_query(filter_run_samples(self.db, run, **kwargs)), kwargs, run_labels=False)
+
+
+class VersionDictCacheTest(unittest.TestCase):
+    """Cached version dicts should match freshly built ones."""
+
+    def run_version(self, version_id: int) -> RunVersion:
+        return RunVersion(id=version_id, data={'name': f"Run {version_id}", 'sections': [{'blocks': [
+            {'type': 'plate-sampler', 'plates': [{'label': 'PLATE-1'}]},
+        ]}]})
+
+    def test_hits_and_copies(self):
+        cache = VersionDictCache(max_entries=10, max_bytes=1024 * 1024)
+        run_version = self.run_version(1)
+        for include_large_fields in (True, False):
+            for _ in range(2):
+                d = cache.data_to_dict(run_version, include_large_fields)
+                self.assertEqual(d, version_data_to_dict(run_version, include_large_fields))
+                d['id'] = 1
+        self.assertEqual(cache.stats()['misses'], 2)
+        self.assertEqual(cache.stats()['hits'], 2)
+        self.assertNotIn('id', cache.data_to_dict(run_version))
+
+    def test_nested_values_are_copies(self):
+        cache = VersionDictCache(max_entries=10, max_bytes=1024 * 1024)
+        run_version = self.run_version(1)
+        expected = version_data_to_dict(run_version)
+        for _ in range(2):
+            d = cache.data_to_dict(run_version)
+            d['sections'][0]['blocks'][0]['plates'].append({'label': 'PLATE-2'})
+            d['sections'].clear()
+        self.assertEqual(cache.data_to_dict(run_version), expected)
+        self.assertEqual(version_data_to_dict(run_version), expected)
+
+    def test_limits(self):
+        cache = VersionDictCache(max_entries=2, max_bytes=1024 * 1024)
+        for version_id in range(1, 4):
+            cache.data_to_dict(self.run_version(version_id))
+        self.assertEqual(cache.stats()['entries'], 2)
+
+        size = cache.stats()['bytes'] // 2
+        cache = VersionDictCache(max_entries=10, max_bytes=size)
+        for version_id in range(1, 4):
+            cache.data_to_dict(self.run_version(version_id))
+        self.assertEqual(cache.stats()['entries'], 1)
+        self.assertLessEqual(cache.stats()['bytes'], size)
+
+
+class SharedEnforcerTest(unittest.TestCase):
+    """Policy edits should reach the enforcers of other workers."""
+
+    SUBJECT = 'shared-enforcer-test'
+
+    @classmethod
+    def setUpClass(cls):
+        if not settings.sqlalchemy_database_uri.startswith('postgresql'):
+            raise unittest.SkipTest('Requires a migrated postgres database.')
+
+    def setUp(self):
+        sync_interval = settings.casbin_policy_sync_interval
+        settings.casbin_policy_sync_interval = 0.0
+        self.addCleanup(setattr, settings, 'casbin_policy_sync_interval', sync_interval)
+        self.enforcer = SharedEnforcer()
+        # Another worker's enforcer.
+        self.other = SharedEnforcer()
+
+    def tearDown(self):
+        db = PolicySession()
+        try:
+            db.query(CasbinRule).filter(CasbinRule.v0 == self.SUBJECT).delete(synchronize_session=False)
+            db.query(CasbinRuleChange).filter(CasbinRuleChange.v0 == self.SUBJECT).delete(synchronize_session=False)
+            db.commit()
+        finally:
+            db.close()
+
+    def allowed(self, path: str) -> bool:
+        return self.other.enforce(self.SUBJECT, path, 'GET')
+
+    def test_sync(self):
+        add_policy(self.enforcer, self.SUBJECT, '/run/1', 'GET')
+        self.assertFalse(self.allowed('/run/1'))
+        self.other.sync()
+        self.assertTrue(self.allowed('/run/1'))
+
+        delete_policy(self.enforcer, self.SUBJECT, '/run/1')
+        self.other.sync()
+        self.assertFalse(self.allowed('/run/1'))
+
+    def test_sync_out_of_order_commits(self):
+        # A change that commits after one with a higher id was replayed.
+        db = PolicySession()
+        try:
+            db.add(CasbinRuleChange(operation='add', ptype='p', field_index=0, v0=self.SUBJECT, v1='/run/1', v2='GET'))
+            db.flush()
+            add_policy(self.enforcer, self.SUBJECT, '/run/2', 'GET')
+            self.other.sync()
+            self.assertTrue(self.allowed('/run/2'))
+            self.assertFalse(self.allowed('/run/1'))
+            db.commit()
+        finally:
+            db.close()
+
+        self.other.sync()
+        self.assertTrue(self.allowed('/run/1'))
+
+    def test_reload(self):
+        # Edits made outside of the API only show up with a full reload.
+        db = PolicySession()
+        try:
+            db.add(CasbinRule(ptype='p', v0=self.SUBJECT, v1='/run/1', v2='GET'))
+            db.commit()
+        finally:
+            db.close()
+        self.other.sync()
+        self.assertFalse(self.allowed('/run/1'))
+        self.other.reload()
+        self.assertTrue(self.allowed('/run/1'))
+
+    def test_failed_write(self):
+        # Too long for casbin_rule, so the adapter's commit fails.
+        with self.assertRaises(Exception):
+            add_policy(self.enforcer, self.SUBJECT, '/run/' + 'x' * 300, 'GET')
+        self.assertTrue(add_policy(self.enforcer, self.SUBJECT, '/run/1', 'GET'))
+        self.other.sync()
+        self.assertTrue(self.allowed('/run/1'))
+
+
+class AccessFilterTest(unittest.TestCase):
+    """access_filter should allow exactly the rows the enforcer allows."""
+
+    USERS = ['access-filter-alice', 'access-filter-bob', 'access-filter-carol', 'access-filter-dave', 'access-filter-erin']
+
+    @classmethod
+    def setUpClass(cls):
+        if not settings.sqlalchemy_database_uri.startswith('postgresql'):
+            raise unittest.SkipTest('Requires a migrated postgres database.')
+
+    def setUp(self):
+        self.connection = engine.connect()
+        self.transaction = self.connection.begin()
+        self.db = Session(bind=self.connection)
+        self.runs = [Run() for _ in range(5)]
+        self.db.add_all(self.runs)
+        self.db.flush()
+        self.run_ids = [run.id for run in self.runs]
+        self.rule_ids = []
+
+    def tearDown(self):
+        self.db.close()
+        self.transaction.rollback()
+        self.connection.close()
+
+        db = PolicySession()
+        try:
+            db.query(CasbinRule).filter(CasbinRule.id.in_(self.rule_ids)).delete(synchronize_session=False)
+            db.commit()
+        finally:
+            db.close()
+
+    def add_rules(self, rules):
+        """Save `rules` to casbin_rule, returning an enforcer with just those."""
+        enforcer = casbin.Enforcer(settings.casbin_model)
+        db = PolicySession()
+        try:
+            rows = [CasbinRule(ptype=ptype, **{f"v{i}": value for i, value in enumerate(values)}) for ptype, *values in rules]
+            db.add_all(rows)
+            db.commit()
+            self.rule_ids = [row.id for row in rows]
+        finally:
+            db.close()
+        for ptype, *values in rules:
+            if ptype == 'p':
+                enforcer.add_policy(*values)
+            else:
+                enforcer.add_grouping_policy(*values)
+        return enforcer
+
+    def assertMatchesEnforcer(self, enforcer, method='GET'):
+        for user in self.USERS:
+            allowed = {run_id for run_id in self.run_ids if enforcer.enforce(user, f"/run/{run_id}", method)}
+            filtered = {run_id for (run_id,) in self.db.query(Run.id)
+                .filter(Run.id.in_(self.run_ids))
+                .filter(access_filter(enforcer, user, '/run/', Run.id, method))}
+            self.assertEqual(filtered, allowed, (user, method))
+
+    def test_access_filter(self):
+        alice, bob, carol, dave, erin = self.USERS
+        r1, r2, r3, r4, r5 = self.run_ids
+        enforcer = self.add_rules([
+            # Exact rules, with a method regex.
+            ('p', alice, f"/run/{r1}", 'GET'),
+            ('p', alice, f"/run/{r2}", 'PUT'),
+            ('p', alice, f"/run/{r3}", 'GET|PUT'),
+            # A role.
+            ('g', bob, 'access-filter-lab'),
+            ('p', 'access-filter-lab', f"/run/{r4}", 'GET'),
+            # Wildcards.
+            ('p', carol, '/run/*', 'GET'),
+            ('p', dave, f"/run/{r5}*", 'GET'),
+            ('p', '*', f"/run/{r2}", 'GET'),
+            ('p', erin, '/protocol/*', 'GET'),
+        ])
+        for method in ('GET', 'PUT'):
+            self.assertMatchesEnforcer(enforcer, method)
+            # With casbin_rule in a separate database the ids are listed instead.
+            with unittest.mock.patch('authorization.engine', None):
+                self.assertMatchesEnforcer(enforcer, method)
+
+
+class ListQueryCountTest(unittest.TestCase):
+    """A page of results should cost the same number of queries at any size."""
+
+    @classmethod
+    def setUpClass(cls):
+        if not settings.sqlalchemy_database_uri.startswith('postgresql'):
+            raise unittest.SkipTest('Requires a migrated postgres database.')
+
+    def setUp(self):
+        # Everything happens in one transaction that is rolled back afterwards.
+        self.enforcer = get_shared_enforcer()
+        self.connection = engine.connect()
+        self.transaction = self.connection.begin()
+        self.db = Session(bind=self.connection)
+        self.current_user = Auth0ClaimsPatched(sub='query-count-test')
+
+        self.user = User(id=self.current_user.username)
+        self.user.current = UserVersion(user=self.user, data={'email': 'query-count-test@example.com'})
+        self.protocol = Protocol(created_by=self.user.id)
+        self.protocol.current = ProtocolVersion(protocol=self.protocol, updated_by=self.user.id, data={'name': 'Protocol', 'sections': []})
+        self.db.add_all([self.user, self.user.current, self.protocol, self.protocol.current])
+        self.db.flush()
+
+    def tearDown(self):
+        user_display_cache.clear()
+        self.db.close()
+        self.transaction.rollback()
+        self.connection.close()
+
+    def add_runs(self, count: int):
+        for i in range(count):
+            run = Run(created_by=self.user.id, protocol_version_id=self.protocol.version_id)
+            run.current = RunVersion(run=run, updated_by=self.user.id, data={'name': f"Run {i}", 'sections': []})
+            self.db.add_all([run, run.current])
+            self.db.flush()
+            self.db.add(CasbinRule(ptype='p', v0=self.user.id, v1=f"/run/{run.id}", v2='GET'))
+        self.db.flush()
+        # Make sure nothing is served from the identity map.
+        self.db.expunge_all()
+
+    def use_app(self) -> casbin.Enforcer:
+        """Serve `app` from this test's transaction, with a local enforcer."""
+        enforcer = casbin.Enforcer(settings.casbin_model)
+        app.dependency_overrides.update({
+            get_db: lambda: self.db,
+            get_enforcer: lambda: enforcer,
+            get_current_user: lambda: self.current_user,
+        })
+        self.addCleanup(app.dependency_overrides.clear)
+        return enforcer
+
+    def asgi_get(self, path: str, headers=()) -> list:
+        """Drive the whole middleware stack, as a server would, and return the messages sent."""
+        path, _, query_string = path.partition('?')
+        messages = []
+        requests = [{'type': 'http.request', 'body': b'', 'more_body': False}]
+        async def receive():
+            if requests:
+                return requests.pop()
+            # StreamingResponse listens for the client going away meanwhile.
+            await asyncio.sleep(3600)
+        async def send(message):
+            messages.append(message)
+        scope = {
+            'type': 'http',
+            'http_version': '1.1',
+            'method': 'GET',
+            'scheme': 'http',
+            'path': path,
+            'root_path': '',
+            'query_string': query_string.encode(),
+            'headers': [(b'host', b'testserver'), *[(name.encode(), value.encode()) for name, value in headers]],
+            'client': ('testclient', 50000),
+            'server': ('testserver', 80),
+        }
+        asyncio.run(app(scope, receive, send))
+        return messages
+
+    def get(self, path: str, **headers):
+        messages = self.asgi_get(path, [(name.replace('_', '-'), value) for name, value in headers.items()])
+        response_headers = {name.decode(): value.decode() for name, value in messages[0]['headers']}
+        body = b''.join(message.get('body', b'') for message in messages[1:])
+        return messages[0]['status'], response_headers, body
+
+    def count_run_page_queries(self, per_page: int) -> int:
+        user_display_cache.clear()
+        profiler = SessionProfiler(engine)
+        with profiler:
+            runs = crud_get_runs(
+                item_to_dict=lambda run: run_to_dict(run, run.current, include_large_fields=False),
+                enforcer=self.enforcer,
+                db=self.db,
+                current_user=self.current_user,
+                page=1,
+                per_page=per_page,
+            )
+        self.assertEqual(len(runs['runs']), per_page)
+        for run in runs['runs']:
+            self.assertEqual(run['created_by'], 'query-count-test@example.com')
+            self.assertEqual(run['protocol']['updated_by'], 'query-count-test@example.com')
+        return profiler.stats['total']
+
+    def test_run_etags(self):
+        enforcer = self.use_app()
+        self.add_runs(2)
+        runs = self.db.query(Run).filter(Run.created_by == self.user.id).order_by(Run.id).all()
+        for run in runs:
+            enforcer.add_permission_for_user(self.user.id, f"/run/{run.id}", 'GET')
+
+        for path in ('/run', f"/run/{runs[0].id}"):
+            status, headers, body = self.get(path)
+            self.assertEqual(status, 200)
+            etag = headers['etag']
+            status, headers, body = self.get(path, if_none_match=etag)
+            self.assertEqual((status, headers['etag'], body), (304, etag, b''))
+            status, headers, body = self.get(path, if_none_match=f'"stale", W/{etag}')
+            self.assertEqual(status, 304)
+            status, headers, body = self.get(path, if_none_match='"stale"')
+            self.assertEqual(status, 200)
+
+        # A new version of either run changes the list's ETag, but only the
+        # edited run's own.
+        list_etag = self.get('/run')[1]['etag']
+        run_etags = [self.get(f"/run/{run.id}")[1]['etag'] for run in runs]
+        runs[1].current = RunVersion(run=runs[1], updated_by=self.user.id, data={'name': 'Run 1', 'sections': []})
+        self.db.add(runs[1].current)
+        self.db.flush()
+        self.assertEqual(self.get('/run', if_none_match=list_etag)[0], 200)
+        self.assertEqual(self.get(f"/run/{runs[0].id}", if_none_match=run_etags[0])[0], 304)
+        self.assertEqual(self.get(f"/run/{runs[1].id}", if_none_match=run_etags[1])[0], 200)
+
+        # So does gaining or losing access to a run, even an unchanged one.
+        list_etag = self.get('/run')[1]['etag']
+        run = Run(created_by=self.user.id, protocol_version_id=self.protocol.version_id)
+        run.current = RunVersion(run=run, data={'name': 'Shared run', 'sections': []})
+        self.db.add_all([run, run.current])
+        self.db.flush()
+        self.assertEqual(self.get('/run', if_none_match=list_etag)[0], 304)
+        rule = CasbinRule(ptype='p', v0=self.user.id, v1=f"/run/{run.id}", v2='GET')
+        self.db.add(rule)
+        self.db.flush()
+        status, headers, body = self.get('/run', if_none_match=list_etag)
+        self.assertEqual(status, 200)
+        self.assertIn('Shared run', body.decode())
+        list_etag = headers['etag']
+        self.db.delete(rule)
+        self.db.flush()
+        self.assertEqual(self.get('/run', if_none_match=list_etag)[0], 200)
+
+    def test_run_page_query_count(self):
+        self.add_runs(20)
+        small_page = self.count_run_page_queries(per_page=2)
+        self.db.expunge_all()
+        full_page = self.count_run_page_queries(per_page=20)
+        self.assertEqual(small_page, full_page)
+        self.assertLessEqual(full_page, 10)
+
+    def test_run_page_fields(self):
+        self.add_runs(3)
+        profiler = SessionProfiler(engine)
+        with profiler:
+            runs = crud_get_runs(
+                item_to_dict=lambda run: run_to_dict(run, run.current, include_large_fields=False, fields=['id', 'name']),
+                enforcer=self.enforcer,
+                db=self.db,
+                current_user=self.current_user,
+                fields=['id', 'name'],
+            )
+        self.assertEqual(len(runs['runs']), 3)
+        for run in runs['runs']:
+            self.assertEqual(set(run), {'id', 'name'})
+        statements = [query.statement for query in profiler.stats['call_stack']]
+        self.assertFalse(any(re.search(r'run_version\w*\.data AS', statement) for statement in statements), statements)
+        self.assertFalse(any('FROM protocol_version' in statement for statement in statements), statements)
+
+    def plates(self, count: int):
+        return [
+            {'label': f"PLATE-{plate}", 'coordinates': [
+                {'row': well // 12, 'col': well % 12, 'plateIndex': plate, 'sampleLabel': f"S-{plate}-{well}"}
+                for well in range(96)
+            ]}
+            for plate in range(count)
+        ]
+
+    def test_save_samples_statement_count(self):
+        plates = self.plates(4)
+        run = Run(created_by=self.user.id, protocol_version_id=self.protocol.version_id)
+        run.current = RunVersion(run=run, data={'sections': [{'blocks': [{'type': 'plate-sampler', 'plates': plates}]}]})
+        self.db.add_all([run, run.current])
+        samples = get_samples(run.current, self.protocol.current)
+
+        profiler = SessionProfiler(engine)
+        with profiler:
+            save_samples(self.db, samples)
+        # The run version, its labels, then the samples.
+        self.assertLessEqual(profiler.stats['total'], 4)
+
+        saved = self.db.query(Sample).filter(Sample.run_version_id == run.version_id).all()
+        self.assertEqual(len(saved), 4 * 96)
+        self.assertTrue(all(sample.current.run_version_id == run.version_id for sample in saved))
+        self.assertEqual(self.db.query(RunLabelIndex).filter(RunLabelIndex.version_id == run.version_id).count(), 4 + 4 * 96)
+
+    def test_shared_sample_sets(self):
+        run = Run(created_by=self.user.id, protocol_version_id=self.protocol.version_id)
+        self.db.add(run)
+
+        def save_version(plates) -> RunVersion:
+            previous = run.current
+            run.current = RunVersion(run=run, data={'name': 'Run', 'sections': [{'blocks': [{'type': 'plate-sampler', 'plates': plates}]}]})
+            self.db.add(run.current)
+            update_samples(self.db, run.current, previous, get_samples(run.current, self.protocol.current))
+            self.db.flush()
+            return run.current
+
+        def stored_samples() -> int:
+            return self.db.query(Sample)\
+                .join(RunVersion, RunVersion.id == Sample.run_version_id)\
+                .filter(RunVersion.run_id == run.id)\
+                .count()
+
+        plates = self.plates(2)
+        first = save_version(plates)
+        self.assertIsNone(first.sample_set_id)
+
+        # Unchanged samples are shared, not copied.
+        second = save_version(plates)
+        self.assertEqual(second.sample_set_id, first.id)
+        self.assertEqual(stored_samples(), 2 * 96)
+        self.assertEqual(filter_run_samples(self.db, run).count(), 2 * 96)
+        self.assertEqual(filter_samples(self.db, run=run.id).count(), 2 * 96)
+
+        plates[0]['coordinates'][0]['sampleLabel'] = 'S-renamed'
+        third = save_version(plates)
+        self.assertIsNone(third.sample_set_id)
+        self.assertEqual(stored_samples(), 2 * 2 * 96)
+        self.assertEqual(filter_run_samples(self.db, run).filter(Sample.sample_id == 'S-renamed').count(), 1)
+        self.assertEqual(filter_samples(self.db, run=run.id).count(), 2 * 96)
+
+    def test_incremental_samples(self):
+        run = Run(created_by=self.user.id, protocol_version_id=self.protocol.version_id)
+        run.current = RunVersion(run=run, data={'name': 'Run', 'sections': [{'blocks': [{'type': 'plate-sampler', 'plates': self.plates(2)}]}]})
+        self.db.add_all([run, run.current])
+        update_samples(self.db, run.current, None, get_samples(run.current, self.protocol.current))
+        self.db.flush()
+
+        def sample_rows():
+            return sorted(
+                (sample.sample_id, sample.plate_id, sample.current.data['plateRow'], sample.current.data['plateCol'])
+                for sample in filter_run_samples(self.db, run)
+            )
+
+        patch = [
+            {'op': 'replace', 'path': '/sections/0/blocks/0/plates/1/coordinates/5/sampleLabel', 'value': 'S-renamed'},
+            {'op': 'remove', 'path': '/sections/0/blocks/0/plates/0/coordinates/0'},
+            {'op': 'remove', 'path': '/sections/0/blocks/0/plates/0/coordinates/0'},
+        ]
+        scope = sample_patch_scope(patch, run.current.data)
+        self.assertEqual(scope.keys, {('S-1-5', 'PLATE-1'), ('S-renamed', 'PLATE-1'), ('S-0-0', 'PLATE-0'), ('S-0-1', 'PLATE-0'), ('S-0-2', 'PLATE-0')})
+
+        previous = run.current
+        run.current = RunVersion(run=run, data=jsonpatch.apply_patch(previous.data, patch))
+        self.db.add(run.current)
+        samples = get_samples(run.current, self.protocol.current, scope)
+        self.assertEqual(len(samples), 2)
+        update_samples(self.db, run.current, previous, samples, scope)
+        self.db.flush()
+
+        expected = sorted(
+            (sample.sample_id, sample.plate_id, sample.current.data['plateRow'], sample.current.data['plateCol'])
+            for sample in get_samples(run.current, self.protocol.current)
+        )
+        self.assertEqual(len(expected), 2 * 96 - 2)
+        self.assertEqual(sample_rows(), expected)
+
+        # Replacing all of a block's plates regenerates everything.
+        self.assertIsNone(sample_patch_scope([{'op': 'replace', 'path': '/sections/0/blocks/0/plates', 'value': []}], run.current.data))
+
+        # Unlabeled plates make it into job payloads too.
+        scope = SampleScope()
+        scope.keys = {('S-1', 'PLATE-0'), ('S-1', None)}
+        self.assertEqual(SampleScope.from_payload(json.loads(json.dumps(scope.to_payload()))).keys, scope.keys)
+
+    def test_signature_patch_regenerates_all_samples(self):
+        run = Run(created_by=self.user.id, protocol_version_id=self.protocol.version_id)
+        run.current = RunVersion(run=run, data={'name': 'Run', 'sections': [{'blocks': [{'type': 'plate-sampler', 'plates': self.plates(2)}]}]})
+        self.db.add_all([run, run.current])
+        update_samples(self.db, run.current, None, get_samples(run.current, self.protocol.current))
+        self.db.flush()
+
+        plate_edit = {'op': 'replace', 'path': '/sections/0/blocks/0/plates/1/coordinates/5/sampleLabel', 'value': 'S-renamed'}
+        for operation in (
+            {'op': 'add', 'path': '/sections/0/signature', 'value': 'signer'},
+            {'op': 'add', 'path': '/sections/0/witness', 'value': 'witness'},
+            {'op': 'add', 'path': '/sections/0/blocks/0/plateLot', 'value': 'LOT-1'},
+        ):
+            self.assertIsNone(sample_patch_scope([plate_edit, operation], run.current.data), operation)
+
+        patch = [plate_edit, {'op': 'add', 'path': '/sections/0/signature', 'value': 'signer'}]
+        previous = run.current
+        run.current = RunVersion(run=run, data=jsonpatch.apply_patch(previous.data, patch))
+        self.db.add(run.current)
+        scope = sample_patch_scope(patch, previous.data)
+        update_samples(self.db, run.current, previous, get_samples(run.current, self.protocol.current, scope), scope)
+        self.db.flush()
+
+        samples = filter_run_samples(self.db, run).all()
+        self.assertEqual(len(samples), 2 * 96)
+        self.assertEqual({tuple(sample.current.data['signers']) for sample in samples}, {('signer',)})
+
+    def test_sample_jobs(self):
+        pool = JobPool(lambda: Session(bind=self.connection), workers=0, poll_interval=1.0, lease=60.0, max_attempts=1)
+        run = Run(created_by=self.user.id, protocol_version_id=self.protocol.version_id)
+        self.db.add(run)
+
+        jobs = []
+        for plates in (self.plates(1), self.plates(2)):
+            previous = run.current
+            run.current = RunVersion(run=run, data={'name': 'Run', 'sections': [{'blocks': [{'type': 'plate-sampler', 'plates': plates}]}]})
+            self.db.add(run.current)
+            jobs.append(enqueue_sample_job(self.db, run.current, previous, None, created_by=self.user.id))
+        self.db.flush()
+        # Until its job is done a version shows the samples of the one before.
+        self.assertEqual(filter_run_samples(self.db, run).count(), 0)
+
+        self.assertTrue(pool.run_next())
+        self.assertTrue(pool.run_next())
+        self.assertFalse(pool.run_next())
+        self.db.expire_all()
+        self.assertEqual([job.status for job in jobs], ['done', 'done'])
+        self.assertEqual(filter_run_samples(self.db, run).count(), 2 * 96)
+
+    def job_session(self) -> Session:
+        """A session whose commits and rollbacks stay within the test's transaction."""
+        db = Session(bind=self.connection)
+        db.begin_nested()
+
+        @event.listens_for(db, 'after_transaction_end')
+        def restart_savepoint(session, transaction):
+            if transaction.nested and not transaction._parent.nested:
+                session.expire_all()
+                session.begin_nested()
+
+        return db
+
+    def test_failed_sample_job(self):
+        pool = JobPool(self.job_session, workers=0, poll_interval=1.0, lease=60.0, max_attempts=1)
+        run = Run(created_by=self.user.id, protocol_version_id=self.protocol.version_id)
+        self.db.add(run)
+
+        def save_version(plates, scope):
+            previous = run.current
+            run.current = RunVersion(run=run, data={'name': 'Run', 'sections': [{'blocks': [{'type': 'plate-sampler', 'plates': plates}]}]})
+            self.db.add(run.current)
+            job = enqueue_sample_job(self.db, run.current, previous, scope, created_by=self.user.id)
+            self.db.flush()
+            return job
+
+        save_version(self.plates(1), None)
+        self.assertTrue(pool.run_next())
+        failing = save_version(self.plates(2), None)
+        # The job's payload no longer matches the handler.
+        failing.payload = {**failing.payload, 'scope': {'keys': 1}}
+        self.db.flush()
+        self.assertTrue(pool.run_next())
+
+        self.db.expire_all()
+        self.assertEqual(failing.status, 'failed')
+        self.assertTrue(run.current.samples_error)
+        self.assertEqual(run_to_dict(run, run.current)['samples_error'], run.current.samples_error)
+        self.assertEqual(filter_run_samples(self.db, run).count(), 96)
+
+        # The next save regenerates all the samples, even with a scope.
+        save_version(self.plates(2), SampleScope())
+        self.assertTrue(pool.run_next())
+        self.db.expire_all()
+        self.assertIsNone(run.current.samples_error)
+        self.assertNotIn('samples_error', run_to_dict(run, run.current))
+        self.assertEqual(filter_run_samples(self.db, run).count(), 2 * 96)
+
+    def test_sample_export_chunks(self):
+        run = Run(created_by=self.user.id, protocol_version_id=self.protocol.version_id)
+        run.current = RunVersion(run=run, data={'name': 'Run', 'sections': [{'signature': 'sig', 'blocks': [{'type': 'plate-sampler', 'plates': self.plates(2)}]}]})
+        self.db.add_all([run, run.current])
+        update_samples(self.db, run.current, None, get_samples(run.current, self.protocol.current))
+        self.db.flush()
+
+        samples_query = filter_run_samples(self.db, run)
+        rows = [row for chunk in sample_export_chunks(self.db, samples_query, chunk_size=1000) for row in chunk]
+        chunks = list(sample_export_chunks(self.db, samples_query, chunk_size=50))
+        self.assertEqual([len(chunk) for chunk in chunks], [50, 50, 50, 42])
+        self.assertEqual([row for chunk in chunks for row in chunk], rows)
+        self.assertEqual(len(set(row[:2] for row in rows)), 2 * 96)
+
+        columns = sample_data_columns(self.db, samples_query)
+        self.assertEqual(columns, set().union(*(flatten_list_or_dict(row[4]).keys() for row in rows)))
+        self.assertIn('signers__0', columns)
+
+    def test_export_flattening(self):
+        run_dict = {
+            'id': 1,
+            'name': 'Run',
+            'sections': [{'signature': 'sig', 'blocks': [{'type': 'plate-sampler', 'plates': [{'label': 'P'}]}]}],
+            'protocol': {'name': 'Protocol'},
+        }
+        flattened_run = Flattener(RUN_EXPORT_EXCLUDE).flatten(run_dict)
+        self.assertEqual(flattened_run, {
+            'id': 1,
+            'name': 'Run',
+            'sections__0__signature': 'sig',
+            'sections__0__blocks__0__type': 'plate-sampler',
+        })
+        self.assertEqual(flatten_list_or_dict([{'a': [1, {'b': None}]}, 2], current_path='x'), {'x__0__a__0': 1, 'x__0__a__1__b': None, 'x__1': 2})
+
+        cache = FlattenedRunCache(2)
+        self.assertEqual(cache.flatten(7, run_dict), flattened_run)
+        self.assertEqual(cache.flatten(7, {**run_dict, 'name': 'Renamed'}), {**flattened_run, 'name': 'Renamed'})
+        self.assertEqual((cache.stats()['hits'], cache.stats()['misses']), (1, 1))
+
+        sample = {'sampleID': 'S', 'plateRow': 0, 'signers': ['a', 'b'], 'name': None, 'witnesses': []}
+        columns = sorted(set(flattened_run) | set(flatten_list_or_dict(sample)) | {'witnesses__0'})
+        plan = ColumnPlan(columns, set(flatten_list_or_dict(sample)) | {'witnesses__0'})
+        flattened_sample = {**flattened_run, **flatten_list_or_dict(sample)}
+        self.assertEqual(plan.row(sample, plan.run_row(flattened_run)), [flattened_sample.get(column, '') for column in columns])
+
+    def test_sample_export_streams(self):
+        run = Run(created_by=self.user.id, protocol_version_id=self.protocol.version_id)
+        run.current = RunVersion(run=run, data={'name': 'Run', 'sections': [{'blocks': [{'type': 'plate-sampler', 'plates': self.plates(2)}]}]})
+        self.db.add_all([run, run.current])
+        update_samples(self.db, run.current, None, get_samples(run.current, self.protocol.current))
+        self.db.flush()
+
+        enforcer = self.use_app()
+        enforcer.add_permission_for_user(self.current_user.username, f"/run/{run.id}", 'GET')
+        chunk_size = settings.export_chunk_size
+        settings.export_chunk_size = 50
+        self.addCleanup(setattr, settings, 'export_chunk_size', chunk_size)
+
+        messages = self.asgi_get(f"/run/{run.id}/sample.csv")
+        self.assertEqual(messages[0]['status'], 200)
+        bodies = [message for message in messages if message['type'] == 'http.response.body']
+        # A chunk of samples per message, instead of one buffered body.
+        self.assertGreaterEqual(len([body for body in bodies if body['body']]), 4)
+        self.assertTrue(all(body.get('more_body') for body in bodies[:-1]))
+        self.assertEqual(b''.join(body['body'] for body in bodies).count(b'\n'), 1 + 2 * 96)
+        self.assertFalse([middleware for middleware in app.user_middleware if issubclass(middleware.cls, BaseHTTPMiddleware)])
+
+    def test_sample_export_routes(self):
+        other_protocol = Protocol(created_by=self.user.id)
+        other_protocol.current = ProtocolVersion(protocol=other_protocol, updated_by=self.user.id, data={'name': 'Other protocol', 'sections': []})
+        self.db.add_all([other_protocol, other_protocol.current])
+        self.db.flush()
+        runs = []
+        for protocol, shared in ((self.protocol, True), (self.protocol, False), (other_protocol, True)):
+            run = Run(created_by=self.user.id, protocol_version_id=protocol.version_id)
+            run.current = RunVersion(run=run, data={'name': 'Run', 'sections': [{'blocks': [{'type': 'plate-sampler', 'plates': self.plates(1)}]}]})
+            self.db.add_all([run, run.current])
+            update_samples(self.db, run.current, None, get_samples(run.current, protocol.current))
+            self.db.flush()
+            if shared:
+                self.db.add(CasbinRule(ptype='p', v0=self.user.id, v1=f"/run/{run.id}", v2='GET'))
+            runs.append(run)
+        self.db.flush()
+
+        enforcer = self.use_app()
+        enforcer.add_permission_for_user(self.user.id, f"/protocol/{self.protocol.id}", 'GET')
+
+        def export(path):
+            status, headers, body = self.get(path)
+            self.assertEqual(status, 200)
+            self.assertTrue(headers['content-type'].startswith('text/csv'))
+            rows = list(csv.DictReader(io.StringIO(body.decode())))
+            return {int(row['runID']) for row in rows}, len(rows)
+
+        # Only samples from the runs the user can read.
+        self.assertEqual(export('/sample.csv'), ({runs[0].id, runs[2].id}, 2 * 96))
+        self.assertEqual(export(f"/sample.csv?protocol={other_protocol.id}"), ({runs[2].id}, 96))
+        self.assertEqual(export(f"/protocol/{self.protocol.id}/sample.csv"), ({runs[0].id}, 96))
+        self.assertEqual(export(f"/protocol/{self.protocol.id}/sample.csv?sample=S-0-5"), ({runs[0].id}, 1))
+
+        self.assertEqual(self.get(f"/protocol/{other_protocol.id}/sample.csv")[0], 403)
+        self.assertEqual(self.get('/sample.xml')[0], 422)
+
+    @unittest.skipIf(pyarrow is None, 'pyarrow is not installed')
+    def test_sample_export_columnar(self):
+        run = Run(created_by=self.user.id, protocol_version_id=self.protocol.version_id)
+        run.current = RunVersion(run=run, data={'name': 'Run', 'sections': [{'blocks': [{'type': 'plate-sampler', 'plates': self.plates(1)}]}]})
+        self.db.add_all([run, run.current])
+        update_samples(self.db, run.current, None, get_samples(run.current, self.protocol.current))
+        self.db.flush()
+
+        samples_query = filter_run_samples(self.db, run)
+        flattened_runs = {run.id: {'name': 'Run', 'count': 3}}
+        types, sample_columns = samples_export_types(self.db, samples_query, flattened_runs)
+        for export_format in ('arrow', 'parquet'):
+            data = b''.join(samples_columnar(sample_export_chunks(self.db, samples_query, chunk_size=50), types, sample_columns, flattened_runs, export_format))
+            if export_format == 'arrow':
+                table = pyarrow.ipc.open_file(pyarrow.BufferReader(data)).read_all()
+            else:
+                table = pyarrow.parquet.read_table(pyarrow.BufferReader(data))
+            self.assertEqual(table.num_rows, 96)
+            self.assertEqual(str(table.schema.field('plateRow').type), 'int32')
+            self.assertEqual(str(table.schema.field('runID').type), 'int64')
+            self.assertEqual(str(table.schema.field('count').type), 'int64')
+            self.assertEqual(str(table.schema.field('name').type), 'string')
+            self.assertEqual(set(table.column('runID').to_pylist()), {run.id})
+
+    def test_user_display_cache(self):
+        self.assertEqual(user_display_cache.load(self.db, [self.user.id])[self.user.id]['email'], 'query-count-test@example.com')
+
+        profiler = SessionProfiler(engine)
+        with profiler:
+            user_display_cache.load(self.db, [self.user.id])
+        self.assertEqual(profiler.stats['total'], 0)
+
+        self.user.current = UserVersion(user=self.user, data={'email': 'renamed@example.com'})
+        self.db.add(self.user.current)
+        self.db.flush()
+        self.assertEqual(user_display_cache.load(self.db, [self.user.id])[self.user.id]['email'], 'query-count-test@example.com')
+        user_display_cache.invalidate(self.user.id)
+        self.assertEqual(user_display_cache.load(self.db, [self.user.id])[self.user.id]['email'], 'renamed@example.com')
+
+
+if __name__ == '__main__':
+    unittest.main()
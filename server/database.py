@@ -1,14 +1,24 @@
 """Database models and utilities."""
 
 import copy
+import json
 import logging
 import pprint
-from sqlalchemy import or_, func, Column, Boolean, DateTime, ForeignKey, ForeignKeyConstraint, Integer, LargeBinary, String
-from sqlalchemy.orm import relationship, Session
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+from sqlalchemy import cast, event, inspect, or_, func, select, text, Column, Boolean, DateTime, ForeignKey, ForeignKeyConstraint, Index, Integer, LargeBinary, String, Text
+from sqlalchemy.orm import joinedload, query_expression, relationship, selectinload, Session
 from sqlalchemy.orm.attributes import flag_modified
 from sqlalchemy.ext.declarative import declared_attr, declarative_base
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.dialects.postgresql import JSONB
 
+from server_timing import timed
+from settings import settings
+
 
 logger = logging.getLogger(__name__)
 
@@ -49,8 +59,74 @@ def json_row_to_dict(row):
 
     return d
 
-def versioned_row_to_dict(row, row_version, include_large_fields=True):
-    """Convert a sqlalchemy row object into a plain python dictionary.
+def strip_large_fields(d):
+    """Remove samples, markers and results from a run or protocol dict, in place."""
+    if 'sections' not in d:
+        return d
+
+    for section in d['sections']:
+        if 'blocks' not in section:
+            continue
+
+        for block in section['blocks']:
+            # Remove samples
+            if block['type'] == 'plate-sampler' and 'plates' in block:
+                del block['plates']
+
+            # Remove markers
+            if block['type'] == 'end-plate-sequencer' and 'plateMarkers' in block and 'plateMarkers':
+                del block['plateMarkers']
+            if block['type'] == 'end-plate-sequencer' and 'definition' in block and 'plateMarkers' in block['definition']:
+                del block['definition']['plateMarkers']
+
+            # Remove results
+            if block['type'] == 'end-plate-sequencer' and 'plateSequencingResults' in block:
+                del block['plateSequencingResults']
+    return d
+
+def version_data_to_dict(row_version, include_large_fields=True):
+    d = copy.deepcopy(row_version.data) if row_version and row_version.data else {}
+    if not include_large_fields:
+        strip_large_fields(d)
+    return d
+
+# Fields versioned_row_to_dict reads from columns rather than version data.
+VERSION_METADATA_FIELDS = {'id', 'created_on', 'created_by', 'version_id', 'updated_on', 'updated_by', 'server_version', 'webapp_version'}
+
+def version_data_projection(version_cls, fields):
+    """A version's data trimmed down to its top level `fields` by Postgres.
+
+    Fields the data doesn't have come back as nulls.
+    """
+    pairs = []
+    for field in sorted(set(fields) - VERSION_METADATA_FIELDS):
+        pairs += [cast(field, Text), version_cls.data[field]]
+    return func.jsonb_build_object(*pairs)
+
+def projected_data_to_dict(row_version, fields, include_large_fields=True) -> dict:
+    """The `fields` of a version's data, from its projected_data if that was
+    loaded (see versioned_row_load_options) instead of the whole document.
+    """
+    if row_version is None:
+        return {}
+    if 'data' in inspect(row_version).unloaded and row_version.projected_data is not None:
+        d = {field: value for field, value in row_version.projected_data.items() if value is not None}
+    else:
+        data = row_version.data or {}
+        d = {field: data[field] for field in fields if data.get(field) is not None}
+
+    if d.get('sections') is not None:
+        # Only the sections are changed below, and not in the loaded data.
+        d['sections'] = copy.deepcopy(d['sections'])
+        fix_plate_markers_sections(d['sections'])
+        if not include_large_fields:
+            strip_large_fields(d)
+    return d
+
+@timed('serialize')
+def versioned_row_to_dict(row, row_version, include_large_fields=True, fields=None):
+    """Convert a sqlalchemy row object into a plain python dictionary, with
+    only its top level `fields` if given.
 
     Assumes that row object contains the following columns:
     - id (int)
@@ -66,35 +142,19 @@ def versioned_row_to_dict(row, row_version, include_large_fields=True):
     Args:
         row (BaseModel): The db row object
     """
-    d = copy.deepcopy(row_version.data) if row_version and row_version.data else {}
-
-    if not include_large_fields and 'sections' in d:
-        for section in d['sections']:
-            if 'blocks' not in section:
-                continue
-
-            for block in section['blocks']:
-                # Remove samples
-                if block['type'] == 'plate-sampler' and 'plates' in block:
-                    del block['plates']
-
-                # Remove markers
-                if block['type'] == 'end-plate-sequencer' and 'plateMarkers' in block and 'plateMarkers':
-                    del block['plateMarkers']
-                if block['type'] == 'end-plate-sequencer' and 'definition' in block and 'plateMarkers' in block['definition']:
-                    del block['definition']['plateMarkers']
-
-                # Remove results
-                if block['type'] == 'end-plate-sequencer' and 'plateSequencingResults' in block:
-                    del block['plateSequencingResults']
+    if fields is None:
+        d = version_dict_cache.data_to_dict(row_version, include_large_fields)
+    else:
+        d = projected_data_to_dict(row_version, fields, include_large_fields)
 
     if row.id:
         d['id'] = row.id
     if row.created_on:
         d['created_on'] = row.created_on
-    if row.owner and hasattr(row.owner, 'current'):
+    users = user_display_cache.load(Session.object_session(row), [row.created_by, row_version.updated_by])
+    if row.created_by in users:
         try:
-            d['created_by'] = row.owner.current.data["email"]
+            d['created_by'] = users[row.created_by]["email"]
         except Exception as ex:
             logging.error("Failed to get user email: %s", ex)
     if row_version.id:
@@ -105,12 +165,15 @@ def versioned_row_to_dict(row, row_version, include_large_fields=True):
         d['server_version'] = row_version.server_version
     if row_version.webapp_version:
         d['webapp_version'] = row_version.webapp_version
-    if row_version.updator and hasattr(row_version.updator, 'current'):
+    if row_version.updated_by in users:
         try:
-            d['updated_by'] = row_version.updator.current.data["email"]
+            d['updated_by'] = users[row_version.updated_by]["email"]
         except Exception as ex:
             logging.error("Failed to get user email: %s", ex)
 
+    if fields is not None:
+        for field in VERSION_METADATA_FIELDS - set(fields):
+            d.pop(field, None)
     return d
 
 def strip_metadata(model):
@@ -127,8 +190,10 @@ def strip_metadata(model):
     d.pop('updated_on', None)
     d.pop('updated_by', None)
     d.pop('server_version', None)
+    d.pop('samples_error', None)
     return d
 
+@timed('serialize')
 def run_to_sample(sample):
     d = copy.deepcopy(sample.current.data) if sample.current and sample.current.data else {}
     if sample.sample_id:
@@ -144,20 +209,70 @@ def run_to_sample(sample):
 
 # Searching -------------------------------------------------------------------
 
-def filter_by_plate_label_filter(plate_id: str):
-    return or_(
-        func.jsonb_path_match(RunVersion.data, f'exists($.sections[*].blocks[*].plateLabels[*] ? (@ like_regex "{plate_id}"))'),
-        func.jsonb_path_match(RunVersion.data, f'exists($.sections[*].blocks[*].plates[*].label ? (@ like_regex "{plate_id}"))'),
-        func.jsonb_path_match(RunVersion.data, f'exists($.sections[*].blocks[*].plateLabel ? (@ like_regex "{plate_id}"))'),
-    )
-
-def filter_by_reagent_label_filter(reagent_id: str):
-    return func.jsonb_path_match(ProtocolVersion.data, f'exists($.sections[*].blocks[*].reagentLabel ? (@ like_regex "{reagent_id}"))')
+# Label kinds stored in run_label_index/protocol_label_index, along with the
+# (lax) json paths they are extracted from.
+RUN_LABEL_PATHS = {
+    'plate': [
+        ('sections', 'blocks', 'plateLabels'),
+        ('sections', 'blocks', 'plates', 'label'),
+        ('sections', 'blocks', 'plateLabel'),
+    ],
+    'sample': [
+        ('sections', 'blocks', 'plates', 'coordinates', 'sampleLabel'),
+    ],
+}
+PROTOCOL_LABEL_PATHS = {
+    'reagent': [
+        ('sections', 'blocks', 'reagentLabel'),
+    ],
+}
+
+def json_path_strings(data, path):
+    """Yield the strings found at `path`, unwrapping arrays like jsonpath's lax mode."""
+    values = [data]
+    for key in path:
+        values = [
+            item[key]
+            for value in values
+            for item in (value if isinstance(value, list) else [value])
+            if isinstance(item, dict) and key in item
+        ]
+    for value in values:
+        for item in (value if isinstance(value, list) else [value]):
+            if isinstance(item, str):
+                yield item
+
+def extract_labels(data, label_paths):
+    return {
+        (label_kind, label)
+        for label_kind, paths in label_paths.items()
+        for path in paths
+        for label in json_path_strings(data, path)
+    }
+
+def label_index_filter(label_index, version_id_column, label_kind: str, pattern: str):
+    # `~` is served by the trigram index on label.
+    version_ids = select([label_index.version_id])\
+        .where(label_index.label_kind == label_kind)\
+        .where(label_index.label.op('~')(pattern))
+    return version_id_column.in_(version_ids)
+
+def filter_by_plate_label_filter(plate_id: str, version_id_column=None):
+    if version_id_column is None:
+        version_id_column = RunVersion.id
+    return label_index_filter(RunLabelIndex, version_id_column, 'plate', plate_id)
+
+def filter_by_reagent_label_filter(reagent_id: str, version_id_column=None):
+    if version_id_column is None:
+        version_id_column = ProtocolVersion.id
+    return label_index_filter(ProtocolLabelIndex, version_id_column, 'reagent', reagent_id)
     # TODO: FIXME. This doesn't work if we remove repeated definitions.
     # return func.jsonb_path_match(RunVersion.data, f'exists($.sections[*].blocks[*].definition.reagentLabel ? (@ == "{reagent_id}"))')
 
-def filter_by_sample_label_filter(sample_id: str):
-    return func.jsonb_path_match(RunVersion.data, f'exists($.sections[*].blocks[*].plates[*].coordinates[*].sampleLabel ? (@ like_regex "{sample_id}"))')
+def filter_by_sample_label_filter(sample_id: str, version_id_column=None):
+    if version_id_column is None:
+        version_id_column = RunVersion.id
+    return label_index_filter(RunLabelIndex, version_id_column, 'sample', sample_id)
 
 def filter_by_plate_label(run_version_query, plate_id: str):
     return run_version_query.filter(filter_by_plate_label_filter(plate_id))
@@ -168,6 +283,30 @@ def filter_by_reagent_label(run_version_query, reagent_id: str):
 def filter_by_sample_label(run_version_query, sample_id: str):
     return run_version_query.filter(filter_by_sample_label_filter(sample_id))
 
+class QueryFilters:
+    """Search filters for a single SELECT.
+
+    Joins are keyed by the joined class, so filters that need the same table
+    share one join instead of each building (and intersecting) its own query.
+    """
+
+    def __init__(self):
+        self.from_tables = OrderedDict()
+        self.filters = []
+
+    def join(self, join_cls, join_filter):
+        self.from_tables.setdefault(join_cls, join_filter)
+
+    def filter(self, search_filter):
+        self.filters.append(search_filter)
+
+    def apply(self, query):
+        for join_cls, join_filter in self.from_tables.items():
+            query = query.join(join_cls, join_filter)
+        for search_filter in self.filters:
+            query = query.filter(search_filter)
+        return query
+
 
 # Tables ----------------------------------------------------------------------
 
@@ -239,14 +378,35 @@ class User(BaseModel):
         order_by=UserVersion.updated_on,
     )
 
+    # Keyset pagination seeks on (created_on, <primary key>).
+    __table_args__ = (
+        Index('ix_user_created_on_id', 'created_on', 'id'),
+    )
+
 class ProtocolVersion(BaseVersionModel):
     __tablename__ = 'protocol_version'
 
     id = Column(Integer, primary_key=True)
     protocol_id = Column(Integer, ForeignKey('protocol.id', ondelete='CASCADE'))
     data = Column(JSONB)
+    # Part of data, when loaded by versioned_row_load_options (with fields).
+    projected_data = query_expression()
 
     protocol = relationship('Protocol', primaryjoin='ProtocolVersion.protocol_id==Protocol.id')
+    labels = relationship('ProtocolLabelIndex', cascade='all, delete-orphan', passive_deletes=True)
+
+class ProtocolLabelIndex(Base):
+    __tablename__ = 'protocol_label_index'
+
+    label_kind = Column(String(16), primary_key=True)
+    label = Column(String, primary_key=True)
+    version_id = Column(Integer, ForeignKey('protocol_version.id', ondelete='CASCADE'), primary_key=True)
+
+    __table_args__ = (
+        Index('ix_protocol_label_index_version_id', 'version_id'),
+        # ix_protocol_label_index_label_trgm (gin_trgm_ops) is left to the migration,
+        # which only creates it when pg_trgm is available.
+    )
 
 class Protocol(BaseModel):
     __tablename__ = 'protocol'
@@ -268,6 +428,10 @@ class Protocol(BaseModel):
         order_by=UserVersion.updated_on,
     )
 
+    __table_args__ = (
+        Index('ix_protocol_created_on_id', 'created_on', 'id'),
+    )
+
 class RunVersionAttachment(Base):
     __tablename__ = 'run_version_attachment'
 
@@ -283,10 +447,41 @@ class RunVersion(BaseVersionModel):
 
     id = Column(Integer, primary_key=True)
     run_id = Column(Integer, ForeignKey('run.id', ondelete='CASCADE'))
+    # The (earlier) version whose samples this version shares, or NULL when
+    # the samples are stored under this version.
+    sample_set_id = Column(Integer, ForeignKey('run_version.id'))
+    # Why this version's samples could not be generated, in which case it
+    # keeps showing the samples of the version before it.
+    samples_error = Column(String)
     data = Column(JSONB)
+    # Part of data, when loaded by versioned_row_load_options (with fields).
+    projected_data = query_expression()
 
     run = relationship('Run', primaryjoin='RunVersion.run_id==Run.id')
     attachments = relationship('Attachment', secondary='run_version_attachment')
+    labels = relationship('RunLabelIndex', cascade='all, delete-orphan', passive_deletes=True)
+
+    @hybrid_property
+    def sample_run_version_id(self):
+        """The `Sample.run_version_id` of this version's samples."""
+        return self.sample_set_id or self.id
+
+    @sample_run_version_id.expression
+    def sample_run_version_id(cls):
+        return func.coalesce(cls.sample_set_id, cls.id)
+
+class RunLabelIndex(Base):
+    __tablename__ = 'run_label_index'
+
+    label_kind = Column(String(16), primary_key=True)
+    label = Column(String, primary_key=True)
+    version_id = Column(Integer, ForeignKey('run_version.id', ondelete='CASCADE'), primary_key=True)
+
+    __table_args__ = (
+        Index('ix_run_label_index_version_id', 'version_id'),
+        # ix_run_label_index_label_trgm (gin_trgm_ops) is left to the migration,
+        # which only creates it when pg_trgm is available.
+    )
 
 class Run(BaseModel):
     __tablename__ = 'run'
@@ -313,6 +508,10 @@ class Run(BaseModel):
         order_by=UserVersion.updated_on,
     )
 
+    __table_args__ = (
+        Index('ix_run_created_on_id', 'created_on', 'id'),
+    )
+
 class SampleVersion(BaseVersionModel):
     __tablename__ = 'sample_version'
 
@@ -371,6 +570,286 @@ class Sample(BaseModel):
         order_by=SampleVersion.updated_on,
     )
 
+    __table_args__ = (
+        Index('ix_sample_created_on_id', 'created_on', 'sample_id', 'plate_id', 'run_version_id', 'protocol_version_id'),
+        Index('ix_sample_run_version_id', 'run_version_id'),
+    )
+
+def run_samples_filter(run_version_id):
+    """Match the samples of the run version `run_version_id` (which may share them)."""
+    sample_run_version_id = select([RunVersion.sample_run_version_id])\
+        .where(RunVersion.id == run_version_id)\
+        .as_scalar()
+    return Sample.run_version_id == sample_run_version_id
+
+class Job(BaseModel):
+    """Work done after a request by the job pool, see jobs.py."""
+    __tablename__ = 'job'
+
+    id = Column(Integer, primary_key=True)
+    kind = Column(String(64), nullable=False)
+    # pending, running, done or failed.
+    status = Column(String(16), nullable=False, default='pending')
+    # Jobs for the same run are run one at a time, in order.
+    run_id = Column(Integer, ForeignKey('run.id', ondelete='CASCADE'))
+    payload = Column(JSONB)
+    attempts = Column(Integer, nullable=False, default=0)
+    error = Column(String)
+    started_on = Column(DateTime)
+    finished_on = Column(DateTime)
+
+    __table_args__ = (
+        Index('ix_job_status_id', 'status', 'id'),
+        Index('ix_job_run_id_id', 'run_id', 'id'),
+    )
+
+
+# Bulk Writes -----------------------------------------------------------------
+
+def json_recordset(columns) -> str:
+    """SQL for the rows of a JSON array bound to `:rows`, typed like `columns`.
+
+    pg8000 sends an executemany one row at a time, and a multi-row VALUES
+    list costs a bind parameter per value to build, so bulk writes pass the
+    whole batch as a single JSON parameter instead.
+    """
+    definitions = ', '.join(f"{column.name} {column.type.compile(dialect=postgresql.dialect())}" for column in columns)
+    return f"jsonb_to_recordset(CAST(:rows AS jsonb)) AS rows({definitions})"
+
+# Versions are never updated, so their labels are only written when the
+# version is inserted. Runs can have thousands of sample labels, so write them
+# all at once.
+@event.listens_for(ProtocolVersion, 'after_insert')
+@event.listens_for(RunVersion, 'after_insert')
+def insert_version_labels(mapper, connection, target):
+    label_paths = RUN_LABEL_PATHS if isinstance(target, RunVersion) else PROTOCOL_LABEL_PATHS
+    labels = extract_labels(target.data, label_paths)
+    if not labels:
+        return
+
+    label_index = mapper.relationships['labels'].mapper.local_table
+    columns = [label_index.c.label_kind, label_index.c.label]
+    connection.execute(
+        text(f"""
+            INSERT INTO {label_index.name} (label_kind, label, version_id)
+            SELECT label_kind, label, :version_id FROM {json_recordset(columns)}
+        """),
+        rows=json.dumps([{'label_kind': label_kind, 'label': label} for label_kind, label in labels]),
+        version_id=target.id,
+    )
+
+
+# User Cache ------------------------------------------------------------------
+
+class UserDisplayCache:
+    """Per-worker LRU of user id -> display fields (email, fullName, avatar).
+
+    Every versioned row reports who created and last updated it, and the same
+    few users are behind most rows, so their display fields are kept here
+    instead of being loaded alongside every row. Edits through this worker
+    invalidate the entry; entries expire after `ttl` seconds so edits made
+    through other workers are picked up too.
+    """
+
+    fields = ('email', 'fullName', 'avatar')
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def load(self, db: Optional[Session], user_ids) -> dict:
+        """Look up `user_ids`, fetching any that aren't cached in one query."""
+        user_ids = {user_id for user_id in user_ids if user_id is not None}
+        now = time.monotonic()
+        found = {}
+        with self._lock:
+            for user_id in user_ids:
+                entry = self._entries.get(user_id)
+                if entry is None:
+                    continue
+                loaded_on, display = entry
+                if now - loaded_on >= self.ttl:
+                    del self._entries[user_id]
+                    continue
+                self._entries.move_to_end(user_id)
+                found[user_id] = display
+            self.hits += len(found)
+            self.misses += len(user_ids) - len(found)
+
+        missing = user_ids - found.keys()
+        if not missing or db is None:
+            return found
+
+        rows = db.query(User.id, UserVersion.data)\
+            .join(UserVersion, UserVersion.id == User.version_id)\
+            .filter(User.id.in_(missing))\
+            .all()
+        loaded = {
+            user_id: {field: data[field] for field in self.fields if field in data}
+            for user_id, data in rows
+            if data is not None
+        }
+        with self._lock:
+            for user_id, display in loaded.items():
+                self._entries[user_id] = (now, display)
+                self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        found.update(loaded)
+        return found
+
+    def invalidate(self, user_id: str):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+user_display_cache = UserDisplayCache(settings.user_display_cache_size, settings.user_display_cache_ttl)
+
+def load_audit_users(db: Session, versioned_rows):
+    """Cache the creators and updators of (row, row_version) pairs in one go."""
+    user_display_cache.load(db, [
+        user_id
+        for row, row_version in versioned_rows
+        for user_id in (row.created_by, row_version.updated_by if row_version else None)
+    ])
+
+def run_audit_rows(runs, include_protocols=True):
+    """The (row, row_version) pairs run_to_dict reports audit fields for."""
+    for run in runs:
+        yield run, run.current
+        if include_protocols and run.protocol_version:
+            yield run.protocol_version.protocol, run.protocol_version
+
+
+# Version Cache ---------------------------------------------------------------
+
+class VersionDictCache:
+    """Per-worker LRU of version data, as versioned_row_to_dict returns it.
+
+    Protocol and run versions are never edited after they are inserted (each
+    edit is a new version), so their data only has to be fetched and trimmed
+    once. Entries hold the JSON encoded data, so every hit decodes a fresh copy
+    that callers are free to edit. They are keyed by (table, version_id,
+    include_large_fields) and bounded by both count and encoded size.
+    """
+
+    tables = {'protocol_version', 'run_version'}
+
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.size = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def data_to_dict(self, row_version, include_large_fields=True) -> dict:
+        if row_version is None or row_version.id is None or row_version.__tablename__ not in self.tables or self.max_entries <= 0:
+            return version_data_to_dict(row_version, include_large_fields)
+
+        key = (row_version.__tablename__, row_version.id, include_large_fields)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+        # A JSON round trip copies JSONB data faster than deepcopy.
+        if entry is not None:
+            return json.loads(entry[0])
+
+        encoded = json.dumps(row_version.data or {})
+        d = json.loads(encoded)
+        if not include_large_fields:
+            strip_large_fields(d)
+            encoded = json.dumps(d)
+        size = len(encoded)
+        if size <= self.max_bytes:
+            with self._lock:
+                if key not in self._entries:
+                    self._entries[key] = (encoded, size)
+                    self.size += size
+                while len(self._entries) > self.max_entries or self.size > self.max_bytes:
+                    _, (_, evicted_size) = self._entries.popitem(last=False)
+                    self.size -= evicted_size
+        return d
+
+    def invalidate(self, table: str, version_id: int):
+        with self._lock:
+            for include_large_fields in (True, False):
+                entry = self._entries.pop((table, version_id, include_large_fields), None)
+                if entry is not None:
+                    self.size -= entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self) -> dict:
+        return {
+            'entries': len(self._entries),
+            'bytes': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+version_dict_cache = VersionDictCache(settings.version_cache_max_entries, settings.version_cache_max_bytes)
+
+
+# Loading Plans ---------------------------------------------------------------
+
+def versioned_row_load_options(row_cls, version_cls, fields=None) -> list:
+    """Eagerly load everything versioned_row_to_dict reads from a row.
+
+    Owner and updator emails come from user_display_cache instead. With
+    `fields`, only those fields of the version data leave the database (as
+    its projected_data).
+    """
+    if fields is None:
+        return [
+            joinedload(row_cls.current),
+        ]
+    return [
+        joinedload(row_cls.current).defer(version_cls.data),
+        joinedload(row_cls.current).with_expression(version_cls.projected_data, version_data_projection(version_cls, fields)),
+    ]
+
+def run_load_options(fields=None) -> list:
+    """Eagerly load everything run_to_dict reads from a run."""
+    if fields is not None and 'protocol' not in fields:
+        return versioned_row_load_options(Run, RunVersion, fields)
+    # Runs share a handful of protocol versions, so don't join those per row.
+    return [
+        *versioned_row_load_options(Run, RunVersion, fields),
+        selectinload(Run.protocol_version)\
+            .selectinload(ProtocolVersion.protocol),
+    ]
+
+def sample_load_options() -> list:
+    """Eagerly load everything run_to_sample reads from a sample."""
+    return [
+        joinedload(Sample.current),
+        selectinload(Sample.run_version),
+        selectinload(Sample.protocol_version),
+    ]
+
 
 # Fixes for changing plateMarkers from a dictionary to a list.
 
@@ -398,6 +877,25 @@ def fix_plate_markers_section(section):
         changes_made = changes_made or fix_plate_markers_block(block)
     return changes_made
 
+def fix_plate_markers_sections(sections):
+    """Fix run (or protocol) sections, and their definitions, in place."""
+    changes_made = False
+    for section in sections:
+        # Handle section definition
+        if section.get('definition', None) is not None:
+            changes_made = changes_made or fix_plate_markers_section(section['definition'])
+
+        if section is None or section.get('blocks', None) is None:
+            continue
+
+        # Handle block definition
+        for block in section['blocks']:
+            if block is not None:
+                changes_made = changes_made or fix_plate_markers_block(block)
+                if block.get('definition', None) is not None:
+                    changes_made = changes_made or fix_plate_markers_block(block['definition'])
+    return changes_made
+
 def fix_plate_markers_protocol_field(protocol):
     if protocol.current.data.get('sections', None) is None:
         return protocol
@@ -418,15 +916,24 @@ def fix_plate_markers_protocol_version(db: Session, protocol_version: ProtocolVe
     if changes_made:
         flag_modified(protocol_version, 'data')
         db.commit()
+        version_dict_cache.invalidate(ProtocolVersion.__tablename__, protocol_version.id)
         logger.info(f"Updated protocol ({protocol_version.protocol_id}, {protocol_version.id}) with new plateMarkers format.")
 
     return protocol_version
 
-def fix_plate_markers_protocol(db: Session, protocol: Protocol) -> Protocol:
+def fix_plate_markers_protocol(db: Session, protocol: Protocol, fields=None) -> Protocol:
+    # Projected fields (see versioned_row_load_options) are fixed as they are
+    # read, without loading (or saving) the rest of the data.
+    if fields is not None:
+        return protocol
     fix_plate_markers_protocol_version(db, protocol.current)
     return protocol
 
-def fix_plate_markers_run(db: Session, run: Run) -> Run:
+def fix_plate_markers_run(db: Session, run: Run, fields=None) -> Run:
+    if fields is not None:
+        if 'protocol' in fields:
+            fix_plate_markers_protocol_version(db, run.protocol_version)
+        return run
     fix_plate_markers_protocol_version(db, run.protocol_version)
 
     changes_made = False
@@ -435,24 +942,12 @@ def fix_plate_markers_run(db: Session, run: Run) -> Run:
         changes_made = changes_made or fix_plate_markers_protocol_field(run.current.data['protocol'])
 
     if run.current.data.get('sections', None) is not None:
-        for section in run.current.data['sections']:
-            # Handle section definition
-            if section.get('definition', None) is not None:
-                changes_made = changes_made or fix_plate_markers_section(section['definition'])
-
-            if section is None or section.get('blocks', None) is None:
-                continue
-
-            # Handle block definition
-            for block in section['blocks']:
-                if block is not None:
-                    changes_made = changes_made or fix_plate_markers_block(block)
-                    if block.get('definition', None) is not None:
-                        changes_made = changes_made or fix_plate_markers_block(block['definition'])
+        changes_made = changes_made or fix_plate_markers_sections(run.current.data['sections'])
 
     if changes_made:
         flag_modified(run.current, 'data')
         db.commit()
+        version_dict_cache.invalidate(RunVersion.__tablename__, run.version_id)
         logger.info(f"Updated run ({run.id}, {run.version_id}) with new plateMarkers format.")
 
     return run
@@ -1,21 +1,118 @@
+import json
+import random
 import re
+import sys
+import time
 
-from easy_profile.profiler import SessionProfiler
+from contextvars import ContextVar
+from queue import Queue
+
+from easy_profile.profiler import DebugQuery, SessionProfiler, _timer
 from easy_profile.reporters import Reporter, StreamReporter
+from sqlalchemy import event
+from sqlalchemy.engine.base import Engine
+
+
+# The profiler of the request being handled, if it is being profiled. Context
+# variables follow requests into the threadpool their handlers run on.
+active_profiler = ContextVar('active_profiler', default=None)
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if active_profiler.get() is not None:
+        context._query_start_time = _timer()
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    profiler = active_profiler.get()
+    if profiler is not None and profiler.alive:
+        profiler.queries.put(DebugQuery(statement, parameters, context._query_start_time, _timer()))
+
+def listen(engine=None):
+    """Send `engine`'s (or every engine's) queries to the profiler of the
+    request that ran them.
+    """
+    target = engine if engine is not None else Engine
+    for identifier, fn in (('before_cursor_execute', _before_cursor_execute), ('after_cursor_execute', _after_cursor_execute)):
+        if not event.contains(target, identifier, fn):
+            event.listen(target, identifier, fn)
+
+
+class RequestProfiler(SessionProfiler):
+    """SessionProfiler recording only the queries of the request it profiles.
+
+    Instead of adding (and removing) engine listeners for every request, which
+    would also record the queries of concurrent requests, it relies on the
+    listeners installed once by `listen`. Recorded queries are only tallied
+    into `stats` by `summarize`, so requests that are not reported skip it.
+    """
+
+    def begin(self):
+        if self.alive:
+            raise AssertionError("Profiling session has already begun")
 
-from starlette.middleware.base import BaseHTTPMiddleware
-from starlette.requests import Request
+        self.alive = True
+        self.queries = Queue()
+        self._reset_stats()
+        self._token = active_profiler.set(self)
 
+    def commit(self):
+        if not self.alive:
+            raise AssertionError("Profiling session is already committed")
 
-class EasyProfileMiddleware(BaseHTTPMiddleware):
-    """This middleware prints the number of database queries for each HTTP
-    request and can be applied as a WSGI server middleware.
-    :param app: WSGI application server
+        self.alive = False
+        active_profiler.reset(self._token)
+
+    def summarize(self):
+        return self._get_stats()
+
+
+class JsonReporter(Reporter):
+    """Reports each profiled request as one line of JSON.
+
+    :param file: output destination (stdout by default)
+    :param int display_duplicates: how many duplicated statements to include
+    """
+
+    def __init__(self, file=sys.stdout, display_duplicates=5):
+        self._file = file
+        self._display_duplicates = display_duplicates or 0
+
+    def report(self, path, stats):
+        duplicates = stats["duplicates"]
+        record = {
+            "path": path,
+            "db": stats["db"],
+            "select": stats["select"],
+            "insert": stats["insert"],
+            "update": stats["update"],
+            "delete": stats["delete"],
+            "total": stats["total"],
+            "duplicates_count": sum(duplicates.values()),
+            "duration_ms": round(stats["duration"] * 1000, 3),
+        }
+        if "request_duration" in stats:
+            record["request_duration_ms"] = round(stats["request_duration"] * 1000, 3)
+        if self._display_duplicates:
+            record["duplicates"] = [
+                {"statement": statement, "count": count + 1}
+                for statement, count
+                in duplicates.most_common(self._display_duplicates)
+                if count
+            ]
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+
+
+class EasyProfileMiddleware:
+    """This middleware reports the database queries of HTTP requests, and can
+    be applied as an ASGI server middleware.
+    :param app: ASGI application
     :param sqlalchemy.engine.base.Engine engine: sqlalchemy database engine
     :param Reporter reporter: reporter instance
     :param list exclude_path: a list of regex patterns for excluding requests
     :param int min_time: minimal queries duration to logging
     :param int min_query_count: minimal queries count to logging
+    :param float sample_rate: fraction of requests to profile (0 disables)
+    :param float min_request_time: minimal request duration to logging
     """
 
     def __init__(
@@ -25,7 +122,9 @@ class EasyProfileMiddleware(BaseHTTPMiddleware):
         reporter=None,
         exclude_path=None,
         min_time=0,
-        min_query_count=1
+        min_query_count=1,
+        sample_rate=1.0,
+        min_request_time=0,
     ):
         if reporter:
             if not isinstance(reporter, Reporter):
@@ -39,25 +138,39 @@ class EasyProfileMiddleware(BaseHTTPMiddleware):
         self.exclude_path = exclude_path or []
         self.min_time = min_time
         self.min_query_count = min_query_count
+        self.sample_rate = sample_rate
+        self.min_request_time = min_request_time
+        if sample_rate:
+            listen(engine)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self._sampled() or self._ignore_request(scope["path"]):
+            await self.app(scope, receive, send)
+            return
+
+        path = "{0} {1}".format(scope["method"], scope["path"])
+        profiler = RequestProfiler(self.engine)
+        start = time.perf_counter()
+        profiler.begin()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            profiler.commit()
+            request_duration = time.perf_counter() - start
+            if request_duration >= self.min_request_time:
+                self._report_stats(path, profiler.summarize(), request_duration)
 
-    async def dispatch_func(self, request: Request, call_next):
-        profiler = SessionProfiler(self.engine)
-        path = request.url.path
-        if not self._ignore_request(path):
-            if request.method:
-                path = "{0} {1}".format(request.method, path)
-            try:
-                with profiler:
-                    return await call_next(request)
-            finally:
-                self._report_stats(path, profiler.stats)
-        return await call_next(request)
+    def _sampled(self):
+        if not self.sample_rate:
+            return False
+        return random.random() < self.sample_rate
 
     def _ignore_request(self, path):
         """Check to see if we should ignore the request."""
         return any(re.match(pattern, path) for pattern in self.exclude_path)
 
-    def _report_stats(self, path, stats):
+    def _report_stats(self, path, stats, request_duration):
         if (stats["total"] >= self.min_query_count and
                 stats["duration"] >= self.min_time):
+            stats["request_duration"] = request_duration
             self.reporter.report(path, stats)
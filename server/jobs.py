@@ -0,0 +1,209 @@
+"""Background jobs.
+
+Jobs are rows in the `job` table, so they survive restarts and can be run by
+any process sharing the database. Every API process runs a small pool of
+worker threads claiming them with `FOR UPDATE SKIP LOCKED`, and `python
+jobs.py` runs a pool on its own.
+"""
+
+import logging
+import threading
+import time
+from datetime import timedelta
+from typing import Callable, Optional
+
+from sqlalchemy import and_, event, exists, func, or_
+from sqlalchemy.orm import aliased, Session
+
+from database import Job
+from server import app, SessionLocal
+from settings import settings
+
+
+logger = logging.getLogger(__name__)
+
+UNFINISHED_STATUSES = ('pending', 'running')
+
+# Job kind -> handler(db, job), see job_handler.
+job_handlers = {}
+# Job kind -> handler(db, job), see job_failure_handler.
+job_failure_handlers = {}
+
+
+def job_handler(kind: str):
+    """Register a function `handler(db, job)` running jobs of `kind`.
+
+    Handlers share the job's session, which is committed once they return
+    (or rolled back if they raise).
+    """
+    def decorator(handler):
+        job_handlers[kind] = handler
+        return handler
+    return decorator
+
+def job_failure_handler(kind: str):
+    """Register a function `handler(db, job)` called once a job of `kind` has
+    failed for the last time, committed along with the job's status.
+    """
+    def decorator(handler):
+        job_failure_handlers[kind] = handler
+        return handler
+    return decorator
+
+def enqueue_job(db: Session, kind: str, run_id: Optional[int] = None, payload: Optional[dict] = None, created_by: Optional[str] = None) -> Job:
+    """Queue a job, to be picked up once `db` commits."""
+    job = Job(kind=kind, status='pending', run_id=run_id, payload=payload, attempts=0, created_by=created_by)
+    db.add(job)
+    event.listen(db, 'after_commit', lambda session: job_pool.notify(), once=True)
+    return job
+
+def has_unfinished_jobs(db: Session, run_id: int) -> bool:
+    return db.query(exists().where(and_(Job.run_id == run_id, Job.status.in_(UNFINISHED_STATUSES)))).scalar()
+
+def wait_for_job(db: Session, job_id: int, timeout: Optional[float] = None) -> Optional[str]:
+    """Wait for a job to finish (at most `settings.job_wait_timeout` seconds).
+
+    Polls from (and blocks) the calling thread. Returns the job's last seen
+    status.
+    """
+    if timeout is None or timeout > settings.job_wait_timeout:
+        timeout = settings.job_wait_timeout
+    deadline = time.monotonic() + timeout
+    delay = 0.01
+    while True:
+        status = db.query(Job.status).filter(Job.id == job_id).scalar()
+        if status not in UNFINISHED_STATUSES or time.monotonic() >= deadline:
+            return status
+        time.sleep(delay)
+        delay = min(delay * 2, 0.25)
+
+
+class JobPool:
+    """Worker threads running queued jobs.
+
+    Jobs for the same run are run one at a time, in the order they were
+    queued. A job left running for longer than `lease` seconds (e.g. by a
+    process that died) is picked up again, and a failed job is retried until
+    it has been attempted `max_attempts` times.
+    """
+    def __init__(self, session_factory: Callable[[], Session], workers: int, poll_interval: float, lease: float, max_attempts: int):
+        self.session_factory = session_factory
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.threads = []
+        self.wakeup = threading.Event()
+        self.stopping = threading.Event()
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.work, name=f"job-worker-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self, timeout: Optional[float] = None):
+        self.stopping.set()
+        self.wakeup.set()
+        for thread in self.threads:
+            thread.join(timeout)
+        self.threads = []
+        self.stopping.clear()
+
+    def notify(self):
+        """Wake the workers up, e.g. because a job was just queued."""
+        self.wakeup.set()
+
+    def work(self):
+        while not self.stopping.is_set():
+            self.wakeup.clear()
+            try:
+                if self.run_next():
+                    continue
+            except Exception:
+                logger.exception("Failed to claim a job")
+            self.wakeup.wait(self.poll_interval)
+
+    def claim(self, db: Session) -> Optional[Job]:
+        earlier = aliased(Job)
+        job = db.query(Job)\
+            .filter(or_(
+                Job.status == 'pending',
+                and_(Job.status == 'running', Job.started_on < func.now() - timedelta(seconds=self.lease)),
+            ))\
+            .filter(~exists().where(and_(
+                earlier.run_id == Job.run_id,
+                earlier.id < Job.id,
+                earlier.status.in_(UNFINISHED_STATUSES),
+            )))\
+            .order_by(Job.id)\
+            .with_for_update(skip_locked=True)\
+            .first()
+        if not job:
+            return None
+        job.status = 'running'
+        job.started_on = func.now()
+        job.attempts += 1
+        db.commit()
+        return job
+
+    def run_next(self) -> bool:
+        """Run the oldest job that can be run, returning whether there was one."""
+        db = self.session_factory()
+        try:
+            job = self.claim(db)
+            if not job:
+                return False
+            self.run(db, job)
+            return True
+        finally:
+            db.close()
+
+    def run(self, db: Session, job: Job):
+        start = time.perf_counter()
+        try:
+            handler = job_handlers.get(job.kind)
+            if handler is None:
+                raise KeyError(f"No handler for {job.kind} jobs")
+            handler(db, job)
+            job.status = 'done'
+            job.error = None
+        except Exception as err:
+            logger.exception(f"Job {job.id} ({job.kind}) failed")
+            db.rollback()
+            job.status = 'pending' if job.attempts < self.max_attempts else 'failed'
+            job.error = str(err)
+            if job.status == 'failed' and job.kind in job_failure_handlers:
+                job_failure_handlers[job.kind](db, job)
+        job.finished_on = func.now()
+        db.commit()
+        logger.info(f"Job {job.id} ({job.kind}) {job.status} after {time.perf_counter() - start:.3f}s")
+
+job_pool = JobPool(
+    SessionLocal,
+    workers=settings.job_workers,
+    poll_interval=settings.job_poll_interval,
+    lease=settings.job_lease,
+    max_attempts=settings.job_max_attempts,
+)
+
+@app.on_event('startup')
+def start_job_pool():
+    job_pool.start()
+
+@app.on_event('shutdown')
+def stop_job_pool():
+    job_pool.stop()
+
+
+if __name__ == '__main__':
+    # Import the handlers (and this module) the way the API does.
+    import api.run
+    from jobs import job_pool as worker_pool
+
+    worker_pool.start()
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        worker_pool.stop()
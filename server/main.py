@@ -3,11 +3,13 @@ import uvicorn
 from server import app
 
 import api.health
+import api.metrics
 import api.user
 import api.group
 import api.protocol
 import api.run
 import api.sample
+import api.job
 import api_graphql
 
 
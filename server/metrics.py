@@ -0,0 +1,217 @@
+"""In-process metrics, served in the Prometheus text format at `/metrics`.
+
+Every worker process keeps its own metrics, so each one has to be scraped
+(or a single worker run per container) to see them all.
+"""
+
+import bisect
+import threading
+import time
+
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.engine.base import Engine
+
+
+def format_labels(labelnames: Tuple[str, ...], labelvalues: Tuple[str, ...]) -> str:
+    if not labelnames:
+        return ''
+    labels = ','.join(
+        '{0}="{1}"'.format(name, str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+        for name, value
+        in zip(labelnames, labelvalues)
+    )
+    return '{' + labels + '}'
+
+def format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def lines(self) -> Iterable[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        header = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        return '\n'.join(header + list(self.lines()))
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+
+    def inc(self, *labelvalues, amount: float = 1.0):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0.0) + amount
+
+    def lines(self) -> Iterable[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        for labelvalues, value in values:
+            yield f"{self.name}{format_labels(self.labelnames, labelvalues)} {format_value(value)}"
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (), buckets: Iterable[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        # labelvalues -> [per bucket counts, sum, count]
+        self._values = {}
+
+    def observe(self, value: float, *labelvalues):
+        with self._lock:
+            entry = self._values.get(labelvalues)
+            if entry is None:
+                entry = self._values[labelvalues] = [[0] * len(self.buckets), 0.0, 0]
+            entry[0][bisect.bisect_left(self.buckets, value)] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def lines(self) -> Iterable[str]:
+        with self._lock:
+            values = sorted((labelvalues, (list(counts), total, count)) for labelvalues, (counts, total, count) in self._values.items())
+        for labelvalues, (counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = format_labels(self.labelnames + ('le',), labelvalues + (format_value(bound),))
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = format_labels(self.labelnames, labelvalues)
+            yield f"{self.name}_sum{labels} {format_value(total)}"
+            yield f"{self.name}_count{labels} {count}"
+
+class CallbackMetric(Metric):
+    """A metric read from `callback() -> {labelvalues: value}` when scraped,
+    e.g. counters or gauges other parts of the server already keep.
+    """
+
+    def __init__(self, kind: str, name: str, documentation: str, labelnames: Iterable[str], callback: Callable[[], Dict[tuple, float]]):
+        super().__init__(name, documentation, labelnames)
+        self.kind = kind
+        self.callback = callback
+
+    def lines(self) -> Iterable[str]:
+        for labelvalues, value in sorted(self.callback().items()):
+            yield f"{self.name}{format_labels(self.labelnames, labelvalues)} {format_value(value)}"
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return '\n'.join(metric.render() for metric in self.metrics) + '\n'
+
+registry = MetricsRegistry()
+
+
+# Metrics ---------------------------------------------------------------------
+
+request_duration = registry.register(Histogram(
+    'flow_http_request_duration_seconds',
+    'Time spent handling requests, by route.',
+    ('method', 'route', 'status'),
+))
+db_queries = registry.register(Counter(
+    'flow_db_queries_total',
+    'Database queries run while handling requests, by route.',
+    ('method', 'route'),
+))
+db_query_duration = registry.register(Counter(
+    'flow_db_query_seconds_total',
+    'Time spent running database queries while handling requests, by route.',
+    ('method', 'route'),
+))
+enforcer_checks = registry.register(Counter(
+    'flow_enforcer_checks_total',
+    'Casbin access checks, by method and result.',
+    ('method', 'result'),
+))
+sample_regenerations = registry.register(Histogram(
+    'flow_sample_regeneration_samples',
+    'Samples generated per run sample regeneration job (0 when they were shared).',
+    ('scope',),
+    buckets=(0, 1, 10, 100, 384, 1000, 1536, 5000, 10000),
+))
+
+
+# Request Metrics -------------------------------------------------------------
+
+# [query count, query seconds] of the request being handled. Context variables
+# follow requests into the threadpool their handlers run on.
+request_queries = ContextVar('request_queries', default=None)
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if request_queries.get() is not None:
+        context._metrics_start_time = time.perf_counter()
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    queries = request_queries.get()
+    if queries is not None:
+        queries[0] += 1
+        queries[1] += time.perf_counter() - context._metrics_start_time
+
+def route_name(scope) -> str:
+    """Name of the endpoint the router picked, as in the TIMING log lines."""
+    endpoint = scope.get('endpoint')
+    if endpoint is None:
+        return '<unmatched>'
+    return f"{endpoint.__module__}.{getattr(endpoint, '__name__', type(endpoint).__name__)}"
+
+
+class MetricsMiddleware:
+    """Records the latency and database queries of every HTTP request."""
+
+    def __init__(self, app, engine: Optional[Engine] = None):
+        self.app = app
+        target = engine if engine is not None else Engine
+        for identifier, fn in (('before_cursor_execute', _before_cursor_execute), ('after_cursor_execute', _after_cursor_execute)):
+            if not event.contains(target, identifier, fn):
+                event.listen(target, identifier, fn)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        status = [500]
+        async def send_with_status(message):
+            if message['type'] == 'http.response.start':
+                status[0] = message['status']
+            await send(message)
+
+        queries = [0, 0.0]
+        token = request_queries.set(queries)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - start
+            request_queries.reset(token)
+            method = scope['method']
+            route = route_name(scope)
+            request_duration.observe(elapsed, method, route, str(status[0]))
+            if queries[0]:
+                db_queries.inc(method, route, amount=queries[0])
+                db_query_duration.inc(method, route, amount=queries[1])
@@ -45,6 +45,10 @@ exclude_tables = exclude_tables_from_config(config.get_section('alembic:exclude'
 def include_object(object, name, type_, reflected, compare_to):    
     if type_ == "table" and name in exclude_tables:
         return False
+    # Trigram indexes only exist where pg_trgm is available, so the models
+    # leave them out.
+    elif type_ == "index" and reflected and name.endswith("_trgm"):
+        return False
     else:
         return True
 
@@ -1,17 +1,48 @@
 # TODO: Consider using this to build ts models: https://pypi.org/project/pydantic-to-typescript/
 
 from pydantic import BaseModel
-from typing import List, Union, Optional, Literal
+from typing import Dict, List, Union, Optional, Literal
 from datetime import datetime
 
 
 # System ----------------------------------------------------------------------
 
+class CacheStats(BaseModel):
+    entries: int
+    bytes: Optional[int]
+    hits: int
+    misses: int
+
+class PoolStats(BaseModel):
+    size: int
+    checked_out: int
+    idle: int
+    overflow: int
+    max_overflow: int
+    checkouts: int
+    timeouts: int
+    wait_ms_total: float
+    wait_ms_max: float
+
 class HealthCheck(BaseModel):
     version: str
     server: bool = False
     database: bool = False
     database_error: Optional[str]
+    caches: Optional[Dict[str, CacheStats]]
+    pools: Optional[Dict[str, PoolStats]]
+
+class JobModel(BaseModel):
+    id: int
+    kind: str
+    status: str
+    run_id: Optional[int]
+    attempts: int
+    error: Optional[str]
+    created_on: Optional[datetime]
+    created_by: Optional[str]
+    started_on: Optional[datetime]
+    finished_on: Optional[datetime]
 
 class SuccessResponse(BaseModel):
     success: bool
@@ -31,6 +62,7 @@ class AuditedModel(BaseModel):
 class PaginatedModel(BaseModel):
     page: Optional[int]
     pageCount: Optional[int]
+    nextCursor: Optional[str]
 
 class UserModel(AuditedModel):
     id: str
@@ -447,5 +479,8 @@ class RunModel(AuditedModel):
 
     protocol: Optional[ProtocolModel]
 
+    # Set when the samples of this version could not be regenerated.
+    samples_error: Optional[str]
+
 class RunsModel(PaginatedModel):
     runs: List[RunModel]
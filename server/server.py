@@ -1,20 +1,27 @@
+import asyncio
 import logging
+import threading
+import time
 
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from typing import Generator
 
-from fastapi import FastAPI
+from fastapi import Depends, FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 from fastapi_cloudauth.auth0 import Auth0, Auth0CurrentUser
-from fastapi_utils.timing import add_timing_middleware
 
 from pydantic import BaseModel, Field
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, exc
 from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy.pool import QueuePool
 
 from easy_profile import StreamReporter
-from easy_profile_asgi import EasyProfileMiddleware
+from easy_profile_asgi import EasyProfileMiddleware, JsonReporter
+from metrics import MetricsMiddleware
+from server_timing import phase, ServerTimingMiddleware, TimedRoute
 
 from settings import settings
 from sqlalchemy_session_asgi import SqlalchemySessionMiddleware
@@ -28,7 +35,80 @@ logger = logging.getLogger(__name__)
 
 # Database --------------------------------------------------------------------
 
-engine = create_engine(settings.sqlalchemy_database_uri)
+class TimedQueuePool(QueuePool):
+    """QueuePool keeping track of how long checkouts wait for a connection."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            with self._stats_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            waited = time.perf_counter() - start
+            with self._stats_lock:
+                self.checkouts += 1
+                self.wait_total += waited
+                self.wait_max = max(self.wait_max, waited)
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            return {
+                'size': self.size(),
+                'checked_out': self.checkedout(),
+                'idle': self.checkedin(),
+                # Starts at -size, counting up as connections are opened.
+                'overflow': max(self.overflow(), 0),
+                'max_overflow': self._max_overflow,
+                'checkouts': self.checkouts,
+                'timeouts': self.timeouts,
+                'wait_ms_total': round(self.wait_total * 1000, 3),
+                'wait_ms_max': round(self.wait_max * 1000, 3),
+            }
+
+def create_pooled_engine(database_uri: str):
+    pooled_engine = create_engine(
+        database_uri,
+        echo=settings.sqlalchemy_echo,
+        poolclass=TimedQueuePool,
+        pool_size=settings.sqlalchemy_pool_size,
+        max_overflow=settings.sqlalchemy_max_overflow,
+        pool_timeout=settings.sqlalchemy_pool_timeout,
+        pool_recycle=settings.sqlalchemy_pool_recycle,
+        pool_pre_ping=settings.sqlalchemy_pool_pre_ping,
+    )
+    if settings.sqlalchemy_statement_timeout and pooled_engine.dialect.name == 'postgresql':
+        @event.listens_for(pooled_engine, 'connect')
+        def set_statement_timeout(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            cursor.execute(f"SET statement_timeout = {int(settings.sqlalchemy_statement_timeout)}")
+            cursor.close()
+            # Committed, or the pool's reset-on-return would roll it back.
+            dbapi_connection.commit()
+    return pooled_engine
+
+def pool_stats() -> dict:
+    stats = {'main': engine.pool.stats()}
+    if casbin_engine is not engine:
+        stats['casbin'] = casbin_engine.pool.stats()
+    return stats
+
+engine = create_pooled_engine(settings.sqlalchemy_database_uri)
+# Share the main connection pool with casbin unless policies live elsewhere.
+if settings.casbin_database_uri == settings.sqlalchemy_database_uri:
+    casbin_engine = engine
+else:
+    casbin_engine = create_pooled_engine(settings.casbin_database_uri)
 # This shouldn't need to be a scoped_session.
 # See: https://github.com/tiangolo/full-stack-fastapi-postgresql/issues/56
 SessionLocal = sessionmaker(
@@ -38,12 +118,9 @@ SessionLocal = sessionmaker(
 )
 
 # Dependency
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+def get_db(request: Request) -> Session:
+    """The request's session, see SqlalchemySessionMiddleware."""
+    return request.state.db.get()
 
 @contextmanager
 def SessionTransaction():
@@ -86,6 +163,10 @@ app = FastAPI(
             'name': 'system',
             'description': 'System operations.',
         },
+        {
+            'name': 'jobs',
+            'description': 'Background jobs, e.g. regenerating samples.',
+        },
         {
             'name': 'protocols',
             'description': 'Operations on protocols.',
@@ -100,6 +181,7 @@ app = FastAPI(
         },
     ]
 )
+app.router.route_class = TimedRoute
 
 app.add_middleware(
     CORSMiddleware,
@@ -110,14 +192,26 @@ app.add_middleware(
 )
 app.add_middleware(
     EasyProfileMiddleware,
-    reporter=StreamReporter(display_duplicates=100)
+    reporter=JsonReporter() if settings.profile_reporter == 'json' else StreamReporter(display_duplicates=100),
+    sample_rate=settings.profile_sample_rate,
+    min_request_time=settings.profile_min_request_time,
 )
 app.add_middleware(
     SqlalchemySessionMiddleware,
-    session_factory=Session,
+    session_factory=SessionLocal,
 )
 
-add_timing_middleware(app, record=logger.info)
+app.add_middleware(ServerTimingMiddleware)
+app.add_middleware(MetricsMiddleware)
+
+@app.on_event('startup')
+async def size_threadpool():
+    # Handlers are plain functions doing blocking database work, so FastAPI
+    # runs them (and GraphQL queries) on the event loop's default executor.
+    asyncio.get_event_loop().set_default_executor(ThreadPoolExecutor(
+        max_workers=settings.threadpool_workers,
+        thread_name_prefix='handler',
+    ))
 
 
 # Authentication --------------------------------------------------------------
@@ -136,4 +230,8 @@ class Auth0CurrentUserPatched(Auth0CurrentUser):
         self.user_info = Auth0ClaimsPatched
         super().__init__(domain, *args, **kwargs)
 
+    async def __call__(self, http_auth: HTTPAuthorizationCredentials = Depends(HTTPBearer())):
+        with phase('auth'):
+            return await super().__call__(http_auth)
+
 get_current_user = Auth0CurrentUserPatched(domain=settings.auth0_domain)
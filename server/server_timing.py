@@ -0,0 +1,175 @@
+"""Per-request phase timings, sent to clients as a `Server-Timing` header.
+
+Code handling a request times its phases with `phase(name)` (or the `timed`
+decorator). Phases with the same name add up, and timing outside of a request
+is a no-op. Browsers show the header in the devtools network panel.
+"""
+
+import asyncio
+import time
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from typing import Optional
+
+from fastapi.routing import APIRoute
+
+from metrics import request_queries
+
+
+class ServerTiming:
+    def __init__(self):
+        self.start = time.perf_counter()
+        # name -> [seconds, count, description]
+        self.phases = {}
+        self.handler_start = None
+        self.handler_end = None
+        # Time spent in phases (e.g. auth) by dependencies, before the handler.
+        self.dependency_phases = 0.0
+
+    def add(self, name: str, seconds: float, description: Optional[str] = None):
+        entry = self.phases.get(name)
+        if entry is None:
+            self.phases[name] = [seconds, 1, description]
+        else:
+            entry[0] += seconds
+            entry[1] += 1
+
+    def header(self) -> str:
+        phases = dict(self.phases)
+        queries = request_queries.get()
+        if queries is not None and queries[0]:
+            phases['db'] = [queries[1], queries[0], f"{queries[0]} {'query' if queries[0] == 1 else 'queries'}"]
+        phases['total'] = [time.perf_counter() - self.start, 1, None]
+        entries = []
+        for name, (seconds, count, description) in phases.items():
+            entry = f"{name};dur={seconds * 1000:.1f}"
+            if description is None and count > 1:
+                description = f"{count} calls"
+            if description is not None:
+                entry += ';desc="{0}"'.format(description.replace('\\', '\\\\').replace('"', '\\"'))
+            entries.append(entry)
+        return ', '.join(entries)
+
+# The timings of the request being handled. Context variables follow requests
+# into the threadpool their handlers run on.
+request_timing = ContextVar('request_timing', default=None)
+
+@contextmanager
+def phase(name: str, description: Optional[str] = None):
+    """Time the enclosed block as phase `name` of the current request."""
+    timing = request_timing.get()
+    if timing is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timing.add(name, time.perf_counter() - start, description)
+
+def timed(name: str, description: Optional[str] = None):
+    """Time every call of the decorated function as phase `name`."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            timing = request_timing.get()
+            if timing is None:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                timing.add(name, time.perf_counter() - start, description)
+        return wrapper
+    return decorator
+
+
+def timed_endpoint(endpoint):
+    """Wrap a route's endpoint, noting when the handler itself ran."""
+    def started():
+        timing = request_timing.get()
+        if timing is not None:
+            timing.handler_start = time.perf_counter()
+            timing.dependency_phases = sum(seconds for seconds, _, _ in timing.phases.values())
+        return timing
+
+    def finished(timing):
+        if timing is not None:
+            timing.handler_end = time.perf_counter()
+            timing.add('handler', timing.handler_end - timing.handler_start)
+
+    if asyncio.iscoroutinefunction(endpoint):
+        @wraps(endpoint)
+        async def wrapper(*args, **kwargs):
+            timing = started()
+            try:
+                return await endpoint(*args, **kwargs)
+            finally:
+                finished(timing)
+    else:
+        @wraps(endpoint)
+        def wrapper(*args, **kwargs):
+            timing = started()
+            try:
+                return endpoint(*args, **kwargs)
+            finally:
+                finished(timing)
+    return wrapper
+
+class TimedRoute(APIRoute):
+    """APIRoute splitting requests into request (parsing and validating the
+    request, solving dependencies), handler and response (validating and
+    encoding the response model) phases.
+    """
+
+    def __init__(self, path: str, endpoint, **kwargs):
+        super().__init__(path, timed_endpoint(endpoint), **kwargs)
+
+    def get_route_handler(self):
+        route_handler = super().get_route_handler()
+
+        async def timed_route_handler(request):
+            timing = request_timing.get()
+            if timing is None:
+                return await route_handler(request)
+            start = time.perf_counter()
+            try:
+                return await route_handler(request)
+            finally:
+                end = time.perf_counter()
+                if timing.handler_start is not None:
+                    timing.add('request', timing.handler_start - start - timing.dependency_phases, 'Request parsing and validation')
+                if timing.handler_end is not None:
+                    timing.add('response', end - timing.handler_end, 'Response validation and encoding')
+
+        return timed_route_handler
+
+
+class ServerTimingMiddleware:
+    """Collects the timings of every HTTP request, and sends them as a
+    `Server-Timing` header.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        timing = ServerTiming()
+        async def send_with_timing(message):
+            if message['type'] == 'http.response.start':
+                headers = list(message.get('headers', []))
+                headers.append((b'server-timing', timing.header().encode('latin-1')))
+                message = {**message, 'headers': headers}
+            await send(message)
+
+        token = request_timing.set(timing)
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            request_timing.reset(token)
@@ -5,6 +5,18 @@ from typing import Optional
 class Settings(BaseSettings):
     sqlalchemy_database_uri: str = 'sqlite:///labflow.db'
     sqlalchemy_echo: bool = False
+    # Connection pool of each engine (the casbin engine is the main one unless
+    # casbin_sqlalchemy_database_uri points elsewhere).
+    sqlalchemy_pool_size: int = 5
+    sqlalchemy_max_overflow: int = 10
+    # Seconds a checkout waits for a connection before giving up.
+    sqlalchemy_pool_timeout: float = 30.0
+    # Seconds before a connection is replaced (-1 never replaces them).
+    sqlalchemy_pool_recycle: int = -1
+    # Test connections with a round trip when checking them out.
+    sqlalchemy_pool_pre_ping: bool = False
+    # Milliseconds before Postgres cancels a statement (0 never does).
+    sqlalchemy_statement_timeout: int = 0
     auth_provider: str = 'auth0'
     auth0_domain: str
     auth0_client_id: str
@@ -13,6 +25,54 @@ class Settings(BaseSettings):
     casbin_model: str = 'casbinmodel.conf'
     # Defaults to the sqlalchemy_database_uri value.
     casbin_sqlalchemy_database_uri: Optional[str] = None
+    # Minimum seconds between checks for policy changes made by other workers.
+    casbin_policy_sync_interval: float = 1.0
+    # Seconds of the change log each sync reads again, to catch changes that
+    # commit out of id order.
+    casbin_policy_sync_overlap: float = 30.0
+    # Seconds between full reloads of the policy table (also bounds the change log).
+    casbin_policy_reload_interval: float = 600.0
+    # Use the query planner's row estimate for pageCount once a listing is
+    # estimated to have more rows than this (0 always counts exactly).
+    pagination_count_estimate_threshold: int = 0
+    # Users whose display fields (email, fullName, avatar) each worker keeps
+    # cached, and for how many seconds.
+    user_display_cache_size: int = 1024
+    user_display_cache_ttl: float = 300.0
+    # Protocol/run version dicts each worker keeps cached, bounded by count
+    # and by their JSON encoded size (0 entries disables the cache).
+    version_cache_max_entries: int = 512
+    version_cache_max_bytes: int = 64 * 1024 * 1024
+    # Threads each process runs request handlers (and their blocking database
+    # work) on. Threads beyond sqlalchemy_pool_size + sqlalchemy_max_overflow
+    # just queue for a connection.
+    threadpool_workers: int = 15
+    # Worker threads each process runs background jobs (sample regeneration)
+    # on. With 0, jobs queue up for other processes (see jobs.py).
+    job_workers: int = 2
+    # Seconds idle workers wait between checks for jobs queued elsewhere.
+    job_poll_interval: float = 1.0
+    # Seconds before a running job is assumed lost and is picked up again.
+    job_lease: float = 600.0
+    job_max_attempts: int = 3
+    # Longest a request asking to wait for its job (`wait=true`) will wait.
+    job_wait_timeout: float = 30.0
+    # Samples streaming exports read (and send) at a time.
+    export_chunk_size: int = 1000
+    # Flattened runs (as prepended to their samples in exports) each worker
+    # keeps cached, by run version (0 disables the cache).
+    export_run_cache_size: int = 256
+    # Fraction of requests whose queries are profiled (0 disables profiling,
+    # 1 profiles every request), reporting those taking at least
+    # profile_min_request_time seconds. Whether a request is slow is only
+    # known once it finishes, so every query of every sampled request is
+    # still recorded; fast ones just skip the tallying and the report. To
+    # catch slow requests cheaply, pair a threshold with a low sample rate.
+    profile_sample_rate: float = 0.0
+    profile_min_request_time: float = 0.0
+    # 'json' writes each report as one line of JSON, 'stream' pretty prints
+    # it (easier to read in local development).
+    profile_reporter: str = 'json'
     server_version: str = 'local'
 
     @property
@@ -1,15 +1,39 @@
-from starlette.middleware.base import BaseHTTPMiddleware
-from starlette.requests import Request
+class RequestSession:
+    """A request's database session, created the first time it is asked for."""
 
+    def __init__(self, session_factory):
+        self.session_factory = session_factory
+        self.session = None
+
+    def get(self):
+        if self.session is None:
+            self.session = self.session_factory()
+        return self.session
+
+    def close(self):
+        if self.session is not None:
+            self.session.close()
+            self.session = None
+
+
+class SqlalchemySessionMiddleware:
+    """Gives each request one session (`request.state.db`), shared by the
+    `get_db` dependency and the GraphQL resolvers, and closes it once the
+    response (including a streamed body) has been sent.
+    """
 
-class SqlalchemySessionMiddleware(BaseHTTPMiddleware):
     def __init__(self, app, session_factory):
         self.app = app
         self.session_factory = session_factory
 
-    async def dispatch_func(self, request: Request, call_next):
-        with self.session_factory() as db:
-            request.state.session = db
-            response = await call_next(request)
-            request.state.session = None
-            return response
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        request_session = RequestSession(self.session_factory)
+        scope.setdefault('state', {})['db'] = request_session
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            request_session.close()